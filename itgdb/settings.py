@@ -174,6 +174,72 @@ CELERY_CACHE_BACKEND = 'django-cache'
 CELERY_RESULT_EXTENDED = True
 
 
+# Chart analysis
+# max number of cached chart analysis results (0 disables the cache)
+ANALYSIS_CACHE_MAX_ENTRIES = int(
+    os.environ.get('ANALYSIS_CACHE_MAX_ENTRIES', 100000)
+)
+# charts that would take more than this many bytes to analyze all at once get
+# analyzed a chunk of measures at a time instead (0 disables the ceiling)
+ANALYSIS_MEMORY_CEILING = int(
+    os.environ.get('ANALYSIS_MEMORY_CEILING', 64 * 1024 * 1024)
+)
+# number of worker processes to analyze the songs of a pack with during pack
+# uploads (0 analyzes them in the uploading process itself)
+UPLOAD_ANALYSIS_PROCESSES = int(
+    os.environ.get('UPLOAD_ANALYSIS_PROCESSES', 0)
+)
+# analyze the songs of uploaded packs in separate celery tasks, so that they
+# can be spread out over all the workers. requires MEDIA_ROOT to be shared by
+# all the workers
+DISTRIBUTED_PACK_UPLOADS = os.environ.get('DISTRIBUTED_PACK_UPLOADS', '0') == '1'
+# number of threads to process the images (banners, backgrounds etc.) of a pack
+# with during pack uploads (0 processes them in the uploading thread)
+UPLOAD_ASSET_THREADS = int(os.environ.get('UPLOAD_ASSET_THREADS', 8))
+# packs that have to be extracted (see utils/extraction.py) may only extract
+# this many bytes/files (0 means no limit)
+EXTRACTION_MAX_BYTES = int(
+    os.environ.get('EXTRACTION_MAX_BYTES', 16 * 1024 * 1024 * 1024)
+)
+EXTRACTION_MAX_FILES = int(os.environ.get('EXTRACTION_MAX_FILES', 20000))
+# total bytes that all the concurrent extractions may take up (0 means no
+# limit). extractions that don't fit wait for the others to finish
+EXTRACTION_SCRATCH_BYTES = int(
+    os.environ.get('EXTRACTION_SCRATCH_BYTES', 32 * 1024 * 1024 * 1024)
+)
+# maximum total size of the downloaded pack files kept around in case they get
+# fetched again (0 disables the download cache)
+DOWNLOAD_CACHE_MAX_BYTES = int(
+    os.environ.get('DOWNLOAD_CACHE_MAX_BYTES', 16 * 1024 * 1024 * 1024)
+)
+# pack downloads of at least DOWNLOAD_SEGMENT_MIN_BYTES bytes are split into
+# this many segments that are downloaded in parallel (if the host supports
+# range requests; 1 disables this)
+DOWNLOAD_SEGMENTS = int(os.environ.get('DOWNLOAD_SEGMENTS', 4))
+DOWNLOAD_SEGMENT_MIN_BYTES = int(
+    os.environ.get('DOWNLOAD_SEGMENT_MIN_BYTES', 64 * 1024 * 1024)
+)
+# run batch uploads as a single task that downloads and extracts the next
+# packs while the current one is being uploaded, rather than as a group of
+# tasks that each download, extract and upload one link at a time (which can
+# be spread out over all the workers)
+PIPELINED_BATCH_UPLOADS = os.environ.get('PIPELINED_BATCH_UPLOADS', '0') == '1'
+# number of links of a pipelined batch upload to download/extract at once
+BATCH_UPLOAD_DOWNLOAD_THREADS = int(
+    os.environ.get('BATCH_UPLOAD_DOWNLOAD_THREADS', 2)
+)
+BATCH_UPLOAD_EXTRACT_THREADS = int(
+    os.environ.get('BATCH_UPLOAD_EXTRACT_THREADS', 1)
+)
+# number of downloaded (or extracted) links that may wait for the next step
+BATCH_UPLOAD_QUEUE_SIZE = int(os.environ.get('BATCH_UPLOAD_QUEUE_SIZE', 1))
+# no more downloads are started while the links waiting to be extracted or
+# uploaded take up more than this many bytes on disk (0 means no limit)
+BATCH_UPLOAD_HIGH_WATER_BYTES = int(
+    os.environ.get('BATCH_UPLOAD_HIGH_WATER_BYTES', 32 * 1024 * 1024 * 1024)
+)
+
+
 # Storages
 AWS_STORAGE_BUCKET_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME', 'itgdbtest')
 AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL', 'http://s3.localhost.localstack.cloud:4566')
@@ -199,7 +265,7 @@ STORAGES = {
         'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage',
     },
     'simfiles': {
-        'BACKEND': 'storages.backends.s3.S3Storage',
+        'BACKEND': 'itgdb_site.storage_backends.ContentAddressedS3Storage',
         'OPTIONS': {
             **base_bucket_storage_options,
             'location': 'sims/',
@@ -207,7 +273,7 @@ STORAGES = {
         }
     },
     'simfilemedia': {
-        'BACKEND': 'storages.backends.s3.S3Storage',
+        'BACKEND': 'itgdb_site.storage_backends.ContentAddressedS3Storage',
         'OPTIONS': {
             **base_bucket_storage_options,
             'location': 'images/',
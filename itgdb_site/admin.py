@@ -4,6 +4,7 @@ import logging
 import json
 import re
 import uuid
+from django.conf import settings
 from django.contrib import admin
 from django.core.files import File
 from django.core.files.uploadhandler import TemporaryFileUploadHandler
@@ -26,9 +27,11 @@ import celery.result
 import simfile
 
 from .models import Tag, Pack, Song, Chart, ImageFile, PackCategory
-from .forms import PackUploadForm, BatchUploadForm, UpdateAnalysesForm, ChangeReleaseDateForm, UploadPatchForm, PatchSongForm
-from .tasks import process_pack_upload, process_pack_from_web, update_analyses, process_patch_upload, ProcessPatchResults
+from .forms import PackUploadForm, BatchUploadForm, UpdateAnalysesForm, ReanalyzeOutdatedForm, RehashChartsForm, ChangeReleaseDateForm, UploadPatchForm, PatchSongForm
+from .tasks import process_pack_upload, process_pack_from_web, update_analyses, reanalyze_outdated_analyses, make_rehash_charts_group, process_patch_upload, ProcessPatchResults, start_batch_upload
 from .utils.uploads import update_song_with_simfile
+from .utils.reanalysis import get_outdated_songs
+from .utils.stored_files import storing_files
 
 logger = logging.getLogger(__name__)
 
@@ -181,8 +184,11 @@ class PackAdmin(ExtraButtonsMixin, admin.ModelAdmin):
                     return render(req, 'admin/itgdb_site/batch_upload.html', context)
                 logger.debug('after parse')
                         
-                task_group = group(tasks)
-                group_result = task_group.apply_async()
+                if settings.PIPELINED_BATCH_UPLOADS:
+                    group_result = start_batch_upload(tasks)
+                else:
+                    task_group = group(tasks)
+                    group_result = task_group.apply_async()
                 logger.debug('after task group')
                 group_result.save()
                 logger.debug('after group save')
@@ -343,10 +349,11 @@ class SongAdmin(ExtraButtonsMixin, admin.ModelAdmin):
             form = PatchSongForm(req.POST, req.FILES)
             if form.is_valid():
                 file = form.cleaned_data['file']
-                with transaction.atomic():
+                with storing_files(), transaction.atomic():
                     song = Song.objects.get(pk=song_id)
                     sim_uuid = uuid.uuid4()
                     song.simfile = File(file, name=f'{sim_uuid}_{file.name}')
+                    song.simfile_name = file.name
 
                     path = file.temporary_file_path()
                     sim = simfile.open(path, strict=False)
@@ -392,6 +399,43 @@ class SongAdmin(ExtraButtonsMixin, admin.ModelAdmin):
         context['form'] = form
         return render(req, 'admin/itgdb_site/update_analyses.html', context)
 
+    @button()
+    def reanalyze_outdated(self, req):
+        context = self.get_common_context(req)
+        if req.method == 'POST':
+            form = ReanalyzeOutdatedForm(req.POST)
+            if form.is_valid():
+                result = reanalyze_outdated_analyses.delay(
+                    form.cleaned_data['chunk_size']
+                )
+                return HttpResponseRedirect(
+                    reverse('admin:task_progress_tracker', args=(result.id,))
+                )
+        else:
+            form = ReanalyzeOutdatedForm()
+        context['form'] = form
+        context['outdated_song_count'] = get_outdated_songs().count()
+        return render(req, 'admin/itgdb_site/reanalyze_outdated.html', context)
+
+    @button()
+    def rehash_charts(self, req):
+        context = self.get_common_context(req)
+        if req.method == 'POST':
+            form = RehashChartsForm(req.POST)
+            if form.is_valid():
+                task_group = make_rehash_charts_group(
+                    form.cleaned_data['songs_per_task']
+                )
+                group_result = task_group.apply_async()
+                group_result.save()
+                return HttpResponseRedirect(
+                    reverse('admin:group_progress_tracker', args=(group_result.id,))
+                )
+        else:
+            form = RehashChartsForm()
+        context['form'] = form
+        return render(req, 'admin/itgdb_site/rehash_charts.html', context)
+
 
 def _get_task_args_display(res):
     if not res:
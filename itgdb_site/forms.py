@@ -92,6 +92,18 @@ class UpdateAnalysesForm(forms.Form):
     )
 
 
+class ReanalyzeOutdatedForm(forms.Form):
+    chunk_size = forms.IntegerField(
+        label='Songs per chunk', min_value=1, initial=50
+    )
+
+
+class RehashChartsForm(forms.Form):
+    songs_per_task = forms.IntegerField(
+        label='Songs per task', min_value=1, initial=50
+    )
+
+
 class PackSearchForm(forms.Form):
     q = forms.CharField(
         label='',
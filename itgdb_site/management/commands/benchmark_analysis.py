@@ -0,0 +1,370 @@
+"""Benchmark the chart analysis routines used during pack uploads.
+
+Usage: python manage.py benchmark_analysis [paths ...] [--repeat N]
+    [--scenario NAME ...] [--steps] [--step STEP ...] [--backend BACKEND]
+    [--seed N] [--memory-ceiling BYTES] [--output FILE] [--compare FILE]
+
+The simfiles benchmarked are the ones found under the given paths (the test
+packs by default), or with --scenario, the synthetic simfiles generated by
+utils/analysis/synthetic.py ('all' for every scenario, with --seed).
+
+By default, every simfile is analyzed the way upload_song()/upload_chart()
+would, once per analysis backend and mode:
+- separate: get_counts(), get_density_graph() and get_stream_info() are
+  called one after another, like upload_chart() used to do
+- fused: a single call to ChartAnalyzer.analyze()
+For each combination, we report the number of passes made through the charts'
+note data along with the wall time of the fastest of --repeat runs.
+
+With --steps (or --step to pick some of them), each step is timed separately
+instead, per simfile, with the given --backend:
+- construct: SongAnalyzer() plus get_chart_analyzer() for every chart
+- get_chart_len, get_bpm_ranges: once for the song
+- get_counts, get_density_graph, get_stream_info, get_hash: once per chart
+Each run of a step starts from a freshly constructed SongAnalyzer (built
+outside the timed region), so it includes whatever parsing that step needs.
+We report the fastest and the median of --repeat runs, and the peak memory,
+which is measured with tracemalloc in one extra run, since tracing slows
+everything down.
+
+--memory-ceiling overrides settings.ANALYSIS_MEMORY_CEILING, e.g. to compare
+chunked analysis (see utils/analysis/streaming.py) against analyzing every
+chart all at once (--memory-ceiling 0).
+
+--output writes the results as JSON. Passing the JSON of an earlier run (e.g.
+from another commit) to --compare prints the relative change of every
+measurement.
+"""
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+import simfile
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from simfile.notes import NoteData
+
+from ...utils.analysis import SongAnalyzer
+from ...utils.analysis.analyzer import BACKENDS, DEFAULT_BACKEND
+from ...utils.analysis.synthetic import SCENARIOS, generate_simfile
+from ...utils.charts import get_hash
+
+
+MODES = ('separate', 'fused')
+DEFAULT_PATHS = [os.path.join(settings.BASE_DIR, 'itgdb_site/tests/packs')]
+
+
+@contextmanager
+def count_note_passes():
+    """Count the number of times any NoteData instance gets iterated
+    through while inside this context."""
+    counter = {'passes': 0}
+    orig_iter = NoteData.__iter__
+
+    def counting_iter(self):
+        counter['passes'] += 1
+        return orig_iter(self)
+
+    NoteData.__iter__ = counting_iter
+    try:
+        yield counter
+    finally:
+        NoteData.__iter__ = orig_iter
+
+
+def find_simfile_paths(paths):
+    for path in paths:
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith(('.sm', '.ssc')):
+                    yield os.path.join(dirpath, filename)
+
+
+def analyze_song(sim, backend: str, mode: str, memory_ceiling: int) -> int:
+    """Analyze all charts of a simfile. Returns the number of charts
+    analyzed."""
+    song_analyzer = SongAnalyzer(sim, backend, memory_ceiling)
+    song_analyzer.get_chart_len()
+    chart_count = 0
+    for chart in sim.charts:
+        analyzer = song_analyzer.get_chart_analyzer(chart)
+        if mode == 'fused':
+            analyzer.analyze()
+        else:
+            analyzer.get_counts()
+            analyzer.get_density_graph()
+            analyzer.get_stream_info()
+        chart_count += 1
+    return chart_count
+
+
+# Per-step timing: ===================================================
+
+def _construct(sim, analyzer_args):
+    song_analyzer = SongAnalyzer(sim, **analyzer_args)
+    for chart in sim.charts:
+        song_analyzer.get_chart_analyzer(chart)
+
+
+def _per_chart(method_name):
+    def step(sim, analyzer_args):
+        song_analyzer = SongAnalyzer(sim, **analyzer_args)
+        analyzers = [song_analyzer.get_chart_analyzer(c) for c in sim.charts]
+        return lambda: [getattr(a, method_name)() for a in analyzers]
+    return step
+
+
+def _per_song(method_name):
+    def step(sim, analyzer_args):
+        song_analyzer = SongAnalyzer(sim, **analyzer_args)
+        return getattr(song_analyzer, method_name)
+    return step
+
+
+def _hash_step(sim, analyzer_args):
+    return lambda: [get_hash(sim, chart) for chart in sim.charts]
+
+
+# each step takes a simfile and the SongAnalyzer arguments, does any untimed
+# setup, and returns the function to time
+STEPS = {
+    'construct': lambda sim, args: lambda: _construct(sim, args),
+    'get_chart_len': _per_song('get_chart_len'),
+    'get_bpm_ranges': _per_song('get_bpm_ranges'),
+    'get_counts': _per_chart('get_counts'),
+    'get_density_graph': _per_chart('get_density_graph'),
+    'get_stream_info': _per_chart('get_stream_info'),
+    'get_hash': _hash_step,
+}
+
+
+def run_step(step, sim, analyzer_args: dict, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        func = step(sim, analyzer_args)
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    func = step(sim, analyzer_args)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'min_s': min(times),
+        'median_s': statistics.median(times),
+        'peak_bytes': peak,
+    }
+
+
+def _get_commit():
+    try:
+        completed_process = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, encoding='utf-8'
+        )
+    except OSError:
+        return None
+    if completed_process.returncode != 0:
+        return None
+    return completed_process.stdout.strip()
+
+
+# the fields that identify a result (as opposed to measurements), for
+# matching results up with --compare
+_RESULT_KEYS = ('simfile', 'step', 'backend', 'mode')
+
+
+class Command(BaseCommand):
+    help = 'Benchmark chart analysis (note data passes, time and memory)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*', default=DEFAULT_PATHS,
+            help='directories to search for simfiles (default: test packs)'
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=3,
+            help='number of timed runs per measurement'
+        )
+        parser.add_argument(
+            '--scenario', action='append',
+            choices=['all', *SCENARIOS.keys()],
+            help='benchmark this synthetic simfile instead of the simfiles in '
+                'paths (can be repeated)'
+        )
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='seed for the synthetic simfile generator'
+        )
+        parser.add_argument(
+            '--steps', action='store_true',
+            help='time each analysis step separately'
+        )
+        parser.add_argument(
+            '--step', action='append', choices=STEPS.keys(),
+            help='step to time (can be repeated; implies --steps)'
+        )
+        parser.add_argument(
+            '--backend', choices=BACKENDS, default=DEFAULT_BACKEND,
+            help='analysis backend for --steps'
+        )
+        parser.add_argument(
+            '--memory-ceiling', type=int,
+            help='analysis memory ceiling in bytes (default: from settings)'
+        )
+        parser.add_argument(
+            '--output', help='write the results as JSON to this file'
+        )
+        parser.add_argument(
+            '--compare', help='JSON results of an earlier run to compare to'
+        )
+
+    def _get_simfiles(self, options):
+        # (name, simfile) pairs
+        scenarios = options['scenario']
+        if scenarios:
+            if 'all' in scenarios:
+                scenarios = list(SCENARIOS)
+            return [
+                (name, simfile.loads(generate_simfile(name, options['seed'])))
+                for name in dict.fromkeys(scenarios)
+            ]
+        return [
+            (os.path.relpath(path), simfile.open(path, strict=False))
+            for path in find_simfile_paths(options['paths'])
+        ]
+
+    def handle(self, *args, **options):
+        sims = self._get_simfiles(options)
+        if not sims:
+            raise CommandError('No simfiles found.')
+        self.stdout.write(f'Found {len(sims)} simfiles.')
+
+        repeat = max(options['repeat'], 1)
+        memory_ceiling = options['memory_ceiling']
+        if memory_ceiling is None:
+            memory_ceiling = settings.ANALYSIS_MEMORY_CEILING
+        meta = {
+            'commit': _get_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'memory_ceiling': memory_ceiling,
+            'seed': options['seed'],
+            'repeat': repeat,
+        }
+
+        if options['steps'] or options['step']:
+            meta['backend'] = options['backend']
+            results = self._benchmark_steps(
+                sims, options['step'] or list(STEPS), repeat,
+                {'backend': options['backend'],
+                 'memory_ceiling': memory_ceiling}
+            )
+        else:
+            results = self._benchmark_modes(sims, repeat, memory_ceiling)
+
+        output = {'meta': meta, 'results': results}
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(output, f, indent=2)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            self._compare(baseline, output)
+
+    def _benchmark_modes(self, sims, repeat, memory_ceiling):
+        results = []
+        self.stdout.write(
+            f'{"backend":<10}{"mode":<10}{"charts":>8}{"passes":>8}'
+            f'{"passes/chart":>14}{"time (s)":>12}'
+        )
+        for backend in BACKENDS:
+            for mode in MODES:
+                best_time = None
+                for _ in range(repeat):
+                    chart_count = 0
+                    with count_note_passes() as counter:
+                        start = time.perf_counter()
+                        for _, sim in sims:
+                            chart_count += analyze_song(
+                                sim, backend, mode, memory_ceiling
+                            )
+                        elapsed = time.perf_counter() - start
+                    if best_time is None or elapsed < best_time:
+                        best_time = elapsed
+                passes = counter['passes']
+                results.append({
+                    'backend': backend,
+                    'mode': mode,
+                    'charts': chart_count,
+                    'passes': passes,
+                    'min_s': best_time,
+                })
+                self.stdout.write(
+                    f'{backend:<10}{mode:<10}{chart_count:>8}{passes:>8}'
+                    f'{passes / max(chart_count, 1):>14.2f}'
+                    f'{best_time:>12.4f}'
+                )
+        return results
+
+    def _benchmark_steps(self, sims, steps, repeat, analyzer_args):
+        results = []
+        self.stdout.write(
+            f'{"simfile":<30}{"step":<20}{"min (s)":>10}{"median (s)":>12}'
+            f'{"peak (KiB)":>12}'
+        )
+        for name, sim in sims:
+            for step in steps:
+                result = {
+                    'simfile': name,
+                    'step': step,
+                    'charts': len(sim.charts),
+                    **run_step(STEPS[step], sim, analyzer_args, repeat)
+                }
+                results.append(result)
+                self.stdout.write(
+                    f'{name[-29:]:<30}{step:<20}{result["min_s"]:>10.4f}'
+                    f'{result["median_s"]:>12.4f}'
+                    f'{result["peak_bytes"] / 1024:>12.0f}'
+                )
+        return results
+
+    def _compare(self, baseline, output):
+        def get_key(result):
+            return tuple(result.get(k) for k in _RESULT_KEYS)
+
+        old_results = {get_key(r): r for r in baseline['results']}
+        self.stdout.write(
+            f'\nCompared to {baseline["meta"].get("commit") or "baseline"}:'
+        )
+        self.stdout.write(f'{"":<50}{"min time":>10}{"peak mem":>10}')
+        for result in output['results']:
+            old = old_results.get(get_key(result))
+            if old is None:
+                continue
+            name = ' '.join(
+                str(result[k]) for k in _RESULT_KEYS if k in result
+            )
+            time_change = result['min_s'] / old['min_s'] - 1 \
+                if old['min_s'] else 0
+            if old.get('peak_bytes'):
+                mem_change = result['peak_bytes'] / old['peak_bytes'] - 1
+                mem_change = f'{mem_change:>+10.1%}'
+            else:
+                mem_change = f'{"-":>10}'
+            self.stdout.write(
+                f'{name[-49:]:<50}{time_change:>+10.1%}{mem_change}'
+            )
@@ -0,0 +1,106 @@
+"""Compare the audio durations read by utils/audio.py to ffprobe's.
+
+Usage: python manage.py compare_audio_durations [paths ...] [--tolerance S]
+    [--verbose]
+
+Every audio file found under the given paths (the test packs by default) gets
+its duration read from its headers (read_audio_duration()) and by ffprobe
+(probe_audio_duration()). Files whose durations differ by more than
+--tolerance seconds are listed (with --verbose, every file is), followed by a
+summary of the differences and the time each method took in total.
+"""
+
+import os
+import time
+from django.conf import settings
+from fs.errors import FSError
+from django.core.management.base import BaseCommand
+
+from ...utils.audio import (
+    UnsupportedAudioError, read_audio_duration, probe_audio_duration
+)
+from ...utils.charts import SOUND_EXTS
+
+
+DEFAULT_PATHS = [os.path.join(settings.BASE_DIR, 'itgdb_site/tests/packs')]
+
+
+def find_audio_paths(paths):
+    for path in paths:
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith(SOUND_EXTS):
+                    yield os.path.join(dirpath, filename)
+
+
+class Command(BaseCommand):
+    help = 'Compare audio durations read from file headers to ffprobe\'s'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*', default=DEFAULT_PATHS,
+            help='directories to search for audio files (default: test packs)'
+        )
+        parser.add_argument(
+            '--tolerance', type=float, default=0.05,
+            help='list files whose durations differ by more than this many '
+                'seconds'
+        )
+        parser.add_argument(
+            '--verbose', action='store_true', help='list every file'
+        )
+
+    def handle(self, *args, **options):
+        tolerance = options['tolerance']
+        read_time = 0
+        probe_time = 0
+        diffs = []
+        unsupported = []
+        file_count = 0
+        for path in find_audio_paths(options['paths']):
+            file_count += 1
+            start = time.perf_counter()
+            try:
+                duration = read_audio_duration(path)
+            except (UnsupportedAudioError, OSError, FSError) as e:
+                duration = None
+                unsupported.append(path)
+                self.stdout.write(f'{path}: unsupported ({e})')
+            read_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            probed = probe_audio_duration(path)
+            probe_time += time.perf_counter() - start
+
+            if duration is None:
+                continue
+            if probed is None:
+                self.stdout.write(f'{path}: ffprobe failed, read {duration:.3f}')
+                continue
+            diff = duration - probed
+            diffs.append(abs(diff))
+            if options['verbose'] or abs(diff) > tolerance:
+                self.stdout.write(
+                    f'{path}: read {duration:.3f}, ffprobe {probed:.3f} '
+                    f'({diff:+.3f})'
+                )
+
+        if not file_count:
+            self.stderr.write('No audio files found.')
+            return
+        self.stdout.write(f'\nFiles: {file_count}')
+        self.stdout.write(
+            f'Unsupported (would fall back to ffprobe): {len(unsupported)}'
+        )
+        if diffs:
+            over = sum(1 for diff in diffs if diff > tolerance)
+            self.stdout.write(
+                f'Max difference: {max(diffs):.4f} s, '
+                f'mean: {sum(diffs) / len(diffs):.4f} s'
+            )
+            self.stdout.write(f'Over tolerance ({tolerance} s): {over}')
+        self.stdout.write(
+            f'Total time: {read_time:.4f} s from headers, '
+            f'{probe_time:.4f} s with ffprobe'
+        )
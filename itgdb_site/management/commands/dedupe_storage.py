@@ -0,0 +1,89 @@
+"""Move the files of existing ImageFiles and Songs to content-addressed names.
+
+Usage: python manage.py dedupe_storage [--dry-run]
+
+Files uploaded before storage became content-addressed (see
+storage_backends.ContentAddressedS3Storage) are named {uuid}_{filename}, so
+identical files got stored once per upload. For every such file, this stores
+its contents under its content-addressed name (unless an identical file is
+stored already), points the rows that use it to the new name and deletes the
+old file (along with its thumbnails).
+
+With --dry-run, files are only read and hashed, to report how much would be
+saved.
+"""
+
+from django.core.management.base import BaseCommand
+from sorl.thumbnail import delete
+
+from ...models import ImageFile
+from ...storage_backends import CONTENT_NAME_PATTERN, get_content_name
+from ...utils.stored_files import CONTENT_ADDRESSED_FIELDS, storing_files
+
+
+class Command(BaseCommand):
+    help = 'Deduplicate stored images and simfiles by content hash'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='only report what would be done'
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        for model, field_name in CONTENT_ADDRESSED_FIELDS.items():
+            self._dedupe(model, field_name, dry_run)
+
+    def _dedupe(self, model, field_name: str, dry_run: bool):
+        field = model._meta.get_field(field_name)
+        storage = field.storage
+        old_names = [
+            name for name in model.objects.exclude(**{field_name: ''})
+                .order_by(field_name).values_list(field_name, flat=True)
+                .distinct()
+            if not CONTENT_NAME_PATTERN.search(name)
+        ]
+        # content-addressed name -> size, for every file we've seen
+        new_names = {}
+        old_bytes = 0
+        rows = 0
+        missing = 0
+        for old_name in old_names:
+            try:
+                f = storage.open(old_name, 'rb')
+            except OSError:
+                # includes FileNotFoundError
+                self.stderr.write(f'{model.__name__}: missing {old_name}')
+                missing += 1
+                continue
+            with f:
+                new_name = get_content_name(old_name, f)
+                old_bytes += f.size
+                new_names[new_name] = f.size
+                if dry_run:
+                    continue
+                # so the new file, if it was stored already, doesn't get
+                # deleted before the rows refer to it
+                with storing_files():
+                    stored_name = storage.save(old_name, f)
+                    assert stored_name == new_name
+                    # update() doesn't send post_save, so the old file isn't
+                    # deleted by signals.py; we do that ourselves once
+                    # nothing refers to it
+                    rows += model.objects.filter(**{field_name: old_name}) \
+                        .update(**{field_name: new_name})
+            old_file = field.attr_class(None, field, old_name)
+            if model is ImageFile:
+                # also deletes the thumbnails
+                delete(old_file)
+            else:
+                storage.delete(old_name)
+
+        new_bytes = sum(new_names.values())
+        self.stdout.write(
+            f'{model.__name__}.{field_name}: {len(old_names)} files '
+            f'({missing} missing) -> {len(new_names)} unique, '
+            f'{old_bytes - new_bytes} bytes '
+            f'{"would be " if dry_run else ""}saved, {rows} rows updated'
+        )
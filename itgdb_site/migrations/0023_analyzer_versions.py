@@ -0,0 +1,33 @@
+# Generated by Django 5.1.15 on 2026-10-17 03:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itgdb_site', '0022_analysiscacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chart',
+            name='counts_version',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chart',
+            name='density_graph_version',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chart',
+            name='stream_info_version',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='chart_length_version',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,202 @@
+# Generated by Django 5.1.15 on 2026-10-17 12:10
+
+import math
+from django.db import migrations, models
+
+
+# version 1 of the breakdowns (see ANALYZER_VERSIONS). hardcoded so that
+# bumping the version later still leaves these for re-analysis to regenerate
+BREAKDOWNS_VERSION = 1
+
+
+# frozen copy of version 1 of utils/analysis/breakdown.py, so that this
+# migration keeps generating version 1 breakdowns whatever happens to that
+# module later
+MAX_BREAKDOWN_SEGMENTS = 24
+
+
+# specify all runs, and all breaks longer than 1 measure
+def _gen_full_breakdown(stream_info):
+    segs = stream_info['segments']
+    if len(segs) > MAX_BREAKDOWN_SEGMENTS:
+        return None
+
+    multiplier = stream_info['quant'] / 16
+    breakdown_parts = []
+    for seg in segs:
+        seg_len = math.floor(abs(seg) * multiplier)
+        if seg > 0: # if this is a stream segment
+            breakdown_parts.append(str(seg_len))
+        else: # if this is a break
+            breakdown_parts.append(f'({seg_len})')
+
+    return ' '.join(breakdown_parts)
+
+
+# represent breaks with symbols:
+# - "'": 1 measure
+# - '-': 2-4 measures
+# - '/': 5-31 measures
+# - '|': >=32 measures
+# simplification levels:
+# - 1: turn all breaks into symbols
+# - 2: breaks of 1 measure are accumulated into broken stream
+# - 3: all '-' breaks are accumulated into broken stream
+def _gen_simplified_breakdown(stream_info, simplify_level):
+    segs = stream_info['segments']
+    multiplier = stream_info['quant'] / 16
+
+    breakdown_parts = []
+    accum_stream = 0 # measured in original chart measures
+    is_broken = False
+
+    def add_part(adj_break_len=None):
+        nonlocal accum_stream, is_broken
+        part = str(math.floor(accum_stream * multiplier))
+        if is_broken:
+            part += '*'
+        if adj_break_len is not None:
+            if adj_break_len < 2:
+                part += "'"
+            elif adj_break_len < 5:
+                part += '-'
+            elif adj_break_len < 32:
+                part += '/'
+            else:
+                part += ' | '
+        breakdown_parts.append(part)
+        # reset
+        accum_stream = 0
+        is_broken = False
+
+    for i, seg in enumerate(segs):
+        # NOTE: we will always append one more breakdown part after this loop,
+        # so if at any point during this loop does the length of breakdown_parts
+        # reach the maximum, it will break the maximum once it leaves the loop.
+        # thus we should abort now.
+        if len(breakdown_parts) >= MAX_BREAKDOWN_SEGMENTS:
+            return None
+
+        if seg > 0: # if stream
+            # if previous segment was also stream, this indicates a
+            # 1-measure break
+            if i > 0 and segs[i - 1] > 0:
+                if simplify_level == 1:
+                    # notate the 1-measure break
+                    # note: 1 measure break * multiplier = multiplier
+                    add_part(multiplier)
+                else:
+                    # accumulate break into broken stream
+                    accum_stream += 1
+                    is_broken = True
+
+            # add the current stream segment
+            accum_stream += seg
+
+        else: # if break
+            break_len = -seg
+            adj_break_len = break_len * multiplier
+
+            # if the break is short enough, merge it into the previous
+            # stream segment instead of ending the stream segment
+            if simplify_level == 3 and adj_break_len < 5:
+                accum_stream += break_len
+                is_broken = True
+            else:
+                add_part(adj_break_len)
+
+    # ensure we do not break the maximum by adding one more segment
+    if len(breakdown_parts) == MAX_BREAKDOWN_SEGMENTS:
+        return None
+    # add remaining stream
+    add_part()
+
+    return ''.join(breakdown_parts)
+
+
+def _gen_bpm_suffix(stream_info):
+    # '@ bpm' part for breakdowns that aren't in 16ths
+    if stream_info['quant'] == 16:
+        return ''
+    bpms = stream_info['bpms']
+    multiplier = stream_info['quant'] / 16
+    adj_bpms = [
+        round(bpms[0] * multiplier),
+        round(bpms[1] * multiplier)
+    ]
+    # display the bpm as 1 number if the bpm bounds round to the
+    # same number, or if the bounds are so close (e.g. float
+    # imprecision) that they should be considered as the same.
+    # the 2nd condition catches some cases that the 1st doesn't, e.g.
+    # if the multiplier takes min_bpm and max_bpm to something like
+    # 120.49999... and 120.500...01, which will round to different nums
+    if adj_bpms[0] == adj_bpms[1] or bpms[1] - bpms[0] < 1e-9:
+        return f' @ {adj_bpms[1]}'
+    return f' @ {adj_bpms[0]}-{adj_bpms[1]}'
+
+
+def generate_breakdowns(stream_info: dict) -> dict:
+    """Generate every breakdown of a chart, for storing alongside it:
+    - 'full': the full breakdown
+    - 'simplified': a list of the breakdowns at each simplification level
+      (1 to 3)
+    - 'display': the breakdown to show, i.e. the most detailed of the above
+      that isn't too long (or the total stream if none of them fit), plus
+      the '@ bpm' part if the chart isn't in 16ths
+    'full' and 'simplified' are None for breakdowns that would be too long,
+    and for charts without streams.
+    """
+    if not stream_info['segments']:
+        return {
+            'full': None,
+            'simplified': [None, None, None],
+            'display': 'No streams',
+        }
+
+    full = _gen_full_breakdown(stream_info)
+    simplified = [
+        _gen_simplified_breakdown(stream_info, simplify_level)
+        for simplify_level in range(1, 4)
+    ]
+    # use the most detailed breakdown that fits under the maximum
+    bd = next((b for b in [full, *simplified] if b is not None), None)
+    if bd is None:
+        bd = f'{stream_info["total_stream"]} total'
+    return {
+        'full': full,
+        'simplified': simplified,
+        'display': bd + _gen_bpm_suffix(stream_info),
+    }
+
+
+def generate_chart_breakdowns(apps, schema_editor):
+    Chart = apps.get_model('itgdb_site', 'Chart')
+    charts = Chart.objects.filter(analysis__has_key='stream_info') \
+        .only('analysis')
+    for chart in charts.iterator():
+        chart.breakdowns = generate_breakdowns(chart.analysis['stream_info'])
+        chart.breakdowns_version = BREAKDOWNS_VERSION
+        chart.save(update_fields=['breakdowns', 'breakdowns_version'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itgdb_site', '0023_analyzer_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chart',
+            name='breakdowns',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='chart',
+            name='breakdowns_version',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(
+            generate_chart_breakdowns, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations
+
+
+def clear_analysis_cache(apps, schema_editor):
+    # entries cached before the digest included the chart length can have
+    # the wrong density graph end point. they'd never be hit again anyway
+    # (bumping the density_graph version changed every digest), so just free
+    # up the space
+    AnalysisCacheEntry = apps.get_model('itgdb_site', 'AnalysisCacheEntry')
+    AnalysisCacheEntry.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itgdb_site', '0024_chart_breakdowns'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_analysis_cache, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.1.15 on 2026-10-17 05:39
+
+from django.db import migrations, models
+
+
+# files stored before storage became content-addressed are named
+# {uuid}_{original name}, so their original names can be recovered (unless
+# dedupe_storage has renamed them already)
+_UUID_PREFIX = '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_'
+
+
+def _fill_in_original_name(table: str, name_column: str, file_column: str):
+    return migrations.RunSQL(
+        sql=f"""UPDATE {table}
+            SET {name_column} =
+                substring({file_column} from '^{_UUID_PREFIX}(.*)$')
+            WHERE {file_column} ~ '^{_UUID_PREFIX}';""",
+        reverse_sql=migrations.RunSQL.noop
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itgdb_site', '0026_pendingfiledeletion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagefile',
+            name='original_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='simfile_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        _fill_in_original_name(
+            'itgdb_site_imagefile', 'original_name', 'image'
+        ),
+        _fill_in_original_name('itgdb_site_song', 'simfile_name', 'simfile'),
+    ]
@@ -2,6 +2,7 @@ from django.core.files.storage import storages
 from django.db import models
 from django.contrib.postgres.search import SearchVector
 from django.contrib.postgres.indexes import GinIndex
+from django_cleanup import cleanup
 from sorl.thumbnail import get_thumbnail
 
 # Callables to pass into the storage argument of a FileField/ImageField.
@@ -14,10 +15,15 @@ def get_simfilemedia_storage():
     return storages['simfilemedia']
 
 
+# files are in content-addressed storage and may be shared, so they're
+# deleted by the handlers in signals.py instead of by django-cleanup
+@cleanup.ignore
 class ImageFile(models.Model):
     pack = models.ForeignKey('Pack', on_delete=models.CASCADE, blank=True, null=True)
     song = models.ForeignKey('Song', on_delete=models.CASCADE, blank=True, null=True)
     image = models.ImageField(storage=get_simfilemedia_storage)
+    # the stored file is named after the hash of its contents
+    original_name = models.CharField(max_length=255, blank=True, default='')
     has_alpha = models.BooleanField()
 
     class Meta:
@@ -31,11 +37,9 @@ class ImageFile(models.Model):
         ]
 
     def __str__(self):
-        splits = self.image.name.split("_", 1)
-        name = splits[1 if len(splits) > 1 else 0]
-        return f'{self.id}: {name}'
+        return f'{self.id}: {self.original_name or self.image.name}'
     
-    def get_thumbnail(self):
+    def get_thumbnail(self, save=True):
         # PIL will error out if it tries to save an image with alpha as JPEG,
         # so we use PNG format for those instead
         format = 'PNG' if self.has_alpha else 'JPEG'
@@ -45,7 +49,8 @@ class ImageFile(models.Model):
             # in case there are some images with incorrectly-labelled has_alpha
             # values, just have it generate PNG as fallback
             self.has_alpha = True
-            self.save()
+            if save:
+                self.save()
             return get_thumbnail(self.image, 'x50', format='PNG')
 
 
@@ -97,6 +102,7 @@ class Pack(models.Model):
         return self.name
 
 
+@cleanup.ignore # see ImageFile
 class Song(models.Model):
     pack = models.ForeignKey(Pack, on_delete=models.CASCADE, null=True, blank=True)
     title = models.CharField(max_length=500, blank=True, default='')
@@ -117,6 +123,8 @@ class Song(models.Model):
     upload_date = models.DateTimeField(null=True, blank=True, auto_now_add=True)
     links = models.TextField(blank=True, default='')
     simfile = models.FileField(storage=get_simfiles_storage)
+    # the stored file is named after the hash of its contents
+    simfile_name = models.CharField(max_length=255, blank=True, default='')
     banner = models.ForeignKey(
         ImageFile, on_delete=models.SET_NULL, related_name='banner_songs',
         blank=True, null=True
@@ -138,6 +146,9 @@ class Song(models.Model):
     has_attacks = models.BooleanField(default=False)
     has_sm = models.BooleanField(default=False)
     has_ssc = models.BooleanField(default=False)
+    # version of the analyzer that computed chart_length (0 if unknown),
+    # see ANALYZER_VERSIONS in utils.analysis.analyzer
+    chart_length_version = models.PositiveSmallIntegerField(default=0)
 
     class Meta:
         constraints = [
@@ -234,6 +245,15 @@ class Chart(models.Model):
     rolls_count = models.PositiveIntegerField()
     lifts_count = models.PositiveIntegerField()
     fakes_count = models.PositiveIntegerField()
+    # versions of the analyzer that computed the counts and the components of
+    # analysis (0 if unknown), see ANALYZER_VERSIONS in utils.analysis.analyzer
+    counts_version = models.PositiveSmallIntegerField(default=0)
+    density_graph_version = models.PositiveSmallIntegerField(default=0)
+    stream_info_version = models.PositiveSmallIntegerField(default=0)
+    # breakdown strings generated from analysis['stream_info'], see
+    # generate_breakdowns() in utils.analysis.breakdown
+    breakdowns = models.JSONField(default=dict, blank=True)
+    breakdowns_version = models.PositiveSmallIntegerField(default=0)
 
     class Meta:
         indexes = [
@@ -332,3 +352,32 @@ class Chart(models.Model):
             desc = (self.description or '').lower()
             return (steps_type, diff, desc)
         return (steps_type, diff)
+
+
+class AnalysisCacheEntry(models.Model):
+    """Cached analysis results of a chart, keyed by a digest of the chart's
+    notes and timing data (see utils.analysis.cache)."""
+    digest = models.CharField(max_length=64, unique=True)
+    analysis = models.JSONField()
+    last_used = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return self.digest
+
+
+class PendingFileDeletion(models.Model):
+    """A file in content-addressed storage to delete once no row refers to
+    it (see utils.stored_files)."""
+    model = models.CharField(max_length=32)
+    name = models.CharField(max_length=255)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['model', 'name'],
+                name='unique_pending_file_deletion'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.model}: {self.name}'
@@ -1,8 +1,58 @@
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
 from django_cleanup.signals import cleanup_pre_delete
 from sorl.thumbnail import delete
 
+from .models import ImageFile, Song
+from .utils.stored_files import (
+    CONTENT_ADDRESSED_FIELDS, delete_unused_files, queue_file_deletion
+)
+
 
 @receiver(cleanup_pre_delete)
 def sorl_delete_thumbnails(**kwargs):
-    delete(kwargs['file'])
\ No newline at end of file
+    delete(kwargs['file'])
+
+
+# files in content-addressed storage can be shared by several rows, so
+# django-cleanup ignores these models, and we queue the files up for deletion
+# instead, see utils/stored_files.py
+def _delete_file_later(model, name: str):
+    queue_file_deletion(model, name)
+    # once the transaction is done, e.g. after a whole pack has been deleted
+    transaction.on_commit(delete_unused_files)
+
+
+def _get_file_name(instance) -> str:
+    return getattr(instance, CONTENT_ADDRESSED_FIELDS[type(instance)]).name
+
+
+@receiver(post_init, sender=ImageFile)
+@receiver(post_init, sender=Song)
+def remember_file_name(sender, instance, **kwargs):
+    # only for rows loaded from the database (without deferring the field,
+    # otherwise we'd have to load it for every instance)
+    if instance.pk is None \
+        or CONTENT_ADDRESSED_FIELDS[sender] in instance.get_deferred_fields():
+        instance._original_file_name = None
+    else:
+        instance._original_file_name = _get_file_name(instance)
+
+
+@receiver(post_save, sender=ImageFile)
+@receiver(post_save, sender=Song)
+def delete_replaced_file(sender, instance, created, update_fields, **kwargs):
+    field_name = CONTENT_ADDRESSED_FIELDS[sender]
+    new_name = _get_file_name(instance)
+    if not created and (update_fields is None or field_name in update_fields):
+        old_name = instance._original_file_name
+        if old_name and old_name != new_name:
+            _delete_file_later(sender, old_name)
+    instance._original_file_name = new_name
+
+
+@receiver(post_delete, sender=ImageFile)
+@receiver(post_delete, sender=Song)
+def delete_unused_file(sender, instance, **kwargs):
+    _delete_file_later(sender, _get_file_name(instance))
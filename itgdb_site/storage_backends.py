@@ -1,3 +1,6 @@
+import hashlib
+import os
+import re
 from storages.backends.s3 import S3Storage
 
 
@@ -5,4 +8,42 @@ from storages.backends.s3 import S3Storage
 # we need to make a class for the thumbnail storage
 class ThumbnailStorage(S3Storage):
     location = 'thumbs/'
-    default_acl = 'public-read'
\ No newline at end of file
+    default_acl = 'public-read'
+
+
+_HASH_CHUNK_SIZE = 1 << 16
+CONTENT_NAME_PATTERN = re.compile(r'(^|/)[0-9a-f]{64}(\.[^/]*)?$')
+
+
+def get_content_name(name: str, content) -> str:
+    """Get the content-addressed name of a file: the SHA-256 of its contents,
+    plus the extension of its original name (in the same directory)."""
+    sha256 = hashlib.sha256()
+    content.seek(0)
+    while chunk := content.read(_HASH_CHUNK_SIZE):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        sha256.update(chunk)
+    content.seek(0)
+    dirname, basename = os.path.split(name)
+    ext = os.path.splitext(basename)[1].lower()
+    return os.path.join(dirname, sha256.hexdigest() + ext)
+
+
+class ContentAddressedS3Storage(S3Storage):
+    """Stores files under the hash of their contents rather than the name
+    they're saved with (only the extension is kept), so identical files
+    uploaded by different packs, patches or re-uploads of a pack share one
+    object. A file that's already stored isn't uploaded again. Thumbnails are
+    shared as well, since sorl-thumbnail keys them by the source's name.
+
+    Since objects can be referred to by several rows, they must only be
+    deleted once nothing refers to them anymore, including rows that are yet
+    to be committed. Files should thus be saved inside of
+    utils.stored_files.storing_files(), see there."""
+
+    def _save(self, name, content):
+        name = get_content_name(name, content)
+        if self.exists(name):
+            return name
+        return super()._save(name, content)
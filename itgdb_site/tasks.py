@@ -1,23 +1,38 @@
 import os
 import shutil
 import re
+import traceback
 import uuid
+from collections import namedtuple
 from django.conf import settings
 from django.core.files.storage import default_storage
 from django.db import transaction
-import simfile
 from simfile.dir import SimfilePack
-from celery import shared_task
+from celery import shared_task, group, chord
+from celery.app.task import Context
+from celery.result import AsyncResult, GroupResult
 from celery.signals import task_postrun
 from celery.utils.log import get_task_logger
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-import patoolib
 import gdown
 
-from .utils.uploads import upload_pack, patch_pack, ProgressTrackingInfo, delete_dupe_sims
+from django_celery_results.models import ChordCounter
+from .utils.uploads import (
+    upload_pack, patch_pack, ProgressTrackingInfo, delete_dupe_sims,
+    analyze_song, SongAnalysis
+)
 from .utils.url_fetch import fetch_from_url
-from .utils.analysis import SongAnalyzer
+from .utils.archive_fs import NATIVE_FS, open_archive
+from .utils.extraction import extract_pack_archive, release_scratch_space
+from .utils.pipeline import Pipeline, Stage
+from .utils.stored_files import storing_files
+from .utils.analysis import SongAnalyzer, AnalysisCache
+from .utils.analysis.analyzer import ANALYZER_VERSIONS
+from .utils.reanalysis import (
+    open_stored_simfile, reanalyze_outdated, rehash_song, update_breakdowns,
+    DEFAULT_CHUNK_SIZE
+)
 from .models import Pack, Song, Chart
 
 logger = get_task_logger(__name__)
@@ -37,38 +52,56 @@ def _send_progress_update(task_id, state, progress, message):
     })
 
 
-@task_postrun.connect
-def task_postrun_handler(**kwargs):
-    state = kwargs['state']
-    retval = kwargs['retval']
+def _send_final_update(task_id, state, retval):
     if state == 'SUCCESS':
         message = f'Success! {retval}'
     elif state == 'FAILURE':
         message = f'Failure: {retval}'
     else:
         message = f'{state}: {retval}'
-    _send_progress_update(kwargs['task_id'], state, 1, message)
+    _send_progress_update(task_id, state, 1, message)
+
+
+@task_postrun.connect
+def task_postrun_handler(**kwargs):
+    state = kwargs['state']
+    if state == 'IGNORED':
+        # the task was replaced (see Task.replace()), and the replacement
+        # keeps reporting progress under the same id
+        return
+    _send_final_update(kwargs['task_id'], state, kwargs['retval'])
 
 
 class ProgressTracker:
-    def __init__(self, task):
+    def __init__(self, task, task_id=None, request=None):
         self.task = task
+        # subtasks can report progress on behalf of the task that started them
+        self.task_id = task_id or task.request.id
+        # the request to store the progress under, for progress reported on
+        # behalf of something that isn't a task of its own (see
+        # process_batch_upload)
+        self.request = request
     
     def update_progress(self, progress, message=''):
-        self.task.update_state(
-            state='PROGRESS',
-            meta={
-                'progress': progress,
-                'message': message
-            }
-        )
-        _send_progress_update(self.task.request.id, 'PROGRESS', progress, message)
+        meta = {
+            'progress': progress,
+            'message': message
+        }
+        if self.request is None:
+            self.task.update_state(
+                task_id=self.task_id, state='PROGRESS', meta=meta
+            )
+        else:
+            self.task.backend.store_result(
+                self.task_id, meta, 'PROGRESS', request=self.request
+            )
+        _send_progress_update(self.task_id, 'PROGRESS', progress, message)
 
 
 # Tasks and task helper functions: ===================================
 
-def _open_pack_if_exists(dir_path):
-    simfile_pack = SimfilePack(dir_path)
+def _open_pack_if_exists(dir_path, filesystem):
+    simfile_pack = SimfilePack(dir_path, filesystem=filesystem)
     delete_dupe_sims(simfile_pack)
     # check if this directory is actually a pack directory by checking
     # if simfiles are present
@@ -77,21 +110,21 @@ def _open_pack_if_exists(dir_path):
     return simfile_pack
 
 
-def _find_packs(pack_names, extracted_path):
+def _find_packs(pack_names, extracted_path, filesystem=NATIVE_FS):
 
     found_packs = {}
     # get all candidate pack directories
-    for name in os.listdir(extracted_path):
+    for name in filesystem.listdir(extracted_path):
         subdir_path = os.path.join(extracted_path, name)
-        if os.path.isdir(subdir_path):
-            pack = _open_pack_if_exists(subdir_path)
+        if filesystem.isdir(subdir_path):
+            pack = _open_pack_if_exists(subdir_path, filesystem)
             if pack:
                 found_packs[name.lower()] = pack
 
     # if we haven't found a pack yet, we can try interpreting the
     # extraction destination directory as a pack (if only 1 pack is requested)
     if not found_packs and len(pack_names) == 1:
-        pack = _open_pack_if_exists(extracted_path)
+        pack = _open_pack_if_exists(extracted_path, filesystem)
         if pack:
             return [pack]
     
@@ -100,12 +133,12 @@ def _find_packs(pack_names, extracted_path):
     # if we haven't found a pack yet, and the root extract directory
     # contains a "Songs" subdirectory, try looking in there too
     songs_path = os.path.join(extracted_path, 'Songs')
-    if not found_packs and os.path.isdir(songs_path):
+    if not found_packs and filesystem.isdir(songs_path):
         # get all candidate pack directories (similar to before)
-        for name in os.listdir(songs_path):
+        for name in filesystem.listdir(songs_path):
             subdir_path = os.path.join(songs_path, name)
-            if os.path.isdir(subdir_path):
-                pack = _open_pack_if_exists(subdir_path)
+            if filesystem.isdir(subdir_path):
+                pack = _open_pack_if_exists(subdir_path, filesystem)
                 if pack:
                     found_packs[name.lower()] = pack
     
@@ -135,27 +168,70 @@ def _find_packs(pack_names, extracted_path):
     return packs_to_return
 
 
-def _extract_pack(file_path):
-    # TODO: likely susceptible to malicious zips (zip bombs, etc.)
+def _extract_pack(file_path, prog_tracker):
     try:
         filename = os.path.basename(file_path)
         extract_dir = filename.rsplit('.', 1)[0]
         extract_path = os.path.join(settings.MEDIA_ROOT, 'extracted', extract_dir)
-        patoolib.extract_archive(
-            file_path, verbosity=-1, outdir=extract_path, interactive=False
-        )
+        report = extract_pack_archive(file_path, extract_path)
     except Exception as e:
         # cleanup in case the extraction was partially complete before
         # being interrupted
         if os.path.exists(extract_path) and os.path.isdir(extract_path):
             shutil.rmtree(extract_path)
+        release_scratch_space(extract_path)
         raise e
     finally:
         os.remove(file_path)
+    logger.info(f'{filename}: {report}')
+    if report.skipped:
+        logger.info(
+            'Skipped: ' + ', '.join(m.name for m in report.skipped)
+        )
+    prog_tracker.update_progress(0, f'Extracted {filename} ({report})')
     return extract_path
 
 
-def _get_extracted_pack_from_link(source_link, prog_tracker):
+# the packs in an uploaded/downloaded file, which we either read straight from
+# the archive or extract first (see _open_pack_source). path is what to delete
+# once we're done (the archive or the extracted directory)
+PackSource = namedtuple('PackSource', ['filesystem', 'root_path', 'path'])
+
+
+def _open_pack_source(file_path, prog_tracker):
+    # archives whose members we can read on demand are read in place,
+    # anything else gets extracted
+    try:
+        archive = open_archive(file_path)
+    except Exception:
+        os.remove(file_path)
+        raise
+    if archive is not None:
+        return PackSource(archive, '/', file_path)
+    extract_path = _extract_pack(file_path, prog_tracker)
+    return PackSource(NATIVE_FS, extract_path, extract_path)
+
+
+def _reopen_pack_source(path):
+    # for tasks that receive the path of a pack source from another task
+    if os.path.isdir(path):
+        return PackSource(NATIVE_FS, path, path)
+    return PackSource(open_archive(path), '/', path)
+
+
+def _remove_pack_source(source):
+    if source.filesystem is not NATIVE_FS:
+        source.filesystem.close()
+    if os.path.isdir(source.path):
+        shutil.rmtree(source.path)
+        release_scratch_space(source.path)
+    else:
+        os.remove(source.path)
+
+
+def _download_pack(source_link, prog_tracker):
+    # returns the path of the downloaded file, or of a directory for links
+    # that don't need an extract step
     prog_tracker.update_progress(0, f'Downloading {source_link}')
     # special case for google drive folder: no extract step needed
     # TODO: maybe just put this logic in fetch_from_url (though it should then
@@ -165,12 +241,33 @@ def _get_extracted_pack_from_link(source_link, prog_tracker):
         dir_path = str(settings.MEDIA_ROOT / 'extracted')
         extract_path = os.path.join(dir_path, dir_name)
         gdown.download_folder(source_link, output=extract_path, quiet=True)
-    else:
-        file_path = fetch_from_url(source_link)
-        filename = os.path.basename(file_path)
-        prog_tracker.update_progress(0, f'Extracting {filename}')
-        extract_path = _extract_pack(file_path)
-    return extract_path
+        return extract_path
+    def report_progress(done, total):
+        total_str = f' / {total / 1e6:.1f}' if total else ''
+        prog_tracker.update_progress(
+            0, f'Downloading {source_link} ({done / 1e6:.1f}{total_str} MB)'
+        )
+
+    file_path, cached = fetch_from_url(source_link, report_progress)
+    filename = os.path.basename(file_path)
+    cache_result = 'download cache hit' if cached else 'download cache miss'
+    logger.info(f'{source_link}: {cache_result}')
+    prog_tracker.update_progress(
+        0, f'Downloaded {filename} ({cache_result})'
+    )
+    return file_path
+
+
+def _open_downloaded_pack(path, prog_tracker):
+    if os.path.isdir(path):
+        return PackSource(NATIVE_FS, path, path)
+    prog_tracker.update_progress(0, f'Extracting {os.path.basename(path)}')
+    return _open_pack_source(path, prog_tracker)
+
+
+def _get_pack_source_from_link(source_link, prog_tracker):
+    path = _download_pack(source_link, prog_tracker)
+    return _open_downloaded_pack(path, prog_tracker)
 
 
 @shared_task(bind=True)
@@ -182,24 +279,132 @@ def process_pack_upload(self, pack_data, filename, source_link):
     if filename:
         prog_tracker.update_progress(0, f'Extracting {filename}')
         file_path = default_storage.path(filename)
-        extract_path = _extract_pack(file_path)
+        source = _open_pack_source(file_path, prog_tracker)
     else:
         # use given source link
-        extract_path = _get_extracted_pack_from_link(source_link, prog_tracker)
+        source = _get_pack_source_from_link(source_link, prog_tracker)
 
+    distributed = False
     try:
-        packs = _find_packs([pack_data['name']], extract_path)
+        packs = _find_packs(
+            [pack_data['name']], source.root_path, source.filesystem
+        )
         assert len(packs) == 1
 
+        if settings.DISTRIBUTED_PACK_UPLOADS:
+            # hand the rest of the upload (including the cleanup) over to
+            # the chord, which takes over this task's id
+            distributed = True
+            return self.replace(_make_distributed_pack_upload(
+                self.request.id, packs[0], pack_data, source.path
+            ))
+
         # TODO: handle uploaded image/sim files better on rollback
         # https://github.com/un1t/django-cleanup/issues/43
-        with transaction.atomic():
+        with storing_files(), transaction.atomic():
             upload_pack(
                 packs[0], pack_data,
                 ProgressTrackingInfo(prog_tracker, 0, 1)
             )
     finally:
-        shutil.rmtree(extract_path)
+        if not distributed:
+            _remove_pack_source(source)
+
+
+# Distributed pack uploads: ==========================================
+# with settings.DISTRIBUTED_PACK_UPLOADS, process_pack_upload replaces itself
+# with a chord of analyze_pack_song tasks (one per song) so that the songs get
+# analyzed by all the workers at once. the pack archive (or the extracted pack)
+# stays where it is in MEDIA_ROOT, which has to be shared by all the workers (it
+# already has to be shared with the web server for uploaded pack files). the
+# chord's callback, finish_pack_upload, then writes everything to the db in one
+# transaction.
+
+def _make_distributed_pack_upload(
+    upload_task_id, simfile_pack, pack_data, source_path
+):
+    simfile_dir_paths = [d.simfile_dir for d in simfile_pack.simfile_dirs()]
+    total_count = len(simfile_dir_paths)
+    archive_path = source_path if os.path.isfile(source_path) else None
+    return chord(
+        (
+            analyze_pack_song.s(
+                path, upload_task_id, i, total_count, archive_path
+            )
+            for i, path in enumerate(simfile_dir_paths)
+        ),
+        finish_pack_upload.s(
+            pack_data, simfile_pack.pack_dir, simfile_dir_paths, source_path
+        ).on_error(cleanup_extracted_pack.si(source_path))
+    )
+
+
+def _count_finished_songs(task, index, total_count):
+    # the django-db result backend counts down the number of unfinished tasks
+    # in a chord (including the current one, until it returns)
+    remaining = ChordCounter.objects.filter(group_id=task.request.group) \
+        .values_list('count', flat=True).first()
+    if remaining is None:
+        # not in a chord (e.g. when running eagerly)
+        return index + 1
+    return total_count - remaining + 1
+
+
+@shared_task(bind=True)
+def analyze_pack_song(
+    self, simfile_dir_path, upload_task_id, index, total_count,
+    archive_path=None
+):
+    """Analyze one song of a pack being uploaded, reporting progress on the
+    upload task. Returns the results of analyze_song() as a dict, or None if
+    the song couldn't be analyzed."""
+    song_analysis = analyze_song(simfile_dir_path, archive_path)
+    # the analysis is the first half of the upload
+    done = _count_finished_songs(self, index, total_count)
+    ProgressTracker(self, upload_task_id).update_progress(
+        done / total_count / 2,
+        f'[{done}/{total_count}] Analyzed {os.path.basename(simfile_dir_path)}'
+    )
+    return song_analysis.to_dict() if song_analysis else None
+
+
+@shared_task(bind=True)
+def finish_pack_upload(
+    self, song_analyses, pack_data, pack_path, simfile_dir_paths, source_path
+):
+    """Upload a pack using the results of its analyze_pack_song tasks. Songs
+    that couldn't be analyzed are skipped rather than failing the upload."""
+    prog_tracker = ProgressTracker(self)
+    analyses = {}
+    skipped = []
+    for path, song_analysis in zip(simfile_dir_paths, song_analyses):
+        if song_analysis is None:
+            skipped.append(os.path.basename(path))
+        else:
+            analyses[path] = SongAnalysis.from_dict(song_analysis)
+
+    source = _reopen_pack_source(source_path)
+    try:
+        with storing_files(), transaction.atomic():
+            upload_pack(
+                SimfilePack(pack_path, filesystem=source.filesystem),
+                pack_data, ProgressTrackingInfo(prog_tracker, 1, 2),
+                song_analyses=analyses
+            )
+    finally:
+        _remove_pack_source(source)
+
+    if skipped:
+        return f'Skipped songs that could not be analyzed: {", ".join(skipped)}'
+
+
+@shared_task
+def cleanup_extracted_pack(source_path):
+    if os.path.isdir(source_path):
+        shutil.rmtree(source_path, ignore_errors=True)
+        release_scratch_space(source_path)
+    elif os.path.exists(source_path):
+        os.remove(source_path)
 
 
 class ProcessPatchResults:
@@ -228,60 +433,283 @@ def process_patch_upload(self, params):
     if filename:
         prog_tracker.update_progress(0, f'Extracting {filename}')
         file_path = default_storage.path(filename)
-        extract_path = _extract_pack(file_path)
+        source = _open_pack_source(file_path, prog_tracker)
     else:
         # use given source link
-        extract_path = _get_extracted_pack_from_link(source_link, prog_tracker)
+        source = _get_pack_source_from_link(source_link, prog_tracker)
 
     try:
-        packs = _find_packs([pack.name], extract_path)
+        packs = _find_packs([pack.name], source.root_path, source.filesystem)
         assert len(packs) == 1
 
         # TODO: handle uploaded image/sim files better on rollback
         # https://github.com/un1t/django-cleanup/issues/43
-        with transaction.atomic():
+        with storing_files(), transaction.atomic():
             patch_pack(
                 packs[0], pack, params,
                 ProgressTrackingInfo(prog_tracker, 0, 1)
             )
     finally:
-        shutil.rmtree(extract_path)
+        _remove_pack_source(source)
     
     return params['results'].make_message()
 
 
+def _upload_packs_from_source(pack_data_list, source, prog_tracker):
+    filesystem = source.filesystem
+    pack_names = [data['name'] for data in pack_data_list]
+    try:
+        packs = _find_packs(pack_names, source.root_path, filesystem)
+    except RuntimeError as e:
+        # sometimes, unar will create an additional directory within
+        # the extraction destination and extract all the files into there.
+        # check that directory first
+        # TODO: check if this is still necessary after switching to unrar
+        contents = filesystem.listdir(source.root_path)
+        if len(contents) == 1 and filesystem.isdir(
+            new_root_path := os.path.join(source.root_path, contents[0])
+        ):
+            packs = _find_packs(pack_names, new_root_path, filesystem)
+        else:
+            raise e
+
+    with storing_files(), transaction.atomic():
+        num_packs = len(pack_data_list)
+        for i, (pack, pack_data) in enumerate(zip(packs, pack_data_list)):
+            upload_pack(
+                pack, pack_data,
+                ProgressTrackingInfo(prog_tracker, i, num_packs)
+            )
+
+
 @shared_task(bind=True)
 def process_pack_from_web(self, pack_data_list, source_link):
     prog_tracker = ProgressTracker(self)
 
-    extract_path = _get_extracted_pack_from_link(source_link, prog_tracker)
+    source = _get_pack_source_from_link(source_link, prog_tracker)
+    try:
+        _upload_packs_from_source(pack_data_list, source, prog_tracker)
+    finally:
+        _remove_pack_source(source)
+
+
+# Pipelined batch uploads: ===========================================
+# with settings.PIPELINED_BATCH_UPLOADS, a batch upload runs as a single
+# process_batch_upload task, which downloads and extracts the next packs of
+# the batch while the current one is being uploaded (see utils/pipeline.py),
+# instead of as a group of process_pack_from_web tasks that each do one thing
+# at a time. each row of the batch still gets its own task id to report its
+# progress and result under, stored as if it came from process_pack_from_web,
+# so the batch's progress tracker looks the same either way.
+
+class _BatchRow:
+    def __init__(self, task, task_id, pack_data_list, source_link):
+        self.task_id = task_id
+        self.pack_data_list = pack_data_list
+        self.source_link = source_link
+        self.request = Context(
+            id=task_id,
+            task=process_pack_from_web.name,
+            args=[pack_data_list, source_link],
+            argsrepr=repr((pack_data_list, source_link)),
+            kwargs={},
+            kwargsrepr=repr({})
+        )
+        self.prog_tracker = ProgressTracker(task, task_id, self.request)
+        # the downloaded file (or directory), and then the pack source opened
+        # from it, until the row's packs have been uploaded
+        self.path = None
+        self.source = None
+
+
+def _download_batch_row(row):
+    row.path = _download_pack(row.source_link, row.prog_tracker)
+    return row
+
 
+def _extract_batch_row(row):
+    path, row.path = row.path, None
+    row.source = _open_downloaded_pack(path, row.prog_tracker)
+    return row
+
+
+def _upload_batch_row(row):
+    source, row.source = row.source, None
     try:
-        pack_names = [data['name'] for data in pack_data_list]
-        try:
-            packs = _find_packs(pack_names, extract_path)
-        except RuntimeError as e:
-            # sometimes, unar will create an additional directory within
-            # the extraction destination and extract all the files into there.
-            # check that directory first
-            # TODO: check if this is still necessary after switching to unrar
-            contents = os.listdir(extract_path)
-            if len(contents) == 1 and os.path.isdir(
-                new_extract_path := os.path.join(extract_path, contents[0])
-            ):
-                packs = _find_packs(pack_names, new_extract_path)
-            else:
-                raise e
-
-        with transaction.atomic():
-            num_packs = len(pack_data_list)
-            for i, (pack, pack_data) in enumerate(zip(packs, pack_data_list)):
-                upload_pack(
-                    pack, pack_data,
-                    ProgressTrackingInfo(prog_tracker, i, num_packs)
-                )
+        _upload_packs_from_source(row.pack_data_list, source, row.prog_tracker)
     finally:
-        shutil.rmtree(extract_path)
+        _remove_pack_source(source)
+    return row
+
+
+def _get_disk_usage(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(dir_path, name))
+        for dir_path, _, filenames in os.walk(path)
+        for name in filenames
+    )
+
+
+def _get_batch_row_disk_usage(row):
+    return _get_disk_usage(row.source.path if row.source else row.path)
+
+
+def _discard_batch_row(row):
+    if row.source:
+        _remove_pack_source(row.source)
+    elif row.path:
+        cleanup_extracted_pack(row.path)
+
+
+def _finish_batch_row(task, row, result):
+    if result.error is None:
+        state, retval = 'SUCCESS', None
+        task.backend.mark_as_done(row.task_id, retval, request=row.request)
+    else:
+        state, retval = 'FAILURE', result.error
+        logger.warning(
+            f'{row.source_link}: {result.stage} failed',
+            exc_info=result.error
+        )
+        task.backend.mark_as_failure(
+            row.task_id, retval,
+            traceback=''.join(traceback.format_exception(retval)),
+            request=row.request, call_errbacks=False
+        )
+    _send_final_update(row.task_id, state, retval)
+
+
+@shared_task(bind=True)
+def process_batch_upload(self, rows):
+    """Upload a batch of packs from the web, pipelining the downloads,
+    extractions and uploads. rows is a list of (task id, pack_data_list,
+    source_link), where the last two are the arguments process_pack_from_web
+    would take; each row reports its progress and result under its task id
+    (see start_batch_upload())."""
+    prog_tracker = ProgressTracker(self)
+    batch_rows = [_BatchRow(self, *row) for row in rows]
+    total = len(batch_rows)
+    finished = 0
+    failed = []
+
+    def on_result(row, result):
+        nonlocal finished
+        finished += 1
+        if result.error is not None:
+            failed.append(row.source_link)
+        _finish_batch_row(self, row, result)
+        prog_tracker.update_progress(
+            finished / total,
+            f'[{finished}/{total}] Finished {row.source_link}'
+        )
+
+    pipeline = Pipeline(
+        [
+            Stage(
+                'download', _download_batch_row,
+                settings.BATCH_UPLOAD_DOWNLOAD_THREADS
+            ),
+            Stage(
+                'extract', _extract_batch_row,
+                settings.BATCH_UPLOAD_EXTRACT_THREADS
+            ),
+            Stage('upload', _upload_batch_row),
+        ],
+        queue_size=settings.BATCH_UPLOAD_QUEUE_SIZE,
+        high_water_bytes=settings.BATCH_UPLOAD_HIGH_WATER_BYTES,
+        get_size=_get_batch_row_disk_usage,
+        discard=_discard_batch_row,
+        on_result=on_result
+    )
+    pipeline.run(batch_rows)
+
+    message = f'Uploaded {total - len(failed)} of {total} links'
+    if failed:
+        message += f' (failed: {", ".join(failed)})'
+    return message
+
+
+def start_batch_upload(signatures):
+    """Start a pipelined batch upload of the given process_pack_from_web
+    signatures (see PackAdmin.parse_batch_csv_into_tasks()). Returns a
+    GroupResult of the process_batch_upload task followed by the results of
+    each row, for the progress tracker; it still has to be saved."""
+    row_ids = [str(uuid.uuid4()) for _ in signatures]
+    result = process_batch_upload.delay([
+        (row_id, *sig.args) for row_id, sig in zip(row_ids, signatures)
+    ])
+    return GroupResult(
+        str(uuid.uuid4()),
+        [result] + [AsyncResult(row_id) for row_id in row_ids]
+    )
+
+
+def _update_song_analyses(
+    song, sim, to_update, need_chart_obj, analysis_cache, ret
+):
+    song_analyzer = SongAnalyzer(sim)
+
+    if 'chart_length' in to_update:
+        chart_len = song_analyzer.get_chart_len()
+        song.chart_length = chart_len
+        song.chart_length_version = ANALYZER_VERSIONS['chart_length']
+        song.save()
+
+    for chart in sim.charts:
+        if 'unusual_diff_check' in to_update:
+            diff = (chart.difficulty or '').lower().strip()
+            usual_diffs = Chart.DIFFICULTY_CHOICES.values()
+            if diff not in usual_diffs:
+                ret.append([
+                    song.id,
+                    song.pack.name if song.pack else '',
+                    song.title,
+                    diff
+                ])
+
+        if not need_chart_obj:
+            continue
+
+        try:
+            description = (chart.description or '').strip()
+            meter = Chart.meter_str_to_int(chart.meter)
+            chart_obj = song.chart_set.get(
+                steps_type=Chart.steps_type_to_int(
+                    chart.stepstype
+                ),
+                difficulty=Chart.difficulty_str_to_int(
+                    chart.difficulty or '', description, meter
+                ),
+                description=description
+            )
+        except Chart.DoesNotExist:
+            continue
+
+        chart_analyzer = song_analyzer.get_chart_analyzer(chart)
+        if {'stream_info', 'counts'} <= to_update:
+            chart_analysis = analysis_cache.analyze(chart_analyzer)
+        else:
+            # analyzing for the cache computes every component, so on a miss
+            # only compute the one we're updating
+            chart_analysis = analysis_cache.get(chart_analyzer)
+
+        if 'stream_info' in to_update:
+            stream_info = chart_analysis.stream_info if chart_analysis \
+                else chart_analyzer.get_stream_info()
+            chart_obj.analysis['stream_info'] = stream_info
+            chart_obj.stream_info_version = ANALYZER_VERSIONS['stream_info']
+            update_breakdowns(chart_obj)
+        
+        if 'counts' in to_update:
+            counts = chart_analysis.counts if chart_analysis \
+                else chart_analyzer.get_counts()
+            for k, v in counts.items():
+                setattr(chart_obj, k + '_count', v)
+            chart_obj.counts_version = ANALYZER_VERSIONS['counts']
+        
+        chart_obj.save()
 
 
 # this task is pretty messy...
@@ -301,79 +729,68 @@ def update_analyses(self, form_data):
     
     # figure out whether we need to access Chart model instances
     need_chart_obj = bool({'stream_info', 'counts'} & to_update)
+    # charts that haven't changed since the last time the analysis code
+    # changed (i.e. ANALYZER_VERSIONS was bumped) can use cached results
+    analysis_cache = AnalysisCache()
 
     for i, song in enumerate(Song.objects.all()):
         prog_tracker.update_progress(
             i / song_count, f'[{i + 1}/{song_count}] Updating {str(song)}'
         )
 
-        file = song.simfile
-        ext = file.name.rsplit('.', 1)[1]
-        tmp_path = os.path.join(settings.MEDIA_ROOT, f'{uuid.uuid4()}.{ext}')
         try:
-            # copy simfile contents to a temp file on disk so that we can
-            # use simfile.open() with its encoding autodetection
-            with file.open(mode='rb') as f, open(tmp_path, 'wb') as tmp:
-                shutil.copyfileobj(f, tmp)
-
-            sim = simfile.open(tmp_path, strict=False)
-            song_analyzer = SongAnalyzer(sim)
-
-            if 'chart_length' in to_update:
-                chart_len = song_analyzer.get_chart_len()
-                song.chart_length = chart_len
-                song.save()
-
-            for chart in sim.charts:
-                if 'unusual_diff_check' in to_update:
-                    diff = (chart.difficulty or '').lower().strip()
-                    usual_diffs = Chart.DIFFICULTY_CHOICES.values()
-                    if diff not in usual_diffs:
-                        ret.append([
-                            song.id,
-                            song.pack.name if song.pack else '',
-                            song.title,
-                            diff
-                        ])
-
-                if not need_chart_obj:
-                    continue
-
-                try:
-                    description = (chart.description or '').strip()
-                    meter = Chart.meter_str_to_int(chart.meter)
-                    chart_obj = song.chart_set.get(
-                        steps_type=Chart.steps_type_to_int(
-                            chart.stepstype
-                        ),
-                        difficulty=Chart.difficulty_str_to_int(
-                            chart.difficulty or '', description, meter
-                        ),
-                        description=description
-                    )
-                except Chart.DoesNotExist:
-                    continue
-
-                chart_analyzer = \
-                    song_analyzer.get_chart_analyzer(chart)
-
-                if 'stream_info' in to_update:
-                    stream_info = chart_analyzer.get_stream_info()
-                    chart_obj.analysis['stream_info'] = stream_info
-                
-                if 'counts' in to_update:
-                    counts = chart_analyzer.get_counts()
-                    for k, v in counts.items():
-                        setattr(chart_obj, k + '_count', v)
-                
-                chart_obj.save()
-                        
+            with open_stored_simfile(song) as sim:
+                _update_song_analyses(
+                    song, sim, to_update, need_chart_obj, analysis_cache, ret
+                )
         except FileNotFoundError:
             continue
-        finally:
-            # cleanup temp file
-            if os.path.isfile(tmp_path):
-                os.remove(tmp_path)
-    
+
+    logger.info(f'Finished updating analyses ({analysis_cache})')
     return ret
-            
\ No newline at end of file
+
+
+@shared_task(bind=True)
+def reanalyze_outdated_analyses(self, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Recompute only the analysis components that were computed by an older
+    version of the analyzer. If interrupted, this can just be run again, and
+    it will pick up from the first chunk of songs that wasn't finished."""
+    prog_tracker = ProgressTracker(self)
+    analysis_cache = AnalysisCache()
+
+    def progress_callback(done, total, song):
+        prog_tracker.update_progress(
+            done / total, f'[{done + 1}/{total}] Re-analyzing {str(song)}'
+        )
+
+    count = reanalyze_outdated(chunk_size, analysis_cache, progress_callback)
+    logger.info(f'Finished re-analyzing {count} songs ({analysis_cache})')
+    return f'Re-analyzed {count} songs ({analysis_cache})'
+
+
+@shared_task(bind=True)
+def rehash_charts(self, song_ids):
+    """Recompute the hashes of the given songs' charts from their stored
+    simfiles."""
+    prog_tracker = ProgressTracker(self)
+    song_count = len(song_ids)
+    changed = 0
+    songs = Song.objects.filter(id__in=song_ids).order_by('id')
+    for i, song in enumerate(songs):
+        prog_tracker.update_progress(
+            i / song_count, f'[{i + 1}/{song_count}] Rehashing {str(song)}'
+        )
+        changed += rehash_song(song) or 0
+    logger.info(f'Finished rehashing {song_count} songs ({changed} changed)')
+    return f'{changed} chart hash(es) changed'
+
+
+def make_rehash_charts_group(songs_per_task=DEFAULT_CHUNK_SIZE):
+    """Make a group of rehash_charts tasks that covers every song in the
+    database, songs_per_task songs per task, so that the rehashing can be
+    spread out over all the workers."""
+    song_ids = list(Song.objects.order_by('id').values_list('id', flat=True))
+    return group(
+        rehash_charts.s(song_ids[i:i + songs_per_task])
+        for i in range(0, len(song_ids), songs_per_task)
+    )
@@ -0,0 +1,182 @@
+import logging
+from io import StringIO
+from unittest.mock import patch
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from django.core.files.storage.memory import InMemoryStorage
+from django.core.management import call_command
+from django.db import connections
+from django.test import TestCase
+from django.urls import reverse
+from storages.backends.s3 import S3Storage
+
+from ..models import Pack, Song, ImageFile, PendingFileDeletion
+from ..storage_backends import CONTENT_NAME_PATTERN
+from ..utils.stored_files import delete_unused_files, _STORING_FILES_LOCK
+from ..utils.uploads import upload_pack
+from ._common import open_test_pack
+
+
+class ContentAddressedStorageTestClass(TestCase):
+
+    def setUp(self):
+        # essentially replace s3 with mock/temporary storage during tests
+        self.in_mem_storage = InMemoryStorage()
+        self.mocks = {}
+        for name in ('_save', '_open', 'exists', 'delete'):
+            patcher = patch.object(
+                S3Storage, name,
+                wraps=getattr(self.in_mem_storage, name)
+            )
+            self.mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # disable info logs for processing songs
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        # restore previous log level
+        logging.disable(logging.NOTSET)
+
+    def _upload(self):
+        upload_pack(open_test_pack('PatchPack_base'), {
+            'name': '',
+            'author': '',
+            'release_date': None,
+            'release_date_year_only': False,
+            'category': None,
+            'tags': [],
+            'links': ''
+        })
+
+    def _get_names(self):
+        return (
+            set(Song.objects.values_list('simfile', flat=True)),
+            set(ImageFile.objects.values_list('image', flat=True))
+        )
+
+    def test_save(self):
+        # identical files are stored once, under the hash of their contents
+        storage = storages['simfiles']
+        name1 = storage.save('abc_test.SM', ContentFile(b'#TITLE:a;'))
+        name2 = storage.save('def_other.sm', ContentFile(b'#TITLE:a;'))
+        name3 = storage.save('def_other.sm', ContentFile(b'#TITLE:b;'))
+        self.assertEqual(name1, name2)
+        self.assertNotEqual(name1, name3)
+        self.assertRegex(name1, CONTENT_NAME_PATTERN)
+        self.assertTrue(name1.endswith('.sm'))
+        self.assertEqual(2, self.mocks['_save'].call_count)
+
+    def test_reupload(self):
+        # uploading a pack again reuses the stored files
+        self._upload()
+        sim_names, image_names = self._get_names()
+        save_count = self.mocks['_save'].call_count
+        self._upload()
+        self.assertEqual(save_count, self.mocks['_save'].call_count)
+        self.assertEqual((sim_names, image_names), self._get_names())
+        self.assertEqual(4, Song.objects.count())
+
+    def test_delete(self):
+        # files are only deleted once no row refers to them anymore
+        self._upload()
+        self._upload()
+        sim_names, image_names = self._get_names()
+        packs = list(Pack.objects.order_by('id'))
+        with self.captureOnCommitCallbacks(execute=True):
+            packs[0].delete()
+        self.mocks['delete'].assert_not_called()
+        with self.captureOnCommitCallbacks(execute=True):
+            packs[1].delete()
+        deleted = {c.args[0] for c in self.mocks['delete'].call_args_list}
+        self.assertTrue(sim_names <= deleted)
+        self.assertTrue(image_names <= deleted)
+
+    def _hold_storing_files_lock(self):
+        # as if an upload was in progress in another session
+        other_connection = connections.create_connection('default')
+        self.addCleanup(other_connection.close)
+        with other_connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_lock_shared(%s)', [_STORING_FILES_LOCK]
+            )
+        return other_connection
+
+    def test_delete_while_storing(self):
+        # files aren't deleted while something's storing files, only once
+        # it's done
+        self._upload()
+        sim_names, image_names = self._get_names()
+        other_connection = self._hold_storing_files_lock()
+        with self.captureOnCommitCallbacks(execute=True):
+            Pack.objects.get().delete()
+        self.mocks['delete'].assert_not_called()
+        self.assertEqual(
+            len(sim_names) + len(image_names),
+            PendingFileDeletion.objects.count()
+        )
+
+        other_connection.close()
+        delete_unused_files()
+        deleted = {c.args[0] for c in self.mocks['delete'].call_args_list}
+        self.assertTrue(sim_names <= deleted)
+        self.assertTrue(image_names <= deleted)
+        self.assertFalse(PendingFileDeletion.objects.exists())
+
+    def test_reused_while_pending_deletion(self):
+        # files that get reused before their deletion comes around are kept
+        self._upload()
+        other_connection = self._hold_storing_files_lock()
+        with self.captureOnCommitCallbacks(execute=True):
+            Pack.objects.get().delete()
+        self._upload()
+        sim_names, image_names = self._get_names()
+
+        other_connection.close()
+        delete_unused_files()
+        deleted = {c.args[0] for c in self.mocks['delete'].call_args_list}
+        self.assertFalse(deleted & (sim_names | image_names))
+        for name in sim_names | image_names:
+            self.assertTrue(self.in_mem_storage.exists(name))
+        self.assertFalse(PendingFileDeletion.objects.exists())
+
+    def test_original_names(self):
+        # files are still shown and downloaded under their original names
+        self._upload()
+        song = Song.objects.order_by('id').first()
+        self.assertRegex(song.simfile.name, CONTENT_NAME_PATTERN)
+        self.assertTrue(song.simfile_name.endswith(('.sm', '.ssc')))
+        response = self.client.get(
+            reverse('itgdb_site:song_simfile', args=[song.id])
+        )
+        self.assertIn(
+            f'filename="{song.simfile_name}"',
+            response['Content-Disposition']
+        )
+        content = b''.join(response.streaming_content)
+        with song.simfile.open('rb') as f:
+            self.assertEqual(f.read(), content)
+
+        img_file = ImageFile.objects.order_by('id').first()
+        self.assertEqual(
+            f'{img_file.id}: {img_file.original_name}', str(img_file)
+        )
+        self.assertNotRegex(img_file.original_name, CONTENT_NAME_PATTERN)
+
+    def test_dedupe_storage(self):
+        # files stored under their old {uuid}_{name} names get moved to
+        # their content-addressed names
+        self._upload()
+        self._upload()
+        sim_names, image_names = self._get_names()
+        for i, song in enumerate(Song.objects.order_by('id')):
+            old_name = f'{i}_{song.simfile.name}'
+            with song.simfile.open('rb') as f:
+                self.in_mem_storage.save(old_name, f)
+            Song.objects.filter(id=song.id).update(simfile=old_name)
+
+        call_command('dedupe_storage', stdout=StringIO())
+        self.assertEqual((sim_names, image_names), self._get_names())
+        deleted = {c.args[0] for c in self.mocks['delete'].call_args_list}
+        self.assertEqual(4, len(deleted))
+        self.assertFalse(deleted & sim_names)
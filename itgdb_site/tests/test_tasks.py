@@ -1,15 +1,27 @@
 import os
 import logging
+import shutil
+import tempfile
 from datetime import datetime, timezone
 from unittest.mock import patch
 from django.conf import settings
-from django.test import TestCase
+from django.core.files.storage.memory import InMemoryStorage
+from django.test import TestCase, override_settings
 from django.test.testcases import SerializeMixin
+from django_celery_results.models import TaskResult
+from storages.backends.s3 import S3Storage
 
-from ..tasks import process_pack_from_web
+from ..admin import _get_task_args_display
+from ..models import Pack
+from ..tasks import (
+    process_batch_upload, process_pack_from_web, process_pack_upload
+)
+from ..utils.archive_fs import ZipArchiveFS
 from ._common import TEST_BASE_DIR
 
 
+# keep the download cache out of MEDIA_ROOT (see test_utils_url_fetch.py)
+@override_settings(DOWNLOAD_CACHE_MAX_BYTES=0)
 @patch('itgdb_site.tasks.ProgressTracker')
 @patch('itgdb_site.tasks.upload_pack')
 class ProcessPackFromWebTestClass(SerializeMixin, TestCase):
@@ -104,13 +116,11 @@ class ProcessPackFromWebTestClass(SerializeMixin, TestCase):
             [{'name': 'asdf'}],
             [None] # extracted dir name is random, don't bother checking
         )
-        # instead, just check where the dir is located
+        # instead, just check that the pack is the root of the archive,
+        # which is read in place
         sim_pack = mock_upload_pack.call_args.args[0]
-        path = sim_pack.pack_dir
-        self.assertEqual(
-            str(settings.MEDIA_ROOT / 'extracted'),
-            os.path.dirname(path)
-        )
+        self.assertEqual('/', sim_pack.pack_dir)
+        self.assertIsInstance(sim_pack.filesystem, ZipArchiveFS)
     
     def test_pack_in_songs_dir(self, mock_upload_pack, mock_prog):
         self._do_test(
@@ -175,6 +185,30 @@ class ProcessPackFromWebTestClass(SerializeMixin, TestCase):
             ['pack1']
         )
     
+    def test_tar_gz_format(self, mock_upload_pack, mock_prog):
+        # compressed tars can't be read in place, so they get extracted
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            contents_path = os.path.join(tmp_dir, 'contents')
+            shutil.unpack_archive(
+                os.path.join(
+                    TEST_BASE_DIR, 'pack_archives',
+                    'ProcessPackFromWeb_1_pack.zip'
+                ),
+                contents_path
+            )
+            archive_path = shutil.make_archive(
+                os.path.join(tmp_dir, 'pack'), 'gztar', contents_path
+            )
+            pack_data_list = self._fill_pack_data_list([{'name': 'pack1'}])
+            task = process_pack_from_web.s(
+                pack_data_list, 'file://' + archive_path
+            ).apply()
+        self.assertEqual('SUCCESS', task.status)
+        self._assert_upload_pack_calls(
+            mock_upload_pack, [('pack1', pack_data_list[0])]
+        )
+        self._assert_cleaned_up()
+
     def test_pack_with_dupe_sims(self, mock_upload_pack, mock_prog):
         # test that a pack with duplicate simfiles can be handled
         # without crashing
@@ -182,4 +216,88 @@ class ProcessPackFromWebTestClass(SerializeMixin, TestCase):
             mock_upload_pack, 'pack_with_dupe_sims.zip',
             [{'name': 'dupes'}],
             [None] # extracted dir name is random, don't bother checking
-        )
\ No newline at end of file
+        )
+
+    def test_batch_upload(self, mock_upload_pack, mock_prog):
+        rows = [
+            ('1_pack.zip', [{'name': 'pack1'}]),
+            ('asdfasdfasdf', [{'name': 'pack1'}]),
+            ('not_an_archive.txt', [{'name': 'pack1'}]),
+            ('2_packs.zip', [{'name': 'pack2'}, {'name': 'pack1'}]),
+        ]
+        rows = [
+            (f'row{i}', self._fill_pack_data_list(pack_data_list),
+             self._get_archive_url(file_suffix))
+            for i, (file_suffix, pack_data_list) in enumerate(rows)
+        ]
+        task = process_batch_upload.s(rows).apply()
+        self.assertEqual('SUCCESS', task.status)
+        self.assertIn('Uploaded 2 of 4', task.result)
+        # the rows get uploaded in whatever order they're ready in
+        self.assertEqual(
+            ['pack1', 'pack1', 'pack2'],
+            sorted(c.args[0].name for c in mock_upload_pack.call_args_list)
+        )
+        self._assert_cleaned_up()
+
+        # each row's result is stored like a process_pack_from_web task's
+        results = {
+            res.task_id: res for res in TaskResult.objects.filter(
+                task_id__in=[row[0] for row in rows]
+            )
+        }
+        self.assertEqual(
+            ['SUCCESS', 'FAILURE', 'FAILURE', 'SUCCESS'],
+            [results[row[0]].status for row in rows]
+        )
+        self.assertEqual(
+            (['pack1'], rows[0][2]), _get_task_args_display(results['row0'])
+        )
+
+
+in_mem_storage = InMemoryStorage()
+
+@override_settings(DISTRIBUTED_PACK_UPLOADS=True, DOWNLOAD_CACHE_MAX_BYTES=0)
+@patch.object(S3Storage, '_save', in_mem_storage._save)
+@patch.object(S3Storage, '_open', in_mem_storage._open)
+@patch.object(S3Storage, 'exists', in_mem_storage.exists)
+@patch('itgdb_site.tasks.ProgressTracker')
+class DistributedPackUploadTestClass(SerializeMixin, TestCase):
+    lockfile = __file__
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _do_test(self):
+        archive_url = 'file://' + os.path.join(
+            TEST_BASE_DIR, 'pack_archives', 'ProcessPackFromWeb_1_pack.zip'
+        )
+        pack_data = {
+            'name': 'pack1',
+            'author': '',
+            'release_date': None,
+            'release_date_year_only': False,
+            'category': None,
+            'tags': [],
+            'links': ''
+        }
+        task = process_pack_upload.s(pack_data, None, archive_url).apply()
+        self.assertEqual('SUCCESS', task.status)
+        self.assertFalse(os.listdir(settings.MEDIA_ROOT / 'extracted'))
+        return task
+
+    def test_upload(self, mock_prog):
+        self._do_test()
+        pack = Pack.objects.get()
+        self.assertEqual(['p1_song1'], [s.title for s in pack.song_set.all()])
+        self.assertTrue(pack.song_set.get().chart_set.exists())
+
+    @patch('itgdb_site.tasks.analyze_song', return_value=None)
+    def test_song_analysis_fails(self, mock_analyze_song, mock_prog):
+        # the song gets skipped instead of failing the whole upload
+        task = self._do_test()
+        self.assertFalse(Pack.objects.get().song_set.exists())
+        self.assertIn('p1_song1', task.result)
@@ -1,13 +1,46 @@
-from django.test import SimpleTestCase
+from decimal import Decimal
+from dataclasses import asdict
+import io
+import json
+import os
+import tempfile
+from unittest.mock import patch
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+import numpy as np
+import simfile
+from simfile.notes import NoteData
+from simfile.timing import Beat
 
-from ..utils.analysis import SongAnalyzer
-from ._common import open_test_chart
+from ..management.commands.benchmark_analysis import MODES
+from ..models import AnalysisCacheEntry
+from ..utils.analysis import SongAnalyzer, AnalysisCache
+from ..utils.analysis.analyzer import BACKENDS
+from ..utils.analysis.timing import BatchTimingEngine
+from ..utils.analysis.intervals import Interval, IntervalSet
+from ..utils.analysis.measures import MeasureCounts
+from ..utils.analysis.tokenizer import NoteTokens
+from ..utils.analysis.breakdown import (
+    generate_breakdown, generate_breakdowns, MAX_BREAKDOWN_SEGMENTS
+)
+from ..utils.analysis.synthetic import SCENARIOS, generate_simfile
+from ..utils.analysis.streaming import (
+    iter_measure_chunks, BYTES_PER_NOTE_DATA_CHAR
+)
+from ._common import TEST_BASE_DIR, open_test_chart
 
 class GetCountsTestClass(SimpleTestCase):
+    backend = 'numpy'
+    fused = False
+
     def _do_test(self, test_name, expected):
         sim, chart = open_test_chart(f'GetCounts_{test_name}.ssc')
-        chart_analyzer = SongAnalyzer(sim).get_chart_analyzer(chart)
-        actual = chart_analyzer.get_counts()
+        chart_analyzer = SongAnalyzer(sim, self.backend) \
+            .get_chart_analyzer(chart)
+        if self.fused:
+            actual = chart_analyzer.analyze().counts
+        else:
+            actual = chart_analyzer.get_counts()
         self.assertEqual(expected, actual)
 
     def test_counts(self):
@@ -95,11 +128,29 @@ class GetCountsTestClass(SimpleTestCase):
         )
 
 
+class GetCountsSimfileBackendTestClass(GetCountsTestClass):
+    # the reference implementation should give the same results
+    backend = 'simfile'
+
+
+class GetCountsFusedTestClass(GetCountsTestClass):
+    # the single-pass analysis should also give the same results
+    backend = 'simfile'
+    fused = True
+
+
 class GetStreamInfoTestClass(SimpleTestCase):
+    backend = 'numpy'
+    fused = False
+
     def _do_test(self, test_name, expected):
         sim, chart = open_test_chart(f'GetStreamInfo_{test_name}.sm')
-        chart_analyzer = SongAnalyzer(sim).get_chart_analyzer(chart)
-        actual = chart_analyzer.get_stream_info()
+        chart_analyzer = SongAnalyzer(sim, self.backend) \
+            .get_chart_analyzer(chart)
+        if self.fused:
+            actual = chart_analyzer.analyze().stream_info
+        else:
+            actual = chart_analyzer.get_stream_info()
         for k in ('segments', 'quant', 'total_stream', 'total_break'):
             self.assertEqual(expected[k], actual[k])
         if expected['bpms'] == [None, None]:
@@ -178,4 +229,463 @@ class GetStreamInfoTestClass(SimpleTestCase):
                 'total_stream': 4,
                 'total_break': 2
             }
-        )
\ No newline at end of file
+        )
+
+
+class GetStreamInfoSimfileBackendTestClass(GetStreamInfoTestClass):
+    backend = 'simfile'
+
+
+class GetStreamInfoFusedTestClass(GetStreamInfoTestClass):
+    backend = 'simfile'
+    fused = True
+
+
+class GenerateBreakdownsTestClass(SimpleTestCase):
+
+    def _stream_info(self, segments, quant=16, bpms=(150, 150)):
+        return {
+            'quant': quant,
+            'bpms': list(bpms),
+            'segments': segments,
+            'total_stream': sum(s for s in segments if s > 0),
+            'total_break': -sum(s for s in segments if s < 0),
+        }
+
+    def test_full(self):
+        stream_info = self._stream_info([16, -1, 8, -8, 32])
+        breakdowns = generate_breakdowns(stream_info)
+        self.assertEqual('16 (1) 8 (8) 32', breakdowns['full'])
+        self.assertEqual(
+            ["16'8/32", "16'8/32", '25*/32'], breakdowns['simplified']
+        )
+        self.assertEqual('16 (1) 8 (8) 32', breakdowns['display'])
+
+    def test_too_long(self):
+        # too many segments for the full breakdown and the first level
+        stream_info = self._stream_info([4, -1] * MAX_BREAKDOWN_SEGMENTS + [4])
+        breakdowns = generate_breakdowns(stream_info)
+        self.assertIsNone(breakdowns['full'])
+        self.assertIsNone(breakdowns['simplified'][0])
+        self.assertEqual(breakdowns['simplified'][2], breakdowns['display'])
+
+    def test_no_streams(self):
+        breakdowns = generate_breakdowns(self._stream_info([]))
+        self.assertEqual('No streams', breakdowns['display'])
+        self.assertIsNone(breakdowns['full'])
+
+    def test_matches_generate_breakdown(self):
+        stream_infos = [
+            self._stream_info([16, -1, 8]),
+            self._stream_info([8, -2, 8], quant=24, bpms=(120, 120)),
+            self._stream_info([8, -2, 8], quant=20, bpms=(120, 130)),
+            self._stream_info([1, 1] * 40),
+            self._stream_info([1, -64] * 30),
+        ]
+        for stream_info in stream_infos:
+            self.assertEqual(
+                generate_breakdown(stream_info),
+                generate_breakdowns(stream_info)['display']
+            )
+
+
+class GetDensityGraphTestClass(SimpleTestCase):
+    backend = 'numpy'
+
+    def _do_test(self, test_name, expected):
+        sim, chart = open_test_chart(f'GetDensityGraph_{test_name}.sm')
+        chart_analyzer = SongAnalyzer(sim, self.backend) \
+            .get_chart_analyzer(chart)
+        actual = chart_analyzer.get_density_graph()
+        self.assertEqual(len(expected), len(actual))
+        for expected_point, actual_point in zip(expected, actual):
+            for i in range(2):
+                self.assertAlmostEqual(expected_point[i], actual_point[i])
+
+    def test_stray_note(self):
+        # 1 measure of quarter notes, then 999 empty measures, then a single
+        # note. the empty measures should collapse into 2 points
+        self._do_test(
+            'test_stray_note',
+            [[0, 2], [2, 0], [1998, 0], [2000, 0.5], [2002, 0]]
+        )
+
+
+class GetDensityGraphSimfileBackendTestClass(GetDensityGraphTestClass):
+    backend = 'simfile'
+
+
+class MeasureCountsTestClass(SimpleTestCase):
+    def test_runs(self):
+        counts = MeasureCounts([2, 3, 7], [16, 4, 1])
+        self.assertEqual(8, len(counts))
+        self.assertEqual([0, 0, 16, 4, 0, 0, 0, 1], counts.to_list())
+        self.assertEqual(
+            [(0, 2, 0), (2, 3, 16), (3, 4, 4), (4, 7, 0), (7, 8, 1)],
+            list(counts.runs())
+        )
+
+    def test_empty(self):
+        counts = MeasureCounts([], [])
+        self.assertEqual(1, len(counts))
+        self.assertEqual([(0, 1, 0)], list(counts.runs()))
+
+
+class BatchTimingEngineTestClass(SimpleTestCase):
+    def _do_test(self, sim_name):
+        sim, chart = open_test_chart(sim_name)
+        engine = SongAnalyzer(sim).get_chart_analyzer(chart).engine
+        batch_engine = BatchTimingEngine(engine)
+        # include negative beats, beats that don't land on a tick, and beats
+        # landing exactly on bpm changes/warps
+        beats = [Beat(i, 4) for i in range(-8, 160)] + [Beat(1, 7), Beat(50, 3)]
+        expected = [engine.time_at(beat) for beat in beats]
+        actual = batch_engine.times_at(beats).tolist()
+        # results should be exactly equal, not just approximately
+        self.assertEqual(expected, actual)
+
+    def test_varying_bpm(self):
+        self._do_test('GetStreamInfo_test_varying_bpm.sm')
+
+    def test_warps(self):
+        self._do_test('GetCounts_test_unhittable_notes.ssc')
+
+
+class IntervalSetTestClass(SimpleTestCase):
+    def test_merge(self):
+        intervals = IntervalSet([
+            Interval(Beat(8), Beat(10)),
+            Interval(Beat(0), Beat(2)),
+            Interval(Beat(1), Beat(3)),     # overlapping
+            Interval(Beat(3), Beat(4)),     # touching
+            Interval(Beat(4), Beat(5), start_closed=False), # 1 point gap
+            Interval(Beat(9), Beat(9)),     # empty
+            Interval(Beat(9), Beat(6)),     # negative length
+        ])
+        self.assertEqual(
+            [
+                Interval(Beat(0), Beat(4)),
+                Interval(Beat(4), Beat(5), False),
+                Interval(Beat(8), Beat(10)),
+            ],
+            intervals.intervals
+        )
+
+    def test_contains(self):
+        intervals = IntervalSet([
+            Interval(Beat(1, 3), Beat(2, 3)),
+            Interval(Beat(1), Beat(3, 2), start_closed=False),
+        ])
+        beats = [
+            Beat(0), Beat(1, 3), Beat(1, 2), Beat(2, 3), Beat(1),
+            Beat(1) + Beat(1, 10**12), Beat(3, 2), Beat(2)
+        ]
+        expected = [False, True, True, False, False, True, False, False]
+        self.assertEqual(expected, [beat in intervals for beat in beats])
+        self.assertEqual(expected, intervals.contains(beats).tolist())
+
+    def test_contains_ticks(self):
+        intervals = IntervalSet([
+            Interval(Beat(1, 3), Beat(2, 3)),
+            Interval(Beat(1), Beat(3, 2), start_closed=False),
+            Interval(Beat(5, 3), Beat(5, 3) + Beat(1, 1000)),
+        ])
+        # 12 ticks per beat
+        ticks = np.array([0, 3, 4, 7, 8, 11, 12, 13, 17, 18, 20, 21])
+        expected = [
+            False, False, True, True, False, False, False, True, True,
+            False, True, False
+        ]
+        self.assertEqual(expected, intervals.contains_ticks(ticks, 12).tolist())
+
+
+class SongAnalyzerTestClass(SimpleTestCase):
+    def _make_sim(self, chart_timing=''):
+        charts = ''.join(
+            f'#NOTEDATA:;#STEPSTYPE:dance-single;#DIFFICULTY:Edit;'
+            f'#METER:{i + 1};#DESCRIPTION:{i};{chart_timing if i == 0 else ""}'
+            f'#NOTES:\n1000\n0000\n0000\n0000\n;\n'
+            for i in range(8)
+        )
+        return simfile.loads(
+            '#VERSION:0.83;#OFFSET:0;#BPMS:0=120,8=0,12=150;'
+            '#DISPLAYBPM:100:200;' + charts
+        )
+
+    def test_shared_timing(self):
+        song_analyzer = SongAnalyzer(self._make_sim())
+        for chart in song_analyzer.sim.charts:
+            song_analyzer.get_chart_analyzer(chart).analyze()
+        self.assertEqual(8, len(song_analyzer.chart_analyzers))
+        self.assertEqual(1, len(song_analyzer.timings))
+
+    def test_split_timing(self):
+        song_analyzer = SongAnalyzer(self._make_sim('#BPMS:0=180;'))
+        for chart in song_analyzer.sim.charts:
+            song_analyzer.get_chart_analyzer(chart).analyze()
+        self.assertEqual(2, len(song_analyzer.timings))
+
+    def test_bpm_ranges(self):
+        sim = self._make_sim()
+        song_analyzer = SongAnalyzer(sim)
+        bpm_range, disp_range = song_analyzer.get_bpm_ranges()
+        # 0 bpm segments are ignored
+        self.assertEqual((Decimal(120), Decimal(150)), bpm_range)
+        self.assertEqual((Decimal(100), Decimal(200)), disp_range)
+        # the simfile itself shouldn't be modified
+        self.assertEqual('0=120,8=0,12=150', sim.bpms)
+
+
+class AnalysisCacheTestClass(TestCase):
+    def _get_analyzer(
+        self, notes='1000', offset='0', title='Song', extra_fields=''
+    ):
+        sim = simfile.loads(
+            f'#VERSION:0.83;#TITLE:{title};#OFFSET:{offset};#BPMS:0=120;'
+            f'{extra_fields}'
+            '#NOTEDATA:;#STEPSTYPE:dance-single;#DIFFICULTY:Hard;#METER:9;'
+            f'#NOTES:\n{notes}\n0000\n1111\n0000\n;\n'
+        )
+        return SongAnalyzer(sim).get_chart_analyzer(sim.charts[0])
+
+    def _analyze(self, cache, analyzer):
+        # cache writes happen once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            return cache.analyze(analyzer)
+
+    def test_hit(self):
+        cache = AnalysisCache()
+        expected = self._analyze(cache, self._get_analyzer(title='A'))
+        # same chart in a different song
+        actual = self._analyze(cache, self._get_analyzer(title='B'))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        # results go through json, so compare them the same way
+        self.assertEqual(
+            json.dumps(asdict(expected), sort_keys=True),
+            json.dumps(asdict(actual), sort_keys=True)
+        )
+
+    def test_miss(self):
+        cache = AnalysisCache()
+        self._analyze(cache, self._get_analyzer())
+        self._analyze(cache, self._get_analyzer(notes='0100'))
+        self._analyze(cache, self._get_analyzer(offset='-0.1'))
+        self.assertEqual((0, 3), (cache.hits, cache.misses))
+
+    def test_chart_length(self):
+        # the density graph ends at the song's chart length, which can be
+        # longer than the chart itself
+        cache = AnalysisCache()
+        short = self._analyze(cache, self._get_analyzer())
+        long = self._analyze(
+            cache, self._get_analyzer(extra_fields='#LASTSECONDHINT:200;')
+        )
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+        self.assertEqual([2.0, 0], short.density_graph[-1])
+        self.assertEqual([200.0, 0], long.density_graph[-1])
+
+    def test_write_on_commit(self):
+        # nothing is written until the transaction commits, but the results
+        # are reused in the meantime
+        cache = AnalysisCache()
+        with self.captureOnCommitCallbacks() as callbacks:
+            cache.analyze(self._get_analyzer(title='A'))
+            cache.analyze(self._get_analyzer(title='B'))
+            self.assertFalse(AnalysisCacheEntry.objects.exists())
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        for callback in callbacks:
+            callback()
+        self.assertEqual(1, AnalysisCacheEntry.objects.count())
+
+    def test_get(self):
+        # get() doesn't analyze the chart on a miss
+        cache = AnalysisCache()
+        analyzer = self._get_analyzer()
+        with patch.object(analyzer, 'analyze') as analyze:
+            self.assertIsNone(cache.get(analyzer))
+            analyze.assert_not_called()
+        expected = self._analyze(cache, analyzer)
+        actual = cache.get(self._get_analyzer())
+        self.assertEqual(
+            json.dumps(asdict(expected), sort_keys=True),
+            json.dumps(asdict(actual), sort_keys=True)
+        )
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+    def test_eviction(self):
+        cache = AnalysisCache(max_entries=2)
+        analyzers = [self._get_analyzer(notes) for notes in ('1000', '0100')]
+        for analyzer in analyzers:
+            self._analyze(cache, analyzer)
+        # use the first chart again, so the second is the least recently used
+        self._analyze(cache, analyzers[0])
+        self._analyze(cache, self._get_analyzer('0010'))
+        self.assertEqual(2, AnalysisCacheEntry.objects.count())
+        self._analyze(cache, analyzers[0])
+        self._analyze(cache, analyzers[1])
+        self.assertEqual((2, 4), (cache.hits, cache.misses))
+        self.assertEqual('analysis cache: 2/6 hits (33%)', str(cache))
+
+
+class NoteTokensTestClass(SimpleTestCase):
+    def _do_test(self, notes, canonical):
+        tokens = NoteTokens(notes)
+        expected = [
+            (note.beat, note.column, note.note_type.value)
+            for note in NoteData(notes)
+        ]
+        actual = [
+            (Beat(int(m) * 4 * int(sub) + int(r) * 4, int(sub)), c, chr(char))
+            for m, r, sub, c, char in zip(
+                tokens.measures, tokens.rows, tokens.subdivisions,
+                tokens.columns.tolist(), tokens.chars
+            )
+        ]
+        self.assertEqual(expected, actual)
+        self.assertEqual(canonical, tokens.get_minimized_chart() is not None)
+
+    def test_canonical(self):
+        self._do_test(
+            '\n0000\n1000\n0000\n0M00\n,\n0000\n0000\n0000\n,\n'
+            + '0000\n' * 47 + '00F1\n,\n2000\n3000\n', True
+        )
+
+    def test_non_canonical(self):
+        # stray whitespace, blank lines, keysounds, commas on the same line
+        # as a row
+        self._do_test(
+            ' 0000 \n1000\n\n0M00\r\n,0000\n0000\t\n0010[3]\n,\n'
+            + '0000\n' * 47 + '00L1,\n2000\n3000\n', False
+        )
+
+    def test_minimized_chart(self):
+        tokens = NoteTokens(
+            '1000\n0000\n0100\n0000\n,\n0000\n0000\n0000\n0000\n,\n'
+            '0000\n0000\n0000\n0000\n0000\n0000\n1000\n0000\n,\n'
+            '1000\n0000\n0100\n'
+        )
+        self.assertEqual(
+            '1000\n0100\n,\n0000\n,\n0000\n0000\n0000\n1000\n,\n'
+            '1000\n0000\n0100',
+            tokens.get_minimized_chart()
+        )
+        with self.assertRaises(RuntimeError):
+            NoteTokens('1000\n,\n,\n1000').get_minimized_chart()
+
+
+class SyntheticSimfileTestClass(SimpleTestCase):
+    def test_deterministic(self):
+        self.assertEqual(
+            generate_simfile('stream_2min', 1),
+            generate_simfile('stream_2min', 1)
+        )
+        self.assertNotEqual(
+            generate_simfile('stream_2min', 1),
+            generate_simfile('stream_2min', 2)
+        )
+
+    def test_scenarios(self):
+        for name, scenario in SCENARIOS.items():
+            with self.subTest(name):
+                sim = simfile.loads(generate_simfile(name))
+                self.assertEqual(
+                    scenario.charts + scenario.edits, len(sim.charts)
+                )
+                song_analyzer = SongAnalyzer(sim)
+                self.assertGreater(song_analyzer.get_chart_len(), 0)
+                for chart in sim.charts:
+                    self.assertEqual(scenario.stepstype, chart.stepstype)
+                    self.assertEqual(
+                        scenario.measures, chart.notes.count(',') + 1
+                    )
+
+    def test_benchmark_command(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'results.json')
+            call_command(
+                'benchmark_analysis', scenario=['stream_2min'], repeat=1,
+                steps=True, output=path, stdout=io.StringIO()
+            )
+            with open(path) as f:
+                results = json.load(f)['results']
+            call_command(
+                'benchmark_analysis', scenario=['stream_2min'], repeat=1,
+                step=['get_hash'], compare=path, stdout=io.StringIO()
+            )
+        self.assertEqual(
+            ['construct', 'get_chart_len', 'get_bpm_ranges', 'get_counts',
+             'get_density_graph', 'get_stream_info', 'get_hash'],
+            [r['step'] for r in results]
+        )
+        for result in results:
+            self.assertLessEqual(result['min_s'], result['median_s'])
+            self.assertGreater(result['peak_bytes'], 0)
+
+        # the backend/mode comparison also takes synthetic simfiles
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'results.json')
+            call_command(
+                'benchmark_analysis', scenario=['stream_2min'], repeat=1,
+                output=path, stdout=io.StringIO()
+            )
+            with open(path) as f:
+                results = json.load(f)['results']
+        self.assertEqual(len(BACKENDS) * len(MODES), len(results))
+        for result in results:
+            self.assertGreater(result['charts'], 0)
+
+
+class StreamingAnalysisTestClass(SimpleTestCase):
+    def _do_test(self, sim, max_chars):
+        memory_ceiling = max_chars * BYTES_PER_NOTE_DATA_CHAR
+        for chart in sim.charts:
+            expected = SongAnalyzer(sim, memory_ceiling=0) \
+                .get_chart_analyzer(chart).analyze()
+            analyzer = SongAnalyzer(sim, memory_ceiling=memory_ceiling) \
+                .get_chart_analyzer(chart)
+            self.assertTrue(analyzer.streaming)
+            self.assertEqual(expected, analyzer.analyze())
+
+    def test_measure_chunks(self):
+        notes = '1000\n,\n0100\n0010\n,\n,\n0001'
+        self.assertEqual(
+            [(0, '1000\n'), (1, '\n0100\n0010\n'), (2, '\n,\n0001')],
+            list(iter_measure_chunks(notes, 8))
+        )
+        # measures longer than the limit get a chunk to themselves
+        self.assertEqual(
+            [(0, '1000\n'), (1, '\n0100\n0010\n'), (2, '\n'), (3, '\n0001')],
+            list(iter_measure_chunks(notes, 1))
+        )
+        self.assertEqual(
+            [(0, '1000\n,\n0100\n0010\n,\n'), (3, '\n0001')],
+            list(iter_measure_chunks(notes, 20))
+        )
+        self.assertEqual([(0, notes)], list(iter_measure_chunks(notes, 100)))
+
+    def test_holds_across_chunks(self):
+        # holds that start in one chunk and end several chunks later still
+        # count towards hands, and heads whose "tail" is in a later chunk
+        # but isn't a tail are still dropped as orphans
+        sim = simfile.loads(
+            '#BPMS:0=120;#NOTES:dance-single::Hard:9::\n'
+            '2000\n0000\n,\n0000\n0000\n,\n0110\n0000\n,\n3002\n0000\n,\n'
+            '0001\n0000\n,\n0200\n0000\n,\n1301\n1011\n;'
+        )
+        self._do_test(sim, 1)
+        self.assertEqual(
+            3, SongAnalyzer(sim, memory_ceiling=1).get_chart_analyzer(
+                sim.charts[0]
+            ).get_counts()['hands']
+        )
+
+    def test_test_charts(self):
+        for name in os.listdir(os.path.join(TEST_BASE_DIR, 'sims')):
+            with self.subTest(name):
+                sim, _ = open_test_chart(name)
+                self._do_test(sim, 50)
+
+    def test_synthetic(self):
+        for name in ('gimmick', 'doubles'):
+            with self.subTest(name):
+                self._do_test(simfile.loads(generate_simfile(name)), 1000)
@@ -0,0 +1,38 @@
+import io
+import os
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from django.test import SimpleTestCase
+
+from ..utils.archive_fs import TarArchiveFS, open_archive
+
+
+class ArchiveFSTestClass(SimpleTestCase):
+
+    def test_tar_threaded_reads(self):
+        # members read in several threads at once shouldn't get mixed up
+        members = {
+            f'/pack/song{i}/file.bin': bytes([i]) * (256 * 1024)
+            for i in range(8)
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_path = os.path.join(tmp_dir, 'pack.tar')
+            with tarfile.open(archive_path, 'w:') as tar:
+                for path, data in members.items():
+                    info = tarfile.TarInfo(path.lstrip('/'))
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+
+            def read(path):
+                chunks = []
+                with archive.openbin(path) as f:
+                    while chunk := f.read(4096):
+                        chunks.append(chunk)
+                return b''.join(chunks)
+
+            with open_archive(archive_path) as archive:
+                self.assertIsInstance(archive, TarArchiveFS)
+                with ThreadPoolExecutor(8) as executor:
+                    results = list(executor.map(read, list(members) * 4))
+        self.assertEqual(list(members.values()) * 4, results)
@@ -0,0 +1,138 @@
+import os
+import struct
+import tempfile
+import wave
+from unittest.mock import patch
+from django.test import SimpleTestCase
+
+from ..utils.audio import (
+    UnsupportedAudioError, read_audio_duration, get_audio_duration
+)
+from ._common import TEST_BASE_DIR
+
+
+# MPEG-1 layer 3 frames at 44.1 kHz, 1152 samples each
+MP3_BITRATES = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+MP3_FRAME_DURATION = 1152 / 44100
+
+
+def make_mp3_frame(bitrate_index=9, padding=0, payload=b''):
+    header = bytes([0xFF, 0xFB, (bitrate_index << 4) | (padding << 1), 0])
+    length = 144 * MP3_BITRATES[bitrate_index] * 1000 // 44100 + padding
+    return header + payload.ljust(length - 4, b'\0')
+
+
+def make_xing_frame(num_frames):
+    # stereo MPEG-1, so the Xing header comes after 32 bytes of side info
+    return make_mp3_frame(
+        payload=b'\0' * 32 + b'Xing' + struct.pack('>II', 1, num_frames)
+    )
+
+
+def make_vbri_frame(num_frames):
+    payload = b'\0' * 32 + b'VBRI' + b'\0' * 6 + struct.pack('>II', 0, num_frames)
+    return make_mp3_frame(payload=payload)
+
+
+def make_id3v2_tag(size):
+    size_bytes = bytes((size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+    return b'ID3\x03\x00\x00' + size_bytes + b'\0' * size
+
+
+class ReadAudioDurationTestClass(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def _write(self, filename, data):
+        path = os.path.join(self.temp_dir.name, filename)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _vbr_frames(self, count):
+        return b''.join(
+            make_mp3_frame((5, 9, 11, 14)[i % 4], i % 2) for i in range(count)
+        )
+
+    def test_ogg(self):
+        path = os.path.join(
+            TEST_BASE_DIR, 'simfile_dirs', 'GetSongLengths_test_longer_song',
+            'click16.ogg'
+        )
+        self.assertAlmostEqual(8, read_audio_duration(path), places=3)
+        path = os.path.join(
+            TEST_BASE_DIR, 'packs', 'PatchPack_base', 'song1', 'click.ogg'
+        )
+        self.assertAlmostEqual(5, read_audio_duration(path), places=3)
+
+    def test_mp3_cbr(self):
+        # frames are counted when there's no Xing/VBRI header, and tags at
+        # either end are skipped
+        frames = b''.join(make_mp3_frame(padding=i % 2) for i in range(400))
+        path = self._write('cbr.mp3', frames)
+        self.assertAlmostEqual(
+            400 * MP3_FRAME_DURATION, read_audio_duration(path)
+        )
+        path = self._write(
+            'tagged.MP3',
+            make_id3v2_tag(300) + frames + b'TAG' + b'\0' * 125
+        )
+        self.assertAlmostEqual(
+            400 * MP3_FRAME_DURATION, read_audio_duration(path)
+        )
+
+    def test_mp3_vbr(self):
+        # the frame count in the Xing/VBRI header is used if present
+        frames = self._vbr_frames(400)
+        path = self._write('no_header.mp3', frames)
+        self.assertAlmostEqual(
+            400 * MP3_FRAME_DURATION, read_audio_duration(path)
+        )
+        path = self._write('xing.mp3', make_xing_frame(400) + frames)
+        self.assertAlmostEqual(
+            400 * MP3_FRAME_DURATION, read_audio_duration(path)
+        )
+        path = self._write('vbri.mp3', make_vbri_frame(200) + frames)
+        self.assertAlmostEqual(
+            200 * MP3_FRAME_DURATION, read_audio_duration(path)
+        )
+
+    def test_wav(self):
+        path = os.path.join(self.temp_dir.name, 'test.wav')
+        with wave.open(path, 'wb') as w:
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+            w.writeframes(b'\0' * 4 * 66150)
+        self.assertAlmostEqual(1.5, read_audio_duration(path))
+
+        # truncated file: the data chunk size is clamped to the file size
+        with open(path, 'rb') as f:
+            data = f.read()
+        path = self._write('truncated.wav', data[:len(data) - 4 * 22050])
+        self.assertAlmostEqual(1, read_audio_duration(path))
+
+    def test_unsupported(self):
+        for filename, data in (
+            ('garbage.ogg', b'not an ogg file'),
+            ('garbage.mp3', b'\0' * 1000),
+            ('garbage.wav', b'RIFF'),
+            ('empty.wav', b''),
+            ('music.flac', b'fLaC'),
+        ):
+            with self.subTest(filename):
+                path = self._write(filename, data)
+                with self.assertRaises(UnsupportedAudioError):
+                    read_audio_duration(path)
+
+    @patch('itgdb_site.utils.audio.probe_audio_duration', return_value=12.5)
+    def test_fallback(self, mock_probe):
+        # ffprobe is only used when the headers can't be read
+        path = self._write('cbr.mp3', make_mp3_frame() * 10)
+        self.assertAlmostEqual(10 * MP3_FRAME_DURATION, get_audio_duration(path))
+        mock_probe.assert_not_called()
+
+        path = self._write('garbage.mp3', b'\0' * 1000)
+        self.assertEqual(12.5, get_audio_duration(path))
+        mock_probe.assert_called_once_with(path)
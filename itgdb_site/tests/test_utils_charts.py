@@ -1,10 +1,12 @@
 import os
+from unittest.mock import patch
 from django.test import SimpleTestCase
 import simfile
 
-from ..utils.charts import get_assets, get_song_lengths
+from ..utils.charts import get_assets, get_song_lengths, get_hash
 from ..utils.analysis import SongAnalyzer
-from ._common import TEST_BASE_DIR, open_test_simfile_dir
+from ..utils.analysis.tokenizer import NoteTokens
+from ._common import TEST_BASE_DIR, open_test_simfile_dir, open_test_chart
 
 
 class GetAssetsTestClass(SimpleTestCase):
@@ -214,4 +216,49 @@ class GetSongLengthsTestClass(SimpleTestCase):
     def test_fail(self):
         # test that the function returns None if the music file cannot be
         # opened
-        self._do_test('test_fail', None)
\ No newline at end of file
+        self._do_test('test_fail', None)
+
+
+class GetHashTestClass(SimpleTestCase):
+    def _do_test(self, sim, chart, expected):
+        self.assertEqual(expected, get_hash(sim, chart))
+        # reusing tokenized notes should give the same result
+        tokens = NoteTokens(chart.notes)
+        self.assertEqual(expected, get_hash(sim, chart, tokens))
+
+    def test_hash(self):
+        sim, chart = open_test_chart('GetStreamInfo_test_varying_bpm.sm')
+        self._do_test(sim, chart, 'c46955d9d461b3660992cccee437b19b38fc5f1e')
+
+    def test_normalization(self):
+        # comments, stray whitespace and CRLFs don't affect the hash
+        sim = simfile.loads(
+            '#BPMS:0=120;#NOTES:dance-single::Hard:9::\n'
+            '1000\n0000\n0100\n0000\n,\n0000\n0000\n0000\n0000\n;'
+        )
+        expected = 'b70c95d6ad236233c78d2553eee73c0d38115543'
+        self._do_test(sim, sim.charts[0], expected)
+        sim.charts[0].notes = (
+            '  1000 // comment\r\n0000\r\n 0100\n0000\n , \n'
+            '0000\n0000\n0000\n0000\n'
+        )
+        self._do_test(sim, sim.charts[0], expected)
+
+    def test_chunk_boundaries(self):
+        # a tiny chunk size means every line (and so every comment and
+        # measure) ends up on a chunk boundary
+        sim = simfile.loads(
+            '#BPMS:0=120;#NOTES:dance-single::Hard:9::\n'
+            '1000\r\n0000 // a, comment\r0100\n0000\n,\n0000\n0000\n0000\n'
+            '0000\n,\n0010\n0000\n;'
+        )
+        expected = get_hash(sim, sim.charts[0])
+        with patch('itgdb_site.utils.charts._HASH_CHUNK_SIZE', 1):
+            self.assertEqual(expected, get_hash(sim, sim.charts[0]))
+
+    def test_empty_measure(self):
+        sim = simfile.loads(
+            '#BPMS:0=120;#NOTES:dance-single::Hard:9::\n1000\n,\n,\n1000\n;'
+        )
+        with self.assertRaises(RuntimeError):
+            get_hash(sim, sim.charts[0])
@@ -0,0 +1,162 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from django.test import TestCase, override_settings
+
+from ..utils.downloader import get_session, open_download
+
+
+class _RangeRequestHandler(BaseHTTPRequestHandler):
+    # a server for one file that supports range requests, and can drop the
+    # connection partway through a response
+    protocol_version = 'HTTP/1.1'
+    data = b''
+    etag = '"1"'
+    accept_ranges = True
+    # drop the connection after sending this many bytes (once)
+    drop_after = None
+
+    def do_GET(self):
+        cls = type(self)
+        cls.requests.append((self.headers.get('Range'), self.client_address))
+        start, end = 0, len(cls.data)
+        range_header = self.headers.get('Range')
+        partial = range_header and cls.accept_ranges \
+            and self.headers.get('If-Range') == cls.etag
+        if partial:
+            m = re.fullmatch(r'bytes=(\d+)-(\d*)', range_header)
+            start = int(m[1])
+            if m[2]:
+                end = int(m[2]) + 1
+        body = cls.data[start:end]
+
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', cls.etag)
+        if cls.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if partial:
+            self.send_header(
+                'Content-Range', f'bytes {start}-{end - 1}/{len(cls.data)}'
+            )
+        self.end_headers()
+
+        if cls.drop_after is not None and len(body) > cls.drop_after:
+            self.wfile.write(body[:cls.drop_after])
+            cls.drop_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        # the client closing connections early is expected
+        pass
+
+
+@override_settings(DOWNLOAD_SEGMENTS=4, DOWNLOAD_SEGMENT_MIN_BYTES=1 << 30)
+@patch('itgdb_site.utils.downloader._RETRY_DELAY', 0)
+class DownloaderTestClass(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, 'download')
+        self.data = os.urandom(300000)
+
+        self.handler = type('Handler', (_RangeRequestHandler,), {
+            'data': self.data, 'requests': []
+        })
+        server = _Server(('127.0.0.1', 0), self.handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f'http://127.0.0.1:{server.server_port}/pack.zip'
+
+    def _download(self):
+        progress = []
+        with open_download(
+            self.url, lambda done, total: progress.append((done, total))
+        ) as download:
+            download.save(self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        return progress
+
+    def test_download(self):
+        progress = self._download()
+        self.assertEqual((len(self.data), len(self.data)), progress[-1])
+        self.assertEqual([None], [r for r, _ in self.handler.requests])
+
+    def test_resume(self):
+        self.handler.drop_after = 100000
+        progress = self._download()
+        self.assertEqual((len(self.data), len(self.data)), progress[-1])
+        ranges = [r for r, _ in self.handler.requests]
+        self.assertEqual(2, len(ranges))
+        self.assertIsNone(ranges[0])
+        # we resume from somewhere after where the connection dropped
+        # (depending on how much of the response had been received)
+        m = re.fullmatch(r'bytes=(\d+)-(\d+)', ranges[1])
+        self.assertLessEqual(int(m[1]), 100000)
+        self.assertEqual(len(self.data) - 1, int(m[2]))
+
+    def test_no_resume_without_ranges(self):
+        self.handler.accept_ranges = False
+        self.handler.drop_after = 100000
+        with self.assertRaises(Exception):
+            self._download()
+        self.assertEqual(1, len(self.handler.requests))
+
+    def test_file_changed(self):
+        # resuming a file that changed in the meantime fails instead of
+        # splicing the two versions together
+        self.handler.drop_after = 100000
+        with open_download(self.url) as download:
+            self.handler.etag = '"2"'
+            with self.assertRaisesRegex(Exception, 'changed'):
+                download.save(self.path)
+
+    def test_segments(self):
+        with self.settings(DOWNLOAD_SEGMENT_MIN_BYTES=1000):
+            progress = self._download()
+        self.assertEqual((len(self.data), len(self.data)), progress[-1])
+        ranges = sorted(r for r, _ in self.handler.requests[1:])
+        self.assertEqual(
+            [
+                'bytes=0-74999', 'bytes=150000-224999', 'bytes=225000-299999',
+                'bytes=75000-149999'
+            ],
+            ranges
+        )
+
+    def test_segments_resume(self):
+        with self.settings(DOWNLOAD_SEGMENT_MIN_BYTES=1000):
+            with open_download(self.url) as download:
+                # one of the segments gets dropped and resumed
+                self.handler.drop_after = 10000
+                download.save(self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        self.assertEqual(6, len(self.handler.requests))
+
+    def test_session_reuse(self):
+        self.assertIs(get_session(self.url), get_session(self.url + '?a=1'))
+        self.assertIsNot(
+            get_session(self.url), get_session('http://example.com/')
+        )
+        for _ in range(3):
+            self._download()
+        # all the downloads went over the same connection
+        self.assertEqual(
+            1, len(set(address for _, address in self.handler.requests))
+        )
@@ -0,0 +1,130 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest.mock import patch
+from django.test import TestCase, override_settings
+
+from ..utils.extraction import (
+    ExtractionBudgetError, extract_pack_archive, list_archive,
+    release_scratch_space, reserve_scratch_space
+)
+from ._common import TEST_BASE_DIR
+
+
+class ExtractPackArchiveTestClass(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        settings_override = override_settings(MEDIA_ROOT=self.tmp_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.extract_path = os.path.join(self.tmp_dir, 'extracted', 'pack')
+
+        # a copy of a test pack with some files the upload doesn't need
+        pack_path = os.path.join(self.tmp_dir, 'pack', 'pack')
+        shutil.copytree(
+            os.path.join(TEST_BASE_DIR, 'packs', 'UploadPack_test_upload'),
+            pack_path
+        )
+        for name in ('song1/keysound.wav', 'song1/script.lua', 'song2/z.ogg'):
+            with open(os.path.join(pack_path, name), 'wb') as f:
+                f.write(b'\0' * 100)
+        # song2 doesn't reference its music, so we should fall back to the
+        # first audio file (click.ogg)
+        sim_path = os.path.join(pack_path, 'song2', 'click.ssc')
+        with open(sim_path, encoding='utf-8') as f:
+            sim_text = f.read()
+        with open(sim_path, 'w', encoding='utf-8') as f:
+            f.write(sim_text.replace('#MUSIC:click.ogg;', '#MUSIC:;'))
+
+        self.archive_path = shutil.make_archive(
+            os.path.join(self.tmp_dir, 'pack'), 'gztar',
+            os.path.join(self.tmp_dir, 'pack')
+        )
+
+    def _get_extracted_files(self):
+        return set(
+            os.path.relpath(os.path.join(dir_path, name), self.extract_path)
+            for dir_path, _, filenames in os.walk(self.extract_path)
+            for name in filenames
+        )
+
+    def test_extract(self):
+        report = extract_pack_archive(self.archive_path, self.extract_path)
+        self.assertEqual(
+            {
+                'pack/pack_banner.png',
+                'pack/song1/click.ssc',
+                'pack/song1/click.ogg',
+                'pack/song1/banner.png',
+                'pack/song2/click.ssc',
+                'pack/song2/click.ogg',
+            },
+            self._get_extracted_files()
+        )
+        self.assertEqual(
+            {
+                'pack/song1/keysound.wav',
+                'pack/song1/script.lua',
+                'pack/song2/z.ogg'
+            },
+            set(os.path.normpath(m.name) for m in report.skipped)
+        )
+        self.assertEqual(300, report.skipped_bytes)
+        self.assertEqual(6, len(report.extracted))
+
+    def test_unsafe_paths(self):
+        with tarfile.open(self.archive_path, 'w:gz') as t:
+            for name in ('../evil.sm', '/pack/song/song.sm'):
+                info = tarfile.TarInfo(name)
+                info.size = 4
+                t.addfile(info, io.BytesIO(b'test'))
+        report = extract_pack_archive(self.archive_path, self.extract_path)
+        self.assertEqual({'pack/song/song.sm'}, self._get_extracted_files())
+        self.assertEqual(['../evil.sm'], [m.name for m in report.skipped])
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tmp_dir, 'extracted', 'evil.sm'))
+        )
+
+    def test_max_files(self):
+        with self.settings(EXTRACTION_MAX_FILES=5):
+            with self.assertRaises(ExtractionBudgetError):
+                extract_pack_archive(self.archive_path, self.extract_path)
+        with self.settings(EXTRACTION_MAX_FILES=6):
+            extract_pack_archive(self.archive_path, self.extract_path)
+
+    def test_max_bytes(self):
+        size = sum(
+            m.size for m in list_archive(self.archive_path)
+            if not m.name.endswith(('.wav', '.lua', 'z.ogg'))
+        )
+        with self.settings(EXTRACTION_MAX_BYTES=size - 1):
+            with self.assertRaises(ExtractionBudgetError):
+                extract_pack_archive(self.archive_path, self.extract_path)
+        with self.settings(EXTRACTION_MAX_BYTES=size):
+            extract_pack_archive(self.archive_path, self.extract_path)
+
+    @patch('itgdb_site.utils.extraction._RESERVATION_TIMEOUT', 0)
+    def test_shared_scratch_space(self):
+        # another job has reserved most of the scratch space
+        other_path = os.path.join(self.tmp_dir, 'extracted', 'other')
+        os.makedirs(other_path)
+        with self.settings(EXTRACTION_SCRATCH_BYTES=1024 * 1024):
+            reserve_scratch_space(other_path, 1024 * 1024 - 10)
+            with self.assertRaises(ExtractionBudgetError):
+                extract_pack_archive(self.archive_path, self.extract_path)
+
+            # until it's done
+            release_scratch_space(other_path)
+            shutil.rmtree(self.extract_path)
+            extract_pack_archive(self.archive_path, self.extract_path)
+
+            # the reservation of a removed directory doesn't count anymore
+            shutil.rmtree(self.extract_path)
+            reserve_scratch_space(other_path, 1024 * 1024 - 10)
+            shutil.rmtree(other_path)
+            os.makedirs(self.extract_path)
+            reserve_scratch_space(self.extract_path, 1024 * 1024)
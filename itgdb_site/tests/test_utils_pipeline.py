@@ -0,0 +1,116 @@
+import threading
+from django.test import SimpleTestCase
+
+from ..utils.pipeline import Pipeline, Stage
+
+
+class PipelineTestClass(SimpleTestCase):
+
+    def test_results(self):
+        def check(x):
+            if x == 2:
+                raise ValueError('2')
+            return x
+
+        results = Pipeline([
+            Stage('double', lambda x: x * 2, threads=3),
+            Stage('check', check),
+            Stage('add', lambda x: x + 1),
+        ]).run(range(5))
+        self.assertEqual([1, None, 5, 7, 9], [r.value for r in results])
+        self.assertEqual(
+            [None, 'check', None, None, None], [r.stage for r in results]
+        )
+        self.assertIsInstance(results[1].error, ValueError)
+
+    def test_overlap(self):
+        # the second item gets fetched while the first one is being ingested
+        first_ingesting = threading.Event()
+        second_fetched = threading.Event()
+
+        def fetch(x):
+            if x == 1:
+                self.assertTrue(first_ingesting.wait(5))
+                second_fetched.set()
+            return x
+
+        def ingest(x):
+            if x == 0:
+                first_ingesting.set()
+                self.assertTrue(second_fetched.wait(5))
+            return x
+
+        results = Pipeline([
+            Stage('fetch', fetch), Stage('ingest', ingest)
+        ]).run(range(2))
+        self.assertEqual([0, 1], [r.value for r in results])
+
+    def test_high_water_mark(self):
+        lock = threading.Lock()
+        in_flight = []
+        max_in_flight = []
+
+        def fetch(x):
+            with lock:
+                in_flight.append(x)
+                max_in_flight.append(len(in_flight))
+            return x
+
+        def ingest(x):
+            with lock:
+                in_flight.remove(x)
+            return x
+
+        # every item is over the high-water mark, so there's only ever one
+        # in the pipeline, despite the room in the queue
+        Pipeline(
+            [Stage('fetch', fetch), Stage('ingest', ingest)],
+            queue_size=4, high_water_bytes=100, get_size=lambda x: 100
+        ).run(range(10))
+        self.assertEqual(1, max(max_in_flight))
+
+        # without the mark, the fetches get ahead
+        max_in_flight.clear()
+        fetched_ahead = threading.Event()
+
+        def fetch_ahead(x):
+            if x == 2:
+                fetched_ahead.set()
+            return fetch(x)
+
+        def slow_ingest(x):
+            if x == 0:
+                self.assertTrue(fetched_ahead.wait(5))
+            return ingest(x)
+
+        Pipeline(
+            [
+                Stage('fetch', fetch_ahead, threads=4),
+                Stage('ingest', slow_ingest)
+            ],
+            queue_size=4, get_size=lambda x: 100
+        ).run(range(10))
+        self.assertGreater(max(max_in_flight), 1)
+
+    def test_interrupted(self):
+        # when the last stage is interrupted, the items waiting for it get
+        # discarded
+        queue_full = threading.Event()
+        discarded = []
+
+        def fetch(x):
+            if x == 3:
+                # 1 and 2 are in the queue
+                queue_full.set()
+            return x
+
+        def ingest(x):
+            self.assertTrue(queue_full.wait(5))
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            Pipeline(
+                [Stage('fetch', fetch), Stage('ingest', ingest)],
+                queue_size=2, discard=discarded.append
+            ).run(range(5))
+        self.assertEqual([1, 2, 3], sorted(discarded))
@@ -0,0 +1,202 @@
+import logging
+from unittest.mock import patch
+from django.test import TestCase
+from django.core.files.storage.memory import InMemoryStorage
+from storages.backends.s3 import S3Storage
+
+from ..models import Song, Chart
+from ..utils.uploads import upload_pack
+from ..utils.reanalysis import (
+    reanalyze_outdated, get_outdated_songs, get_outdated_charts, rehash_song
+)
+from ..tasks import make_rehash_charts_group
+from ..utils.analysis import SongAnalyzer
+from ..utils.analysis.analyzer import ANALYZER_VERSIONS
+from ._common import open_test_pack
+
+
+class _UploadedPackTestCase(TestCase):
+
+    def setUp(self):
+        # essentially replace s3 with mock/temporary storage during tests.
+        # (the songs get uploaded here, so we can't use class decorators)
+        in_mem_storage = InMemoryStorage()
+        for name in ('_save', '_open', 'exists'):
+            patcher = patch.object(
+                S3Storage, name, getattr(in_mem_storage, name)
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # disable info logs for processing songs
+        logging.disable(logging.INFO)
+
+        # the base pack has:
+        # - song1
+        #     - hard chart (4 steps)
+        #     - challenge chart (8 steps)
+        # - song2
+        #     - challenge chart (8 steps)
+        upload_pack(open_test_pack('PatchPack_base'), {
+            'name': 'Test Pack',
+            'author': '',
+            'release_date': None,
+            'release_date_year_only': False,
+            'category': None,
+            'tags': [],
+            'links': ''
+        })
+        self.song1 = Song.objects.get(title='song1')
+        self.song2 = Song.objects.get(title='song2')
+
+    def tearDown(self):
+        # restore previous log level
+        logging.disable(logging.NOTSET)
+
+
+class ReanalyzeOutdatedTestClass(_UploadedPackTestCase):
+
+    def test_uploads_are_up_to_date(self):
+        self.assertFalse(get_outdated_songs().exists())
+        self.assertFalse(get_outdated_charts().exists())
+        self.assertEqual(0, reanalyze_outdated())
+
+    def test_only_outdated_components(self):
+        song1_hard = self.song1.chart_set.get(difficulty=3)
+        song1_hard.steps_count = 0
+        song1_hard.counts_version = 0
+        # up to date, so this should be left alone
+        song1_hard.analysis['stream_info'] = 'untouched'
+        song1_hard.save()
+        Chart.objects.filter(song=self.song2).update(
+            analysis={'density_graph': [], 'stream_info': 'untouched'},
+            density_graph_version=0
+        )
+        self.assertEqual(
+            [self.song1.id, self.song2.id],
+            sorted(get_outdated_songs().values_list('id', flat=True))
+        )
+
+        self.assertEqual(2, reanalyze_outdated())
+
+        song1_hard.refresh_from_db()
+        self.assertEqual(4, song1_hard.steps_count)
+        self.assertEqual(ANALYZER_VERSIONS['counts'], song1_hard.counts_version)
+        self.assertEqual('untouched', song1_hard.analysis['stream_info'])
+        song2_chall = self.song2.chart_set.get()
+        self.assertNotEqual([], song2_chall.analysis['density_graph'])
+        self.assertEqual('untouched', song2_chall.analysis['stream_info'])
+        self.assertFalse(get_outdated_songs().exists())
+
+    def test_breakdowns(self):
+        song1_hard = self.song1.chart_set.get(difficulty=3)
+        breakdowns = song1_hard.breakdowns
+        self.assertIn('display', breakdowns)
+        Chart.objects.filter(id=song1_hard.id).update(
+            breakdowns={}, breakdowns_version=0
+        )
+        # regenerated from the stored stream info
+        song2_chall = self.song2.chart_set.get()
+        song2_chall.analysis['stream_info'].update(
+            quant=16, segments=[16, -2, 8], total_stream=24
+        )
+        song2_chall.breakdowns_version = 0
+        song2_chall.save()
+
+        self.assertEqual(2, reanalyze_outdated())
+        song1_hard.refresh_from_db()
+        self.assertEqual(breakdowns, song1_hard.breakdowns)
+        self.assertEqual(
+            ANALYZER_VERSIONS['breakdowns'], song1_hard.breakdowns_version
+        )
+        song2_chall.refresh_from_db()
+        self.assertEqual('16 (2) 8', song2_chall.breakdowns['display'])
+
+    def test_chart_length(self):
+        chart_len = self.song1.chart_length
+        Song.objects.filter(id=self.song1.id).update(
+            chart_length=0, chart_length_version=0
+        )
+        self.assertEqual(1, reanalyze_outdated())
+        self.song1.refresh_from_db()
+        self.assertEqual(chart_len, self.song1.chart_length)
+        self.assertEqual(
+            ANALYZER_VERSIONS['chart_length'], self.song1.chart_length_version
+        )
+
+    def test_chart_length_changed(self):
+        # the density graphs end at the old chart length
+        Song.objects.filter(id=self.song1.id).update(
+            chart_length=0, chart_length_version=0
+        )
+        song1_hard = self.song1.chart_set.get(difficulty=3)
+        density_graph = song1_hard.analysis['density_graph']
+        song1_hard.analysis['density_graph'] = []
+        song1_hard.save()
+        self.assertEqual(1, reanalyze_outdated())
+        song1_hard.refresh_from_db()
+        self.assertEqual(density_graph, song1_hard.analysis['density_graph'])
+
+    def test_failing_song(self):
+        Song.objects.update(chart_length_version=0)
+
+        def analyze(sim):
+            if sim.title == 'song1':
+                raise ValueError
+            return SongAnalyzer(sim)
+
+        # song1 gets skipped, without keeping song2 from being re-analyzed
+        with patch(
+            'itgdb_site.utils.reanalysis.SongAnalyzer', side_effect=analyze
+        ), self.assertLogs('itgdb_site.utils.reanalysis', 'WARNING'):
+            self.assertEqual(2, reanalyze_outdated(chunk_size=1))
+        self.assertEqual(
+            [self.song1.id], list(get_outdated_songs().values_list('id', flat=True))
+        )
+
+    def test_resume(self):
+        Chart.objects.update(stream_info_version=0)
+        Song.objects.update(chart_length_version=0)
+
+        # crash while processing the second chunk
+        def crash_on_song2(done, total, song):
+            if song == self.song2:
+                raise RuntimeError
+        with self.assertRaises(RuntimeError):
+            reanalyze_outdated(chunk_size=1, progress_callback=crash_on_song2)
+
+        # the first chunk should've been committed
+        self.assertEqual(
+            [self.song2.id], list(get_outdated_songs().values_list('id', flat=True))
+        )
+
+        # running it again should only process the unfinished chunk
+        processed = []
+        reanalyze_outdated(
+            chunk_size=1,
+            progress_callback=lambda done, total, song: processed.append(song)
+        )
+        self.assertEqual([self.song2], processed)
+        self.assertFalse(get_outdated_songs().exists())
+
+
+class RehashTestClass(_UploadedPackTestCase):
+
+    def test_rehash_song(self):
+        hashes = dict(Chart.objects.values_list('id', 'chart_hash'))
+        self.song1.chart_set.filter(difficulty=3).update(chart_hash='bad')
+        self.assertEqual(1, rehash_song(self.song1))
+        self.assertEqual(0, rehash_song(self.song2))
+        self.assertEqual(
+            hashes, dict(Chart.objects.values_list('id', 'chart_hash'))
+        )
+
+    def test_rehash_group(self):
+        hashes = dict(Chart.objects.values_list('id', 'chart_hash'))
+        Chart.objects.update(chart_hash='bad')
+        task_group = make_rehash_charts_group(songs_per_task=1)
+        self.assertEqual(2, len(task_group.tasks))
+        task_group.apply()
+        self.assertEqual(
+            hashes, dict(Chart.objects.values_list('id', 'chart_hash'))
+        )
@@ -1,16 +1,25 @@
 import logging
+import multiprocessing
 from datetime import datetime, timezone
 import shutil
 import os
+import tempfile
+import zipfile
 from unittest.mock import patch
-from django.test import TestCase
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now
 from django.core.files.storage.memory import InMemoryStorage
 from simfile.dir import SimfilePack
 from storages.backends.s3 import S3Storage
 
 from ..models import Tag, PackCategory, Pack, ImageFile, Song, Chart
-from ..utils.uploads import upload_pack, patch_pack, upload_song
+from ..utils.uploads import (
+    upload_pack, patch_pack, upload_song, analyze_song, _process_image,
+    _iter_song_analyses
+)
+from ..utils.archive_fs import ZipArchiveFS, open_archive
 from ._common import TEST_BASE_DIR, open_test_pack, open_test_simfile_dir
 from ..tasks import ProcessPatchResults
 
@@ -19,6 +28,7 @@ in_mem_storage = InMemoryStorage()
 # essentially replace s3 with mock/temporary storage during tests
 @patch.object(S3Storage, '_save', in_mem_storage._save)
 @patch.object(S3Storage, '_open', in_mem_storage._open)
+@patch.object(S3Storage, 'exists', in_mem_storage.exists)
 class UploadPackTestClass(TestCase):
 
     def setUp(self):
@@ -256,10 +266,207 @@ SyncOffset=ITG
         self._check_pack(pack, pack_data)
         # correct banner has dimensions 100x70
         self.assertEqual(100, pack.banner.image.width)
+
+    def test_bulk(self):
+        # inserting the songs, charts and images in bulk should give the
+        # same results as saving them one by one, in fewer queries
+        pack_data = {
+            'name': '',
+            'author': '',
+            'release_date': None,
+            'release_date_year_only': False,
+            'category': None,
+            'tags': [],
+            'links': ''
+        }
+        query_counts = []
+        for bulk in (False, True):
+            with CaptureQueriesContext(connection) as queries:
+                upload_pack(
+                    open_test_pack('UploadPack_test_upload'), pack_data,
+                    bulk=bulk
+                )
+            query_counts.append(len(queries))
+        self.assertLess(query_counts[1], query_counts[0])
+
+        packs = Pack.objects.order_by('id')
+        song_fields = ('title', 'music_length', 'banner__image')
+        chart_fields = ('song__title', 'difficulty', 'chart_hash', 'analysis')
+        for pack in packs:
+            self.assertEqual(2, pack.song_set.count())
+            self.assertEqual(2, pack.imagefile_set.count())
+            # the pack banner is shared with song2
+            self.assertEqual(
+                pack.banner, pack.song_set.get(title='song2').banner
+            )
+        songs, bulk_songs = (
+            list(pack.song_set.order_by('id').values_list(*song_fields))
+            for pack in packs
+        )
+        self.assertEqual(
+            [s[:2] for s in songs], [s[:2] for s in bulk_songs]
+        )
+        self.assertTrue(all(s[2] for s in bulk_songs))
+        self.assertEqual(*(
+            list(
+                Chart.objects.filter(song__pack=pack).order_by('id')
+                .values(*chart_fields)
+            )
+            for pack in packs
+        ))
+
+    def test_asset_threads(self):
+        # processing the images in threads should give the same results as
+        # processing them one by one, and each image file should only be
+        # processed once
+        pack_data = {
+            'name': '',
+            'author': '',
+            'release_date': None,
+            'release_date_year_only': False,
+            'category': None,
+            'tags': [],
+            'links': ''
+        }
+        for threads in (0, 4):
+            with self.settings(UPLOAD_ASSET_THREADS=threads), patch(
+                'itgdb_site.utils.uploads._process_image',
+                wraps=_process_image
+            ) as mock_process_image:
+                upload_pack(open_test_pack('UploadPack_test_upload'), pack_data)
+            paths = [c.args[0] for c in mock_process_image.call_args_list]
+            self.assertEqual(len(set(paths)), len(paths))
+
+        packs = Pack.objects.order_by('id')
+        song_fields = ('title', 'banner__has_alpha', 'bg__has_alpha')
+        for pack in packs:
+            self.assertEqual(2, pack.imagefile_set.count())
+            # the pack banner is shared with song2
+            self.assertEqual(
+                pack.banner, pack.song_set.get(title='song2').banner
+            )
+            self.assertTrue(all(s.banner for s in pack.song_set.all()))
+        self.assertEqual(*(
+            list(pack.song_set.order_by('id').values_list(*song_fields))
+            for pack in packs
+        ))
+
+    def test_analysis_processes(self):
+        # analyzing the songs in worker processes should give the same
+        # results as analyzing them during the upload
+        pack_data = {
+            'name': '',
+            'author': '',
+            'release_date': None,
+            'release_date_year_only': False,
+            'category': None,
+            'tags': [],
+            'links': ''
+        }
+        upload_pack(open_test_pack('PatchPack_base'), pack_data)
+        upload_pack(
+            open_test_pack('PatchPack_base'), pack_data, analysis_processes=2
+        )
+
+        song_fields = ('title', 'min_bpm', 'max_bpm', 'chart_length')
+        chart_fields = (
+            'song__title', 'difficulty', 'chart_hash', 'analysis', 'breakdowns',
+            'steps_count', 'combo_count'
+        )
+        packs = Pack.objects.order_by('id')
+        self.assertEqual(2, len(packs))
+        self.assertEqual(*(
+            list(pack.song_set.order_by('id').values(*song_fields))
+            for pack in packs
+        ))
+        self.assertEqual(*(
+            list(
+                Chart.objects.filter(song__pack=pack).order_by('id')
+                .values(*chart_fields)
+            )
+            for pack in packs
+        ))
     
 
+    def test_archive(self):
+        # uploading a pack straight from a zip should give the same results
+        # as uploading the extracted pack
+        pack_data = {
+            'name': '',
+            'author': '',
+            'release_date': None,
+            'release_date_year_only': False,
+            'category': None,
+            'tags': [],
+            'links': ''
+        }
+        upload_pack(open_test_pack('UploadPack_test_upload'), pack_data)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_path = shutil.make_archive(
+                os.path.join(tmp_dir, 'packs'), 'zip',
+                os.path.join(TEST_BASE_DIR, 'packs')
+            )
+            for processes in (0, 2):
+                with open_archive(archive_path) as archive:
+                    self.assertIsInstance(archive, ZipArchiveFS)
+                    upload_pack(
+                        SimfilePack(
+                            '/UploadPack_test_upload', filesystem=archive
+                        ),
+                        pack_data, analysis_processes=processes
+                    )
+
+            # duplicate simfiles are only hidden in the archive
+            with open_archive(archive_path) as archive:
+                upload_pack(
+                    SimfilePack(
+                        '/UploadPack_test_dupe_sims', filesystem=archive
+                    ),
+                    pack_data
+                )
+            with zipfile.ZipFile(archive_path) as z:
+                self.assertIn(
+                    'UploadPack_test_dupe_sims/dupetest/STEPS_.ssc',
+                    z.namelist()
+                )
+
+        song_fields = (
+            'title', 'music_length', 'min_bpm', 'max_bpm', 'banner__has_alpha',
+            'bg__has_alpha'
+        )
+        chart_fields = ('song__title', 'difficulty', 'chart_hash', 'analysis')
+        packs = Pack.objects.order_by('id')
+        self.assertEqual(4, len(packs))
+        for pack in packs[1:3]:
+            self.assertEqual(
+                list(packs[0].song_set.order_by('id').values(*song_fields)),
+                list(pack.song_set.order_by('id').values(*song_fields))
+            )
+            self.assertEqual(
+                list(
+                    Chart.objects.filter(song__pack=packs[0]).order_by('id')
+                    .values(*chart_fields)
+                ),
+                list(
+                    Chart.objects.filter(song__pack=pack).order_by('id')
+                    .values(*chart_fields)
+                )
+            )
+            self.assertEqual(2, pack.imagefile_set.count())
+        self.assertEqual(
+            {
+                'dupetest REAL',
+                'dupetest2 REAL',
+                'dupetest_sm REAL',
+                'dupetest_uppercase_ext REAL'
+            },
+            set(packs[3].song_set.values_list('title', flat=True))
+        )
+
+
 @patch.object(S3Storage, '_save', in_mem_storage._save)
 @patch.object(S3Storage, '_open', in_mem_storage._open)
+@patch.object(S3Storage, 'exists', in_mem_storage.exists)
 class PatchPackTestClass(TestCase):
     maxDiff = None
 
@@ -408,6 +615,7 @@ SyncOffset=ITG
 
 @patch.object(S3Storage, '_save', in_mem_storage._save)
 @patch.object(S3Storage, '_open', in_mem_storage._open)
+@patch.object(S3Storage, 'exists', in_mem_storage.exists)
 class UploadSongTestClass(TestCase):
 
     def setUp(self):
@@ -440,4 +648,60 @@ class UploadSongTestClass(TestCase):
 
         self.assertEqual(1, len(Song.objects.all()))
         song = Song.objects.first()
-        self._check_song(song, dict(min_bpm=100, max_bpm=105))
\ No newline at end of file
+        self._check_song(song, dict(min_bpm=100, max_bpm=105))
+
+
+def _send_song_analyses(simfile_dirs, conn):
+    conn.send([
+        analysis.to_dict()
+        for analysis in _iter_song_analyses(simfile_dirs, 2)
+    ])
+
+
+class AnalyzeSongTestClass(SimpleTestCase):
+
+    def test_daemonic_parent(self):
+        # celery's prefork workers are daemonic processes, which should
+        # still be able to analyze songs in worker processes
+        simfile_dirs = list(open_test_pack('PatchPack_base').simfile_dirs())
+        recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.get_context('fork').Process(
+            target=_send_song_analyses, args=(simfile_dirs, send_conn),
+            daemon=True
+        )
+        process.start()
+        self.assertTrue(recv_conn.poll(30))
+        analyses = recv_conn.recv()
+        process.join()
+        self.assertEqual(
+            [analyze_song(d.simfile_dir).to_dict() for d in simfile_dirs],
+            analyses
+        )
+
+    def test_archive_closed(self):
+        # outside of the worker processes (e.g. in a celery task), the
+        # archive only stays open while the song is analyzed
+        simfile_dir = next(open_test_pack('PatchPack_base').simfile_dirs())
+        archive_dir_path = '/' + os.path.relpath(
+            simfile_dir.simfile_dir, os.path.join(TEST_BASE_DIR, 'packs')
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_path = shutil.make_archive(
+                os.path.join(tmp_dir, 'packs'), 'zip',
+                os.path.join(TEST_BASE_DIR, 'packs')
+            )
+            archives = []
+
+            def open_and_keep_archive(path):
+                archives.append(open_archive(path))
+                return archives[-1]
+
+            with patch(
+                'itgdb_site.utils.uploads.open_archive', open_and_keep_archive
+            ):
+                analysis = analyze_song(archive_dir_path, archive_path)
+        self.assertEqual(
+            analyze_song(simfile_dir.simfile_dir).to_dict(), analysis.to_dict()
+        )
+        self.assertEqual(1, len(archives))
+        self.assertTrue(archives[0].isclosed())
@@ -0,0 +1,198 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from functools import partial
+from pathlib import Path
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from django.test import TestCase, override_settings
+
+from ..tasks import process_pack_from_web
+from ..utils.download_cache import normalize_url
+from ..utils.url_fetch import fetch_from_url
+from ._common import TEST_BASE_DIR
+
+
+class _RequestHandler(SimpleHTTPRequestHandler):
+    etag = None
+    send_last_modified = True
+
+    def send_header(self, keyword, value):
+        if keyword == 'Last-Modified' and not self.send_last_modified:
+            return
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        if self.etag:
+            self.send_header('ETag', self.etag)
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FetchFromUrlTestClass(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.media_root = os.path.join(self.tmp_dir, 'media')
+        os.makedirs(os.path.join(self.media_root, 'packs'))
+        self.files_path = os.path.join(self.tmp_dir, 'files')
+        os.makedirs(self.files_path)
+        settings_override = override_settings(
+            MEDIA_ROOT=Path(self.media_root), DOWNLOAD_CACHE_MAX_BYTES=1024
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _write_file(self, name, contents):
+        path = os.path.join(self.files_path, name)
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return path
+
+    def _start_server(self, **handler_attrs):
+        handler = type('Handler', (_RequestHandler,), handler_attrs)
+        server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), partial(handler, directory=self.files_path)
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f'http://127.0.0.1:{server.server_port}/', handler
+
+    def _fetch(self, url, expected_cached, expected_contents):
+        path, cached = fetch_from_url(url)
+        self.assertEqual(expected_cached, cached)
+        with open(path, 'rb') as f:
+            self.assertEqual(expected_contents, f.read())
+        os.remove(path)
+
+    def _get_cache_entries(self):
+        return [
+            name for name in os.listdir(
+                os.path.join(self.media_root, 'download_cache')
+            )
+            if not name.startswith('.')
+        ]
+
+    def test_file_url(self):
+        path = self._write_file('pack.zip', b'pack')
+        url = 'file://' + path
+        self._fetch(url, False, b'pack')
+        self._fetch(url, True, b'pack')
+
+        # the file changed (and so did its mtime)
+        self._write_file('pack.zip', b'pack v2')
+        os.utime(path, (0, 0))
+        self._fetch(url, False, b'pack v2')
+        self._fetch(url, True, b'pack v2')
+
+    def test_http_etag(self):
+        self._write_file('pack.zip', b'pack')
+        base_url, handler = self._start_server(
+            etag='"1"', send_last_modified=False
+        )
+        self._fetch(base_url + 'pack.zip', False, b'pack')
+        self._fetch(base_url + 'pack.zip#fragment', True, b'pack')
+
+        self._write_file('pack.zip', b'pack v2')
+        handler.etag = '"2"'
+        self._fetch(base_url + 'pack.zip', False, b'pack v2')
+
+    def test_no_validators(self):
+        # responses we can't tell apart from a changed file aren't cached
+        self._write_file('pack.zip', b'pack')
+        base_url, _ = self._start_server(send_last_modified=False)
+        self._fetch(base_url + 'pack.zip', False, b'pack')
+        self._fetch(base_url + 'pack.zip', False, b'pack')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.media_root, 'download_cache')
+        ))
+
+    def test_cache_disabled(self):
+        url = 'file://' + self._write_file('pack.zip', b'pack')
+        with self.settings(DOWNLOAD_CACHE_MAX_BYTES=0):
+            self._fetch(url, False, b'pack')
+            self._fetch(url, False, b'pack')
+
+    def test_eviction(self):
+        urls = {
+            name: 'file://' + self._write_file(name, bytes(400))
+            for name in ('a', 'b', 'c')
+        }
+        self._fetch(urls['a'], False, bytes(400))
+        self._fetch(urls['b'], False, bytes(400))
+        # a is now more recently used than b
+        for i, entry in enumerate(sorted(
+            self._get_cache_entries(),
+            key=lambda name: os.path.getmtime(
+                os.path.join(self.media_root, 'download_cache', name)
+            )
+        )):
+            os.utime(
+                os.path.join(self.media_root, 'download_cache', entry),
+                (1000 + i, 1000 + i)
+            )
+        self._fetch(urls['a'], True, bytes(400))
+        self._fetch(urls['c'], False, bytes(400))
+        self.assertEqual(2, len(self._get_cache_entries()))
+        self._fetch(urls['a'], True, bytes(400))
+        self._fetch(urls['c'], True, bytes(400))
+        self._fetch(urls['b'], False, bytes(400))
+
+    def test_normalize_url(self):
+        self.assertEqual(
+            normalize_url('https://www.dropbox.com/s/abc/pack.zip?dl=0'),
+            normalize_url('HTTPS://WWW.dropbox.com/s/abc/pack.zip?dl=1#x')
+        )
+        self.assertEqual(
+            normalize_url('https://example.com/pack.zip?b=2&a=1'),
+            normalize_url('https://example.com/pack.zip?a=1&b=2')
+        )
+        self.assertNotEqual(
+            normalize_url('https://example.com/Pack.zip'),
+            normalize_url('https://example.com/pack.zip')
+        )
+
+    @patch('itgdb_site.tasks.ProgressTracker')
+    @patch('itgdb_site.tasks.upload_pack')
+    def test_task_progress_message(self, mock_upload_pack, mock_prog):
+        os.makedirs(os.path.join(self.media_root, 'extracted'))
+        archive_path = shutil.copy(
+            os.path.join(
+                TEST_BASE_DIR, 'pack_archives', 'ProcessPackFromWeb_1_pack.zip'
+            ),
+            self.files_path
+        )
+        pack_data_list = [{
+            'name': 'pack1',
+            'author': '',
+            'release_date': None,
+            'release_date_year_only': False,
+            'category': None,
+            'tags': [],
+            'links': ''
+        }]
+        messages = []
+        logging.disable(logging.CRITICAL)
+        try:
+            with self.settings(DOWNLOAD_CACHE_MAX_BYTES=1024 * 1024):
+                for _ in range(2):
+                    task = process_pack_from_web.s(
+                        pack_data_list, 'file://' + archive_path
+                    ).apply()
+                    self.assertEqual('SUCCESS', task.status)
+                    messages.append([
+                        c.args[1] for c in
+                        mock_prog.return_value.update_progress.call_args_list
+                    ])
+                    mock_prog.reset_mock()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertTrue(any('download cache miss' in m for m in messages[0]))
+        self.assertTrue(any('download cache hit' in m for m in messages[1]))
+        self.assertFalse(os.listdir(os.path.join(self.media_root, 'packs')))
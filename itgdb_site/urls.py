@@ -7,6 +7,7 @@ urlpatterns = [
     path('', views.IndexView.as_view(), name='index'),
     path('packs/<int:pk>/', views.PackDetailView.as_view(), name='pack_detail'),
     path('songs/<int:pk>/', views.SongDetailView.as_view(), name='song_detail'),
+    path('songs/<int:pk>/simfile/', views.SongSimfileView.as_view(), name='song_simfile'),
     path('pack_search/', views.PackSearchView.as_view(), name='pack_search'),
     path('song_search/', views.SongSearchView.as_view(), name='song_search'),
     path('chart_search/', views.ChartSearchView.as_view(), name='chart_search'),
@@ -1 +1,2 @@
-from .analyzer import SongAnalyzer, ChartAnalyzer, get_chart_key
\ No newline at end of file
+from .analyzer import SongAnalyzer, ChartAnalyzer, ChartAnalysis, get_chart_key
+from .cache import AnalysisCache
@@ -4,21 +4,28 @@ My main reason for using classes here is so that I can more easily cache certain
 expensive-to-compute results, hence the @cached_property decorators.
 """
 
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+from django.conf import settings
+import hashlib
 from typing import Dict, List, Tuple, Iterable, FrozenSet, Iterator
 from dataclasses import dataclass
-from itertools import zip_longest
 from functools import cached_property
 from math import isclose
-from fractions import Fraction
+import numpy as np
 from simfile.types import Chart, Simfile
 from simfile.notes import NoteData, NoteType, Note
 from simfile.notes.group import group_notes, SameBeatNotes, OrphanedNotes, NoteWithTail, GroupedNotes
 from simfile.notes.count import *
 from simfile.timing import TimingData, BeatValues, BeatValue, Beat
-from simfile.timing.displaybpm import displaybpm
 from simfile.timing.engine import TimingEngine
+from simfile.timing._private.timingsource import timing_source
 from ...models import Chart as ChartModel
+from .note_matrix import NoteMatrix, ROW_TICKS_PER_BEAT
+from .tokenizer import NoteTokens
+from .timing import BatchTimingEngine
+from .intervals import IntervalSet
+from .measures import MeasureCounts, MeasureCountsBuilder, MeasureTimes
+from .streaming import analyze_in_chunks, BYTES_PER_NOTE_DATA_CHAR
 
 
 DEFAULT_GROUP_NOTE_TYPES = frozenset((
@@ -43,6 +50,11 @@ ALL_NOTE_TYPES = frozenset(( # or at least all the ones we care about
     NoteType.MINE,
     NoteType.FAKE,
 ))
+STREAM_NOTE_TYPES = frozenset((
+    NoteType.TAP,
+    NoteType.HOLD_HEAD,
+    NoteType.ROLL_HEAD,
+))
 
 
 def get_chart_key(chart: Chart) -> Tuple[str]:
@@ -60,26 +72,136 @@ def get_chart_key(chart: Chart) -> Tuple[str]:
     return (steps_type, diff)
 
 
+def get_timing_digest(sim: Simfile, chart: Chart | None) -> str:
+    """Given a simfile and (optionally) a chart, returns a digest of the
+    timing fields that apply to the chart. Charts with the same digest have
+    the same timing data.
+    """
+    # NOTE: timing_source() isn't part of the simfile library's public API,
+    # but it's how TimingData decides between the song and chart timing
+    source = timing_source(sim, chart)
+    fields = (
+        source.bpms, source.stops, source.delays, source.get('WARPS'),
+        source.offset
+    )
+    return hashlib.sha1(repr(fields).encode()).hexdigest()
+
+
+# the version of the code computing each analysis component stored in the
+# database. bump a component's version whenever a change to the analysis code
+# changes its results, so that results computed by an older version get
+# recomputed (see the reanalyze_outdated task) and don't get reused from the
+# cache (see cache.py)
+ANALYZER_VERSIONS = {
+    # stored in Chart
+    'counts': 1,
+    # 2: results cached before the digest included the chart length could
+    # have the wrong end point
+    'density_graph': 2,
+    'stream_info': 1,
+    # generated from stream_info (see breakdown.py), also stored in Chart
+    'breakdowns': 1,
+    # stored in Song
+    'chart_length': 1,
+}
+CHART_ANALYSIS_COMPONENTS = ('counts', 'density_graph', 'stream_info')
+
+
+def get_analysis_digest(sim: Simfile, chart: Chart, chart_len: float) -> str:
+    """Given a simfile, a chart and the song's chart length (see
+    SongAnalyzer.chart_len, which is where the density graph ends), returns a
+    digest of everything that goes into the chart's analysis results: the
+    notes, the effective timing data (including fakes), the chart length and
+    the analyzer versions. Charts with the same digest have the same analysis
+    results.
+    """
+    fields = (
+        tuple(ANALYZER_VERSIONS[c] for c in CHART_ANALYSIS_COMPONENTS),
+        (chart.stepstype or '').strip().lower(),
+        chart.notes,
+        get_timing_digest(sim, chart),
+        chart.get('FAKES') or sim.get('FAKES'),
+        chart_len,
+    )
+    return hashlib.sha256(repr(fields).encode()).hexdigest()
+
+
 @dataclass
 class StreamRun:
     start: int
     len: int
 
 
+@dataclass
+class ChartAnalysis:
+    """All the statistics of a chart that get stored in the database."""
+    counts: Dict[str, int]
+    density_graph: list
+    stream_info: dict
+
+
 BPMRange = tuple[float | Decimal, float | Decimal] | tuple[None, None]
 
+# analysis backends:
+# - 'numpy': parse each chart once into a NoteMatrix and compute statistics
+#   with vectorized operations
+# - 'simfile': iterate through the chart's Note objects using the simfile
+#   library's grouping routines (slower, but kept as a reference)
+BACKENDS = ('numpy', 'simfile')
+DEFAULT_BACKEND = 'numpy'
+
+
+class ChartTiming:
+    """The timing data of a chart, along with the timing engines built from
+    it. Charts with the same effective timing share a single instance (see
+    SongAnalyzer.get_timing())."""
+
+    def __init__(self, timing_data: TimingData):
+        # filter out 0 bpm segments to prevent problems down the line,
+        # and also to match stepmania's behavior
+        timing_data.bpms = BeatValues(
+            bpm for bpm in timing_data.bpms if bpm.value != 0
+        )
+        self.timing_data = timing_data
+
+    @cached_property
+    def engine(self) -> TimingEngine:
+        return TimingEngine(self.timing_data)
+
+    @cached_property
+    def batch_engine(self) -> BatchTimingEngine:
+        return BatchTimingEngine(self.engine)
+
+    @cached_property
+    def warp_regions(self) -> IntervalSet | None:
+        return IntervalSet.from_warps(self.engine)
+
 
 class SongAnalyzer:
     """A class facilitating the analysis of songs."""
 
-    def __init__(self, sim: Simfile):
+    def __init__(
+        self,
+        sim: Simfile,
+        backend: str = DEFAULT_BACKEND,
+        memory_ceiling: int | None = None
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f'unknown analysis backend {backend}')
         self.sim = sim
-        self.chart_analyzers: Dict[tuple, ChartAnalyzer] = {}
+        self.backend = backend
+        # charts too big to analyze all at once within this many bytes get
+        # analyzed in chunks (see streaming.py). 0 means no ceiling
+        if memory_ceiling is None:
+            memory_ceiling = settings.ANALYSIS_MEMORY_CEILING
+        self.memory_ceiling = memory_ceiling
+        self.charts: Dict[tuple, Chart] = {}
         for chart in sim.charts:
-            key = get_chart_key(chart)
             # don't overwrite if already present
-            if key not in self.chart_analyzers:
-                self.chart_analyzers[key] = ChartAnalyzer(chart, self)
+            self.charts.setdefault(get_chart_key(chart), chart)
+        # chart analyzers and timing data are created as needed
+        self.chart_analyzers: Dict[tuple, ChartAnalyzer] = {}
+        self.timings: Dict[str, ChartTiming] = {}
 
     @cached_property
     def chart_len(self) -> float:
@@ -91,9 +213,7 @@ class SongAnalyzer:
         # init charts' end as the LASTSECONDHINT value
         chart_end = float(self.sim.get('LASTSECONDHINT', '0'))
         
-        for analyzer in self.chart_analyzers.values():
-            chart = analyzer.chart
-
+        for key, chart in self.charts.items():
             # NOTE: it is intended behavior for the chart length to be affected
             # by charts with stepstype that are not 4/8-panel-based (e.g. pump)
             # -- see the test_longer_chart test case.
@@ -107,16 +227,28 @@ class SongAnalyzer:
             if chart.difficulty.lower() == 'edit' and len(self.sim.charts) > 1:
                 continue
 
+            analyzer = self._get_chart_analyzer_by_key(key)
             if analyzer.last_note_beat:
-                last_note_time = analyzer.engine.time_at(
-                    analyzer.last_note_beat
-                )
-                chart_end = max(chart_end, last_note_time)
+                chart_end = max(chart_end, analyzer.last_note_time)
         
         return chart_end
     
+    def _get_chart_analyzer_by_key(self, key: tuple) -> 'ChartAnalyzer':
+        if key not in self.chart_analyzers:
+            self.chart_analyzers[key] = ChartAnalyzer(self.charts[key], self)
+        return self.chart_analyzers[key]
+
     def get_chart_analyzer(self, chart: Chart) -> 'ChartAnalyzer':
-        return self.chart_analyzers[get_chart_key(chart)]
+        return self._get_chart_analyzer_by_key(get_chart_key(chart))
+
+    def get_timing(self, chart: Chart | None) -> ChartTiming:
+        """Get the timing data for the given chart (or the song's timing data
+        if chart is None). Parsed timing data and engines are reused between
+        charts with the same effective timing."""
+        digest = get_timing_digest(self.sim, chart)
+        if digest not in self.timings:
+            self.timings[digest] = ChartTiming(TimingData(self.sim, chart))
+        return self.timings[digest]
     
     def get_chart_len(self):
         return self.chart_len
@@ -125,59 +257,58 @@ class SongAnalyzer:
         """Get the actual and the displayed BPM ranges for this simfile."""
 
         sim = self.sim
+        if sim.bpms is not None:
+            return self._get_bpm_ranges(None)
 
-        # bit of a hack: temporarily filter out 0 bpm segments to match the 
-        # behavior of stepmania
-        def _filter_out_0bpm_segs(bpms):
-            return str(BeatValues(
-                bpm for bpm in BeatValues.from_str(bpms) if bpm.value != 0
-            ))
-        old_bpms = sim.bpms
-        if old_bpms is not None:
-            sim.bpms = _filter_out_0bpm_segs(old_bpms)
-
-        try:
-            bpm = displaybpm(sim, ignore_specified=True)
-            disp = displaybpm(sim)
-            bpm_range = (bpm.min, bpm.max)
-            disp_range = (disp.min, disp.max)
-        except KeyError:
-            # if the simfile has no main #BPMS field, use a chart's #BPMS instead.
-            # first, figure out which chart to use.
-            # prioritize singles and higher difficulties (but leave edits for last)
-            # TODO: this might be overcomplicated for handling a case this rare.
-            # take another look later
-            chart_keys = [get_chart_key(chart) for chart in sim.charts]
-            chart_keys = sorted(
-                # filter out unknown stepstype
-                filter(
-                    lambda k: ChartModel.steps_type_to_int(k[0]) is not None,
-                    chart_keys
-                ),
-                key=lambda k: (
-                    ChartModel.steps_type_to_int(k[0]), # singles=1 < doubles=2
-                    -k[1] if k[1] <= 4 else k[1]   # diffs: -4, -3, -2, -1, 0, 5
-                )
+        # if the simfile has no main #BPMS field, use a chart's #BPMS instead.
+        # first, figure out which chart to use.
+        # prioritize singles and higher difficulties (but leave edits for last)
+        # TODO: this might be overcomplicated for handling a case this rare.
+        # take another look later
+        chart_keys = sorted(
+            # filter out unknown stepstype
+            filter(
+                lambda k: ChartModel.steps_type_to_int(k[0]) is not None,
+                self.charts.keys()
+            ),
+            key=lambda k: (
+                ChartModel.steps_type_to_int(k[0]), # singles=1 < doubles=2
+                -k[1] if k[1] <= 4 else k[1]   # diffs: -4, -3, -2, -1, 0, 5
             )
-            bpm, disp = None, None
-            if len(chart_keys) > 0:
-                chart_analyzer = self.chart_analyzers[chart_keys[0]]
-                chart = chart_analyzer.chart
-                old_chart_bpms = chart.get('BPMS')
-                if old_chart_bpms is not None:
-                    chart.bpms = _filter_out_0bpm_segs(old_chart_bpms)
-                    # this shouldn't KeyError this time
-                    bpm = displaybpm(sim, chart, ignore_specified=True)
-                    disp = displaybpm(sim, chart)
-                    chart.bpms = old_chart_bpms # restore
-            if bpm is not None:
-                bpm_range = (bpm.min, bpm.max)
-                disp_range = (disp.min, disp.max)
-            else:
-                bpm_range = (60, 60)
-                disp_range = (60, 60)
+        )
+        if len(chart_keys) > 0:
+            chart = self.charts[chart_keys[0]]
+            if chart.get('BPMS') is not None:
+                return self._get_bpm_ranges(chart)
+        return (60, 60), (60, 60)
+
+    def _get_bpm_ranges(
+        self, chart: Chart | None
+    ) -> tuple[BPMRange, BPMRange]:
+        """Get the actual and displayed BPM ranges from the timing source
+        of the given chart (same as simfile's displaybpm())."""
+        # the parsed timing data already has 0 bpm segments filtered out,
+        # matching the behavior of stepmania
+        bpms = [
+            bpm.value for bpm in self.get_timing(chart).timing_data.bpms
+        ]
+        bpm_range = (min(bpms), max(bpms))
 
-        sim.bpms = old_bpms # restore
+        properties = timing_source(self.sim, chart)
+        disp_range = bpm_range
+        if 'DISPLAYBPM' in properties:
+            displaybpm_value = properties['DISPLAYBPM']
+            try:
+                if displaybpm_value == '*':
+                    disp_range = (None, None)
+                elif ':' in displaybpm_value:
+                    min_bpm, _, max_bpm = displaybpm_value.partition(':')
+                    disp_range = (Decimal(min_bpm), Decimal(max_bpm))
+                else:
+                    disp_range = (Decimal(displaybpm_value),) * 2
+            except InvalidOperation:
+                # ignore decimal errors and use the song bpm
+                pass
 
         return bpm_range, disp_range
 
@@ -202,15 +333,20 @@ class ChartAnalyzer:
             notes_str = ('0' * columns + '\n') * 4
             self.notes = NoteData(notes_str)
 
-        timing_data = TimingData(self.sim, chart)
-        # filter out 0 bpm segments to prevent problems down the line,
-        # and also to match stepmania's behavior
-        timing_data.bpms = BeatValues(
-            bpm for bpm in timing_data.bpms if bpm.value != 0
-        )
-        self.engine = TimingEngine(timing_data)
+        self.timing = song_analyzer.get_timing(chart)
+        self.engine = self.timing.engine
 
         self.song_analyzer = song_analyzer
+        # the numpy backend doesn't handle routine charts, so fall back to
+        # the simfile backend for those
+        self.backend = song_analyzer.backend
+        if self.backend == 'numpy' and \
+            not NoteMatrix.supports(str(self.notes)):
+            self.backend = 'simfile'
+
+        memory_ceiling = song_analyzer.memory_ceiling
+        self.streaming = memory_ceiling > 0 and \
+            len(str(self.notes)) * BYTES_PER_NOTE_DATA_CHAR > memory_ceiling
 
     @cached_property
     def fake_segments(self) -> List[BeatValue]:
@@ -233,6 +369,87 @@ class ChartAnalyzer:
             return fake_segs
         return []
 
+    @cached_property
+    def batch_engine(self) -> BatchTimingEngine:
+        return self.timing.batch_engine
+
+    @cached_property
+    def num_measures(self) -> int:
+        """The number of measures in the chart, up to and including the
+        measure containing the last note."""
+        if self.last_note_beat is None:
+            return 1
+        return self.last_note_beat // 4 + 1
+
+    @cached_property
+    def measure_times(self) -> MeasureTimes:
+        """The song times of the chart's measure boundaries (computed as
+        needed), i.e. the times at beats 0, 4, 8, etc."""
+        return MeasureTimes(self.batch_engine)
+
+    @cached_property
+    def last_note_time(self) -> float | None:
+        if self.last_note_beat is None:
+            return None
+        return float(self.batch_engine.times_at([self.last_note_beat])[0])
+
+    @cached_property
+    def note_tokens(self) -> NoteTokens | None:
+        """The tokenized note data, or None if it can't be tokenized (i.e. if
+        this is a routine chart) or is too big to keep in memory at once."""
+        if self.streaming or not NoteMatrix.supports(str(self.notes)):
+            return None
+        return NoteTokens(str(self.notes))
+
+    @cached_property
+    def note_matrix(self) -> NoteMatrix:
+        return NoteMatrix(self.note_tokens)
+
+    @cached_property
+    def fake_regions(self) -> IntervalSet:
+        return IntervalSet.from_fake_segments(self.fake_segments)
+
+    @cached_property
+    def unhittable_regions(self) -> IntervalSet | None:
+        """The regions of beats where notes can't be hit, i.e. warps and fake
+        segments. None if the chart's timing data is too weird to represent
+        the warps this way (see IntervalSet.from_warps())."""
+        warp_regions = self.timing.warp_regions
+        if warp_regions is None:
+            return None
+        return warp_regions | self.fake_regions
+
+    def _is_hittable(self, beat: Beat) -> bool:
+        if self.unhittable_regions is not None:
+            return beat not in self.unhittable_regions
+        return self.engine.hittable(beat) and beat not in self.fake_regions
+
+    def _rows_in_regions(
+        self, note_matrix: NoteMatrix, regions: IntervalSet
+    ) -> np.ndarray:
+        """Get a boolean mask of which rows in the note matrix lie in the
+        given regions."""
+        mask = regions.contains_ticks(
+            note_matrix.row_ticks, ROW_TICKS_PER_BEAT
+        )
+        # rows that aren't on the tick grid need an exact check
+        for i in np.flatnonzero(~note_matrix.row_on_grid):
+            mask[i] = note_matrix.row_beat(i) in regions
+        return mask
+
+    @cached_property
+    def hittable_rows(self) -> np.ndarray:
+        """A boolean mask of which rows in self.note_matrix are hittable."""
+        return self._get_hittable_rows(self.note_matrix)
+
+    def _get_hittable_rows(self, note_matrix: NoteMatrix) -> np.ndarray:
+        if self.unhittable_regions is not None:
+            return ~self._rows_in_regions(note_matrix, self.unhittable_regions)
+        mask = ~self._rows_in_regions(note_matrix, self.fake_regions)
+        for i in np.flatnonzero(mask):
+            mask[i] = self.engine.hittable(note_matrix.row_beat(i))
+        return mask
+
     @cached_property
     def hittables(self) -> List[GroupedNotes]:
         """A list of all objects in the chart that land on a hittable beat,
@@ -246,21 +463,13 @@ class ChartAnalyzer:
         # the notedata iteration process multiple times. memory will
         # take a hit but i think it'll be fine
         def generator():
-            start_idx = -1
             group_iterator = self._group_notes_no_orphans(
                 self.notes,
                 include_note_types=ALL_NOTE_TYPES
             )
             for grouped_notes in group_iterator:
-                beat = grouped_notes[0].beat
-                if not self.engine.hittable(beat):
-                    continue
-                else:
-                    in_fake_seg, start_idx = self._is_in_fake_segment(
-                        beat, start_idx
-                    )
-                    if not in_fake_seg:
-                        yield grouped_notes
+                if self._is_hittable(grouped_notes[0].beat):
+                    yield grouped_notes
 
         return list(generator())
     
@@ -271,39 +480,30 @@ class ChartAnalyzer:
         ))
 
     @cached_property
-    def notes_per_measure(self) -> List[int]:
+    def notes_per_measure(self) -> MeasureCounts:
+        if self.streaming:
+            return self._streamed_stats[1]
+        if self.backend == 'numpy':
+            return self.note_matrix.get_notes_per_measure(self.hittable_rows)
+
         grouped_notes = self._filter_groups_by_type(
-            self.hittables, frozenset((
-                NoteType.TAP,
-                NoteType.HOLD_HEAD,
-                NoteType.ROLL_HEAD,
-            ))
+            self.hittables, STREAM_NOTE_TYPES
         )
 
         # get number of notes per measure
-        count_per_measure = []
-        cur_measure_start = 0
-        cur_measure_count = 0
+        builder = MeasureCountsBuilder()
         for note_row in grouped_notes:
-            beat = note_row[0].beat
-            # if we've exited the current measure,
-            # finish the count for that measure and advance
-            if beat >= cur_measure_start + 4:
-                count_per_measure.append(cur_measure_count)
-                cur_measure_count = 0
-                cur_measure_start += 4
-                while beat - cur_measure_start >= 4:
-                    count_per_measure.append(0)
-                    cur_measure_start += 4
-            cur_measure_count += 1
-        # append final measure
-        count_per_measure.append(cur_measure_count)
-
-        return count_per_measure
+            builder.add(note_row[0].beat)
+        return builder.build()
 
     @cached_property
     def last_note_beat(self) -> Beat:
         """The beat value of the last note/mine/object in the chart."""
+        if self.streaming:
+            return self._streamed_stats[2]
+        if self.backend == 'numpy':
+            return self.note_matrix.last_note_beat
+
         # get the last note by exhausting the iterator
         last_note = None
         for last_note in self.notes:
@@ -312,30 +512,98 @@ class ChartAnalyzer:
             return None
         return last_note.beat
 
-    def _is_in_fake_segment(
-            self, beat: Beat, start_idx: int
-    ) -> Tuple[bool, int]:
-        """Checks whether the given beat lands within a fake segment.
-
-        start_idx is the index into self.fake_segments where we should start
-        searching. start_idx must be <= the index of the last segment with
-        start time <= the given beat. start_idx should initially be -1
-        (meaning no fake segments are before the given beat).
-
-        Returns the result of the check, and a new value of start_idx to use
-        for next time.
-        """
-        # advance start_idx to the last segment with start time <= beat
-        while start_idx < len(self.fake_segments) - 1 \
-            and self.fake_segments[start_idx + 1].beat <= beat:
-            start_idx += 1
-        result = False
-        if start_idx >= 0:
-            # check if inside this segment
-            seg = self.fake_segments[start_idx]
-            result = beat < seg.beat + Fraction(seg.value)
-        return result, start_idx
-    
+    @cached_property
+    def _single_pass_stats(
+        self
+    ) -> Tuple[Dict[str, int], MeasureCounts, Beat]:
+        """Compute the notecounts, notes_per_measure, and last_note_beat
+        with a single pass through the note data (simfile backend only).
+
+        The results are the same as those from get_counts() and the
+        notes_per_measure/last_note_beat properties, which each go through
+        the note data separately."""
+        last_note = None
+        def note_stream():
+            # keep track of the last note (including the notes that get
+            # filtered out by group_notes(), like tails and keysounds)
+            nonlocal last_note
+            for last_note in self.notes:
+                yield last_note
+
+        counts = dict.fromkeys((
+            'objects', 'steps', 'combo', 'jumps', 'mines', 'hands', 'holds',
+            'rolls', 'lifts', 'fakes'
+        ), 0)
+        tail_beats = [None] * self.notes.columns
+        measure_counts = MeasureCountsBuilder()
+
+        group_iterator = self._group_notes_no_orphans(
+            note_stream(),
+            include_note_types=ALL_NOTE_TYPES
+        )
+        for group in group_iterator:
+            # objects and fakes are counted regardless of hittability
+            counts['objects'] += len(group)
+            counts['fakes'] += sum(
+                note.note_type == NoteType.FAKE for note in group
+            )
+
+            beat = group[0].beat
+            if not self._is_hittable(beat):
+                continue
+
+            counts['mines'] += sum(
+                note.note_type == NoteType.MINE for note in group
+            )
+            combo_notes = [
+                note for note in group
+                if note.note_type in COMBO_INCREASING_NOTE_TYPES
+            ]
+            if combo_notes:
+                counts['steps'] += 1
+                counts['combo'] += len(combo_notes)
+                counts['jumps'] += len(combo_notes) >= 2
+                for note in combo_notes:
+                    if note.note_type == NoteType.HOLD_HEAD:
+                        counts['holds'] += 1
+                    elif note.note_type == NoteType.ROLL_HEAD:
+                        counts['rolls'] += 1
+                    elif note.note_type == NoteType.LIFT:
+                        counts['lifts'] += 1
+                # same as _count_hands()
+                for i, tail_beat in enumerate(tail_beats):
+                    if tail_beat and tail_beat < beat:
+                        tail_beats[i] = None
+                active_holds_count = sum(t is not None for t in tail_beats)
+                if active_holds_count + len(combo_notes) > 2:
+                    counts['hands'] += 1
+                for note in combo_notes:
+                    if isinstance(note, NoteWithTail):
+                        tail_beats[note.column] = note.tail_beat
+
+            # same as notes_per_measure
+            if any(note.note_type in STREAM_NOTE_TYPES for note in group):
+                measure_counts.add(beat)
+
+        last_note_beat = last_note.beat if last_note is not None else None
+        return counts, measure_counts.build(), last_note_beat
+
+    @cached_property
+    def _streamed_stats(
+        self
+    ) -> Tuple[Dict[str, int], MeasureCounts, Beat]:
+        """Compute the notecounts, notes_per_measure, and last_note_beat
+        within the memory ceiling, for charts that are too big to analyze all
+        at once."""
+        if NoteMatrix.supports(str(self.notes)):
+            return analyze_in_chunks(
+                str(self.notes),
+                self.song_analyzer.memory_ceiling // BYTES_PER_NOTE_DATA_CHAR,
+                self._get_hittable_rows
+            )
+        # the single pass only keeps fixed-size state around anyway
+        return self._single_pass_stats
+
     @staticmethod
     def _group_notes_no_orphans(
         notes: Iterable[Note],
@@ -414,6 +682,80 @@ class ChartAnalyzer:
         
         return hands_count
 
+    def _find_stream_runs(
+        self, measure_bpms: Dict[int, float], quants: Tuple[int]
+    ) -> Tuple[Dict[int, List[StreamRun]], Dict[int, float], Dict[int, float]]:
+        """Find the stream runs for each of the given quants, along with the
+        min/max bpm of the stream measures."""
+        stream_runs = {q: [] for q in quants}
+        # keep track of measure bpms ourselves (i'd like to not rely on 
+        # displaybpm, see e.g. "Stamina RPG 7 - FE/Burning Throb")
+        min_bpm = {q: None for q in quants}
+        max_bpm = {q: None for q in quants}
+        counts = self.notes_per_measure
+        for i, count in zip(counts.measures, counts.counts):
+            for q in quants:
+                if count >= q:
+                    # this is a stream measure
+                    bpm = measure_bpms[i]
+                    runs = stream_runs[q]
+                    # can we extend the last stream run to include
+                    # this measure?
+                    if runs and runs[-1].start + runs[-1].len == i:
+                        runs[-1].len += 1
+                    # if not, create a new stream run
+                    else:
+                        runs.append(StreamRun(i, 1))
+                
+                    if min_bpm[q] is None:
+                        # neither min_bpm nor max_bpm has been populated
+                        # yet; populate them now
+                        min_bpm[q] = bpm
+                        max_bpm[q] = bpm
+                    else:
+                        min_bpm[q] = min(min_bpm[q], bpm)
+                        max_bpm[q] = max(max_bpm[q], bpm)
+
+        return stream_runs, min_bpm, max_bpm
+
+    def _find_stream_runs_vectorized(
+        self, measure_bpms: Dict[int, float], quants: Tuple[int]
+    ) -> Tuple[Dict[int, List[StreamRun]], Dict[int, float], Dict[int, float]]:
+        """Same as _find_stream_runs(), but using vectorized operations."""
+        counts = self.notes_per_measure
+        measures = np.array(counts.measures, dtype=np.int64)
+        measure_counts = np.array(counts.counts, dtype=np.int64)
+
+        stream_runs = {}
+        min_bpm = {}
+        max_bpm = {}
+        for q in quants:
+            stream_measures = measures[measure_counts >= q]
+            # a new run starts wherever the stream measures aren't
+            # consecutive
+            is_run_start = np.ones(len(stream_measures), dtype=bool)
+            is_run_start[1:] = np.diff(stream_measures) != 1
+            run_starts = np.flatnonzero(is_run_start)
+            run_lens = np.diff(np.append(run_starts, len(stream_measures)))
+            stream_runs[q] = [
+                StreamRun(int(stream_measures[start]), int(len_))
+                for start, len_ in zip(run_starts, run_lens)
+            ]
+            if len(stream_measures) > 0:
+                # keep the original bpm values around so the min/max bpms we
+                # return are the exact same objects as in _find_stream_runs().
+                # argmin/argmax return the first occurrence of the min/max,
+                # matching the behavior of the builtin min()/max()
+                bpm_values = [measure_bpms[i] for i in stream_measures.tolist()]
+                bpms = np.array(bpm_values, dtype=np.float64)
+                min_bpm[q] = bpm_values[np.argmin(bpms)]
+                max_bpm[q] = bpm_values[np.argmax(bpms)]
+            else:
+                min_bpm[q] = None
+                max_bpm[q] = None
+
+        return stream_runs, min_bpm, max_bpm
+
     def get_counts(self) -> Dict[str, int]:
         """Get notecount statistics for a chart."""
         # NOTE: stepmania discard orphaned hold heads, but there's currently 
@@ -428,6 +770,10 @@ class ChartAnalyzer:
         #     same_beat_notes=SameBeatNotes.KEEP_SEPARATE
         # ):
         #     print(n)
+        if self.streaming:
+            return self._streamed_stats[0].copy()
+        if self.backend == 'numpy':
+            return self.note_matrix.get_counts(self.hittable_rows)
 
         return {
             'objects': sum(1 for _ in self._group_notes_no_orphans(
@@ -472,12 +818,29 @@ class ChartAnalyzer:
             else:
                 nps_data.append([time, nps])
         
+        measure_counts = self.notes_per_measure
+        measure_times = self.measure_times
+        num_measures = len(measure_counts)
+        runs = list(measure_counts.runs())
+        # fetch the measure times we're (probably) going to need all at once.
+        # for long runs of empty measures, we only need the times near the
+        # ends (see below)
+        needed_times = [num_measures]
+        for start, end, _ in runs:
+            if end - start <= 8:
+                needed_times.extend(range(start, end + 1))
+            else:
+                needed_times.extend((start, start + 1, end - 1, end))
+        measure_times.prefetch(needed_times)
+
         # get nps for each measure, assemble final graph data
-        start_t = self.engine.time_at(Beat(0))
+        min_measure_len = 0.12
+        start_t = measure_times[0]
         deferred_count = 0 # count of notes not put in the graph yet
-        for i, count in enumerate(self.notes_per_measure):
-            end_beat = Beat((i + 1) * 4)
-            end_t = self.engine.time_at(end_beat)
+
+        def add_measure(i, count):
+            nonlocal start_t, deferred_count
+            end_t = measure_times[i + 1]
             measure_len = end_t - start_t
             # as it turns out, time_at() is not necessary monotonic w.r.t. beat #,
             # so we should check if measure is of positive length and only
@@ -488,7 +851,7 @@ class ChartAnalyzer:
             # that can inflate the NPS. so here, if the measure does not meet a
             # certain length, we defer calculating the NPS until we
             # accumulate more time from future measures
-            if measure_len > 0.12:
+            if measure_len > min_measure_len:
                 # calculate the NPS, including notes deferred from previous
                 # skipped measures
                 nps = (count + deferred_count) / measure_len
@@ -500,13 +863,43 @@ class ChartAnalyzer:
             # defer its count until later
             else:
                 deferred_count += count
+
+        for start, end, count in runs:
+            if count > 0:
+                add_measure(start, count)
+                continue
+            # this is a run of empty measures. where the timing is steady,
+            # every measure gets its own 0 nps point, and each one after the
+            # first would just move the last point forward (see
+            # append_point()). so we skip to the end of those stretches,
+            # only adding the points that would remain
+            i = start
+            for c, d in measure_times.steady_ranges(
+                start, end, min_measure_len
+            ):
+                while i < c:
+                    add_measure(i, 0)
+                    i += 1
+                # make sure the previous measure was long enough to
+                # advance start_t up to here
+                while i < d and start_t != measure_times[i]:
+                    add_measure(i, 0)
+                    i += 1
+                if d - i >= 2:
+                    add_measure(i, 0)
+                    append_point(measure_times[i + 1], 0.0)
+                    if d - i >= 3:
+                        append_point(measure_times[d - 1], 0.0)
+                    start_t = measure_times[d]
+                    i = d
+            while i < end:
+                add_measure(i, 0)
+                i += 1
         # in the rare case where there are still deferred counts at the end,
         # let's just ditch them
 
         # add 0 nps point right after last measure
-        beat = Beat(len(self.notes_per_measure) * 4)
-        time = self.engine.time_at(beat)
-        append_point(time, 0)
+        append_point(measure_times[num_measures], 0)
 
         # add 0 nps point at *very* end of song:
         chart_len = self.song_analyzer.chart_len
@@ -526,52 +919,43 @@ class ChartAnalyzer:
                 'total_break': 0
             }
 
-        # calculate the bpm of each measure based on the measure's duration
-        measure_bpms = []
-        num_measures = self.last_note_beat // 4 + 1
-        start_t = self.engine.time_at(Beat(0))
-        for i in range(num_measures):
-            end_beat = Beat((i + 1) * 4)
-            end_t = self.engine.time_at(end_beat)
-            measure_len = end_t - start_t
+        # try to build up stream runs for all the following quants
+        quants = (32, 24, 20, 16)
+        num_measures = self.num_measures
+
+        # calculate the bpm of each measure based on the measure's duration.
+        # we only need the bpms of measures that could be stream measures
+        counts = self.notes_per_measure
+        stream_measures = [
+            measure for measure, count in zip(counts.measures, counts.counts)
+            if count >= min(quants)
+        ]
+        measure_times = self.measure_times
+        measure_times.prefetch(stream_measures)
+        measure_times.prefetch(measure + 1 for measure in stream_measures)
+        measure_bpms = {}
+        for i in stream_measures:
+            if i >= num_measures:
+                # can happen with routine charts, whose last note isn't
+                # necessarily in the last measure
+                measure_bpms[i] = 0
+                continue
+            measure_len = measure_times[i + 1] - measure_times[i]
             if measure_len != 0:
-                measure_bpms.append(240 / measure_len) # convert length to bpm
+                measure_bpms[i] = 240 / measure_len # convert length to bpm
             else:
                 # fallback to avoid division by 0
-                measure_bpms.append(0)
-            start_t = end_t
-        
-        # try to build up stream runs for all the following quants
-        quants = (32, 24, 20, 16)
-        stream_runs = {q: [] for q in quants}
-        # keep track of measure bpms ourselves (i'd like to not rely on 
-        # displaybpm, see e.g. "Stamina RPG 7 - FE/Burning Throb")
-        min_bpm = {q: None for q in quants}
-        max_bpm = {q: None for q in quants}
-        for i, (count, bpm) in enumerate(zip_longest(
-            self.notes_per_measure, measure_bpms, fillvalue=0
-        )):
-            for q in quants:
-                if count >= q:
-                    # this is a stream measure
-                    runs = stream_runs[q]
-                    # can we extend the last stream run to include
-                    # this measure?
-                    if runs and runs[-1].start + runs[-1].len == i:
-                        runs[-1].len += 1
-                    # if not, create a new stream run
-                    else:
-                        runs.append(StreamRun(i, 1))
-                    
-                    if min_bpm[q] is None:
-                        # neither min_bpm nor max_bpm has been populated
-                        # yet; populate them now
-                        min_bpm[q] = bpm
-                        max_bpm[q] = bpm
-                    else:
-                        min_bpm[q] = min(min_bpm[q], bpm)
-                        max_bpm[q] = max(max_bpm[q], bpm)
-        
+                measure_bpms[i] = 0
+
+        if self.backend == 'numpy':
+            stream_runs, min_bpm, max_bpm = self._find_stream_runs_vectorized(
+                measure_bpms, quants
+            )
+        else:
+            stream_runs, min_bpm, max_bpm = self._find_stream_runs(
+                measure_bpms, quants
+            )
+
         # figure out what quant to use for the breakdown.
         # similar to zmod, this will be the first of (32nds, 24ths, 20ths) 
         # whose total density (including breaks before/after all stream runs)
@@ -619,3 +1003,27 @@ class ChartAnalyzer:
             'total_stream': total_stream,
             'total_break': total_break
         }
+
+    def analyze(self) -> ChartAnalysis:
+        """Get the notecounts, density graph, and stream info for the chart
+        all at once, going through the note data only once.
+
+        Prefer this over calling get_counts(), get_density_graph(), and
+        get_stream_info() separately if you need all three."""
+        if self.backend == 'numpy' or self.streaming:
+            # the note matrix (or the chunked stats) is already built in a
+            # single pass and shared between all three
+            counts = self.get_counts()
+        else:
+            counts, notes_per_measure, last_note_beat = \
+                self._single_pass_stats
+            # populate the cached properties so the density graph and stream
+            # info don't go through the note data again
+            self.__dict__.setdefault('notes_per_measure', notes_per_measure)
+            self.__dict__.setdefault('last_note_beat', last_note_beat)
+            counts = counts.copy()
+        return ChartAnalysis(
+            counts=counts,
+            density_graph=self.get_density_graph(),
+            stream_info=self.get_stream_info(),
+        )
@@ -105,37 +105,60 @@ def _gen_simplified_breakdown(stream_info, simplify_level):
     return ''.join(breakdown_parts)
 
 
+def _gen_bpm_suffix(stream_info):
+    # '@ bpm' part for breakdowns that aren't in 16ths
+    if stream_info['quant'] == 16:
+        return ''
+    bpms = stream_info['bpms']
+    multiplier = stream_info['quant'] / 16
+    adj_bpms = [
+        round(bpms[0] * multiplier),
+        round(bpms[1] * multiplier)
+    ]
+    # display the bpm as 1 number if the bpm bounds round to the
+    # same number, or if the bounds are so close (e.g. float
+    # imprecision) that they should be considered as the same.
+    # the 2nd condition catches some cases that the 1st doesn't, e.g.
+    # if the multiplier takes min_bpm and max_bpm to something like
+    # 120.49999... and 120.500...01, which will round to different nums
+    if adj_bpms[0] == adj_bpms[1] or bpms[1] - bpms[0] < 1e-9:
+        return f' @ {adj_bpms[1]}'
+    return f' @ {adj_bpms[0]}-{adj_bpms[1]}'
+
+
+def generate_breakdowns(stream_info: dict) -> dict:
+    """Generate every breakdown of a chart, for storing alongside it:
+    - 'full': the full breakdown
+    - 'simplified': a list of the breakdowns at each simplification level
+      (1 to 3)
+    - 'display': the breakdown to show, i.e. the most detailed of the above
+      that isn't too long (or the total stream if none of them fit), plus
+      the '@ bpm' part if the chart isn't in 16ths
+    'full' and 'simplified' are None for breakdowns that would be too long,
+    and for charts without streams.
+    """
+    if not stream_info['segments']:
+        return {
+            'full': None,
+            'simplified': [None, None, None],
+            'display': 'No streams',
+        }
+
+    full = _gen_full_breakdown(stream_info)
+    simplified = [
+        _gen_simplified_breakdown(stream_info, simplify_level)
+        for simplify_level in range(1, 4)
+    ]
+    # use the most detailed breakdown that fits under the maximum
+    bd = next((b for b in [full, *simplified] if b is not None), None)
+    if bd is None:
+        bd = f'{stream_info["total_stream"]} total'
+    return {
+        'full': full,
+        'simplified': simplified,
+        'display': bd + _gen_bpm_suffix(stream_info),
+    }
+
+
 def generate_breakdown(stream_info: dict) -> str:
-    if stream_info['segments']:
-        # attempt to generate simplier and simplier breakdowns until
-        # we get one that fits under the minimum
-        bd = _gen_full_breakdown(stream_info)
-        if bd is None:
-            for simplify_level in range(1, 4):
-                bd = _gen_simplified_breakdown(stream_info, simplify_level)
-                if bd is not None:
-                    break
-        if bd is None:
-            bd = f'{stream_info["total_stream"]} total'
-        
-        # add '@ bpm' part if this is not 16th stream
-        if stream_info['quant'] != 16:
-            bpms = stream_info['bpms']
-            multiplier = stream_info['quant'] / 16
-            adj_bpms = [
-                round(bpms[0] * multiplier),
-                round(bpms[1] * multiplier)
-            ]
-            # display the bpm as 1 number if the bpm bounds round to the
-            # same number, or if the bounds are so close (e.g. float
-            # imprecision) that they should be considered as the same.
-            # the 2nd condition catches some cases that the 1st doesn't, e.g.
-            # if the multiplier takes min_bpm and max_bpm to something like
-            # 120.49999... and 120.500...01, which will round to different nums
-            if adj_bpms[0] == adj_bpms[1] or bpms[1] - bpms[0] < 1e-9:
-                bd += f' @ {adj_bpms[1]}'
-            else:
-                bd += f' @ {adj_bpms[0]}-{adj_bpms[1]}'
-    else:
-        bd = 'No streams'
-    return bd
\ No newline at end of file
+    return generate_breakdowns(stream_info)['display']
@@ -0,0 +1,149 @@
+"""A content-addressed cache for chart analysis results.
+
+The same chart data gets uploaded many times (re-releases, compilations, packs
+reusing the same easier charts, etc.), so instead of re-running the analysis
+every time, we store the results in the database keyed by a digest of
+everything that goes into them (see get_analysis_digest()) and reuse them
+whenever we see the same chart again.
+
+Writes to the cache (new entries, and bumping the last use of the ones that
+were hit) are held back until the current transaction commits, so that an
+upload's hours-long transaction doesn't hold locks on cache entries that other
+uploads need too. (Losing them if the transaction is rolled back is fine.)
+
+Entries are evicted in least recently used order once there are more than
+settings.ANALYSIS_CACHE_MAX_ENTRIES of them. Since counting them takes a while,
+that's only checked every so often, so the cache can briefly grow a bit past
+that. Setting it to 0 disables the cache.
+"""
+
+from dataclasses import asdict
+from typing import Dict, Set
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from ...models import AnalysisCacheEntry
+from .analyzer import ChartAnalyzer, ChartAnalysis, get_analysis_digest
+
+
+# number of entries written by this process since it last checked whether any
+# need to be evicted. it checks again once that's _EVICTION_SLACK times the max
+# number of entries
+_written_since_eviction = 0
+_EVICTION_SLACK = 0.01
+
+
+class AnalysisCache:
+    """Looks up and stores chart analysis results, keeping track of the
+    number of cache hits and misses along the way."""
+
+    def __init__(self, max_entries: int | None = None):
+        if max_entries is None:
+            max_entries = settings.ANALYSIS_CACHE_MAX_ENTRIES
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # digest -> results to write, and digests of entries to bump the
+        # last use of, once the current transaction commits
+        self._to_store: Dict[str, ChartAnalysis] = {}
+        self._used: Set[str] = set()
+
+    @property
+    def lookups(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f'analysis cache: {self.hits}/{self.lookups} hits '
+            f'({self.hit_rate:.0%})'
+        )
+
+    def _get_digest(self, analyzer: ChartAnalyzer) -> str:
+        return get_analysis_digest(
+            analyzer.sim, analyzer.chart, analyzer.song_analyzer.chart_len
+        )
+
+    def _get(self, digest: str) -> ChartAnalysis | None:
+        chart_analysis = self._to_store.get(digest)
+        if chart_analysis is None:
+            entry = AnalysisCacheEntry.objects.filter(digest=digest).first()
+            if entry is not None:
+                chart_analysis = ChartAnalysis(**entry.analysis)
+                self._used.add(digest)
+                transaction.on_commit(self._write)
+        if chart_analysis is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return chart_analysis
+
+    def get(self, analyzer: ChartAnalyzer) -> ChartAnalysis | None:
+        """Get the cached analysis results of a chart, or None if there
+        aren't any."""
+        if self.max_entries <= 0:
+            return None
+        return self._get(self._get_digest(analyzer))
+
+    def analyze(self, analyzer: ChartAnalyzer) -> ChartAnalysis:
+        """Get the analysis results of a chart, either from the cache or by
+        running ChartAnalyzer.analyze() (and caching the results)."""
+        if self.max_entries <= 0:
+            return analyzer.analyze()
+
+        digest = self._get_digest(analyzer)
+        chart_analysis = self._get(digest)
+        if chart_analysis is None:
+            chart_analysis = analyzer.analyze()
+            self.store(digest, chart_analysis)
+        return chart_analysis
+
+    def store(self, digest: str, chart_analysis: ChartAnalysis):
+        """Cache the analysis results of the chart with the given digest (see
+        get_analysis_digest()), e.g. if they were computed elsewhere."""
+        if self.max_entries <= 0:
+            return
+        self._to_store[digest] = chart_analysis
+        transaction.on_commit(self._write)
+
+    def _write(self):
+        # the first of these callbacks writes everything, the rest find
+        # nothing left to write. (outside of a transaction, it's called right
+        # away)
+        global _written_since_eviction
+        to_store, self._to_store = self._to_store, {}
+        used, self._used = self._used, set()
+        if used:
+            AnalysisCacheEntry.objects.filter(digest__in=used) \
+                .update(last_used=timezone.now())
+        if to_store:
+            # another upload might have cached the same charts in the
+            # meantime, in which case we can just keep the existing entries.
+            # (inserting in the same order as everyone else means concurrent
+            # writes can't deadlock)
+            AnalysisCacheEntry.objects.bulk_create(
+                [
+                    AnalysisCacheEntry(
+                        digest=digest, analysis=asdict(to_store[digest])
+                    )
+                    for digest in sorted(to_store)
+                ],
+                ignore_conflicts=True
+            )
+            _written_since_eviction += len(to_store)
+            if _written_since_eviction >= self.max_entries * _EVICTION_SLACK:
+                _written_since_eviction = 0
+                self._evict()
+
+    def _evict(self):
+        excess = AnalysisCacheEntry.objects.count() - self.max_entries
+        if excess <= 0:
+            return
+        stale_pks = list(
+            AnalysisCacheEntry.objects.order_by('last_used', 'pk')
+            .values_list('pk', flat=True)[:excess]
+        )
+        AnalysisCacheEntry.objects.filter(pk__in=stale_pks).delete()
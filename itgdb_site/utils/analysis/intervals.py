@@ -0,0 +1,189 @@
+"""Sorted interval sets over beats, used for finding unhittable notes.
+
+A chart's warps and fake segments both describe regions of beats where notes
+can't be hit. Checking each note against the TimingEngine and walking through
+the fake segments one by one gets slow for charts with lots of gimmicks, so
+instead we precompile these regions into a sorted list of disjoint intervals
+that can be searched with bisection (or for whole arrays of beats at once,
+with NumPy).
+"""
+
+from bisect import bisect_right
+from fractions import Fraction
+from itertools import pairwise
+from typing import Iterable, List, NamedTuple, Sequence, Tuple
+import numpy as np
+from simfile.timing import BeatValue
+from simfile.timing.engine import TimingEngine, EventTag
+
+
+# stand-in for the end of a warp that never ends
+_FOREVER = Fraction(2**40)
+_INT64_MAX = np.iinfo(np.int64).max
+
+
+def _ceil(x: Fraction) -> int:
+    return -(-x.numerator // x.denominator)
+
+
+class Interval(NamedTuple):
+    """An interval of beats. The end is always exclusive, while the start may
+    or may not be inclusive."""
+    start: Fraction
+    end: Fraction
+    start_closed: bool = True
+
+
+class IntervalSet:
+    """A union of beat intervals, stored as disjoint intervals sorted by
+    their start."""
+
+    def __init__(self, intervals: Iterable[Interval] = ()):
+        merged: List[Interval] = []
+        for interval in sorted(
+            intervals, key=lambda iv: (iv.start, not iv.start_closed)
+        ):
+            if interval.end <= interval.start:
+                continue
+            if merged:
+                last = merged[-1]
+                # merge if overlapping, or if touching without a gap
+                if interval.start < last.end or (
+                    interval.start == last.end and interval.start_closed
+                ):
+                    if interval.end > last.end:
+                        merged[-1] = last._replace(end=interval.end)
+                    continue
+            merged.append(interval)
+
+        self.intervals = merged
+        self._starts = [interval.start for interval in merged]
+        # float versions of the bounds for the vectorized lookup. note that
+        # float() rounds Fractions correctly, so any comparison between floats
+        # that isn't a tie gives the same result as the exact comparison
+        self._starts_f = np.array(self._starts, dtype=np.float64)
+        self._ends_f = np.array(
+            [interval.end for interval in merged], dtype=np.float64
+        )
+        self._starts_closed = np.array(
+            [interval.start_closed for interval in merged], dtype=bool
+        )
+        self._tick_bounds_cache = {}
+
+    def __len__(self) -> int:
+        return len(self.intervals)
+
+    def __or__(self, other: 'IntervalSet') -> 'IntervalSet':
+        return IntervalSet(self.intervals + other.intervals)
+
+    def __contains__(self, beat: Fraction) -> bool:
+        idx = bisect_right(self._starts, beat) - 1
+        if idx < 0:
+            return False
+        interval = self.intervals[idx]
+        if beat == interval.start:
+            return interval.start_closed
+        return beat < interval.end
+
+    def contains(self, beats: Sequence[Fraction]) -> np.ndarray:
+        """Get a boolean mask of which of the given beats lie in this set."""
+        beats_f = np.array([float(beat) for beat in beats], dtype=np.float64)
+        if len(self.intervals) == 0:
+            return np.zeros(len(beats_f), dtype=bool)
+
+        idx = np.searchsorted(self._starts_f, beats_f, side='right') - 1
+        has_interval = idx >= 0
+        idx[~has_interval] = 0
+        starts_f = self._starts_f[idx]
+        ends_f = self._ends_f[idx]
+        mask = has_interval & (beats_f < ends_f) & (
+            (beats_f > starts_f) | self._starts_closed[idx]
+        )
+        # redo the lookups that involved a tie between floats with
+        # exact arithmetic instead
+        ties = has_interval & ((beats_f == starts_f) | (beats_f == ends_f))
+        for i in np.flatnonzero(ties):
+            mask[i] = beats[i] in self
+        return mask
+
+    def _tick_bounds(
+        self, ticks_per_beat: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Map each interval to the range of integer ticks [start, end) that
+        lie within it."""
+        if ticks_per_beat in self._tick_bounds_cache:
+            return self._tick_bounds_cache[ticks_per_beat]
+        starts = []
+        ends = []
+        for interval in self.intervals:
+            start = interval.start * ticks_per_beat
+            if interval.start_closed:
+                start_tick = _ceil(start)
+            else:
+                start_tick = start.numerator // start.denominator + 1
+            end_tick = _ceil(interval.end * ticks_per_beat)
+            # intervals shorter than a tick might not contain any ticks
+            if start_tick < end_tick:
+                starts.append(min(start_tick, _INT64_MAX))
+                ends.append(min(end_tick, _INT64_MAX))
+        bounds = (
+            np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+        )
+        self._tick_bounds_cache[ticks_per_beat] = bounds
+        return bounds
+
+    def contains_ticks(
+        self, ticks: np.ndarray, ticks_per_beat: int
+    ) -> np.ndarray:
+        """Same as contains(), but for beats given as integer numbers of
+        ticks. Everything here is integer arithmetic, so unlike contains(),
+        there are no ties to worry about."""
+        starts, ends = self._tick_bounds(ticks_per_beat)
+        if len(starts) == 0:
+            return np.zeros(len(ticks), dtype=bool)
+        idx = np.searchsorted(starts, ticks, side='right') - 1
+        return (idx >= 0) & (ticks < ends[np.maximum(idx, 0)])
+
+    @classmethod
+    def from_fake_segments(cls, fake_segments: List[BeatValue]) -> 'IntervalSet':
+        """Build the set of beats that lie within the given fake segments,
+        which should be sorted and filtered as in ChartAnalyzer.fake_segments.
+        """
+        # the game only checks the last segment starting at or before a given
+        # beat, so each segment is cut off by the start of the next one
+        # (meaning overlapping segments end where the later segment ends)
+        intervals = []
+        for i, seg in enumerate(fake_segments):
+            end = seg.beat + Fraction(seg.value)
+            if i + 1 < len(fake_segments):
+                end = min(end, fake_segments[i + 1].beat)
+            intervals.append(Interval(Fraction(seg.beat), end))
+        return cls(intervals)
+
+    @classmethod
+    def from_warps(cls, engine: TimingEngine) -> 'IntervalSet | None':
+        """Build the set of beats that TimingEngine.hittable() considers
+        unhittable due to warps. Returns None if the engine's timing events
+        are out of order, in which case its bisection-based lookups can't be
+        reproduced with intervals."""
+        # NOTE: the simfile library doesn't expose the engine's timing states
+        # publicly, so we have to dig into its internals here
+        if any(a > b for a, b in pairwise(engine._tagged_beats)):
+            return None
+
+        # since STOP_END is the last event tag, the state hittable() looks at
+        # is the last state at or before the given beat
+        states = engine._state_machine
+        intervals = []
+        for state, next_state in zip(states, [*states[1:], None]):
+            if not state.warp:
+                continue
+            start = Fraction(state.event.beat)
+            end = Fraction(next_state.event.beat) if next_state \
+                else _FOREVER
+            # notes coinciding with the end of a stop/delay are hittable
+            start_closed = state.event.tag not in (
+                EventTag.STOP_END, EventTag.DELAY_END
+            )
+            intervals.append(Interval(start, end, start_closed))
+        return cls(intervals)
@@ -0,0 +1,145 @@
+"""Sparse per-measure data for charts.
+
+Most charts have notes in nearly every measure, but it's possible (and it does
+happen in troll/gimmick files) for a chart to have a single stray note
+millions of beats in. To keep the analysis cost proportional to the number of
+notes rather than the length of the chart, we only store the measures that
+actually contain notes, and skip over runs of empty measures wherever
+possible.
+"""
+
+from bisect import bisect_right
+from typing import Dict, Iterable, Iterator, List, Tuple
+import numpy as np
+from .timing import BatchTimingEngine, TICKS_PER_MEASURE
+
+
+class MeasureCounts:
+    """The number of notes in each measure of a chart, stored sparsely.
+
+    Only measures with a nonzero count are stored; the runs of empty measures
+    in between are implied. The length is the number of measures up to and
+    including the last nonempty one (or 1 if there are none), matching the
+    dense list of counts this replaces.
+    """
+
+    def __init__(self, measures: Iterable[int], counts: Iterable[int]):
+        self.measures: List[int] = list(measures)
+        self.counts: List[int] = list(counts)
+
+    def __len__(self) -> int:
+        return self.measures[-1] + 1 if self.measures else 1
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, MeasureCounts):
+            return NotImplemented
+        return self.measures == other.measures and self.counts == other.counts
+
+    def __repr__(self) -> str:
+        return f'MeasureCounts({self.measures!r}, {self.counts!r})'
+
+    def to_list(self) -> List[int]:
+        """Get the counts of every measure as a regular (dense) list."""
+        dense = [0] * len(self)
+        for measure, count in zip(self.measures, self.counts):
+            dense[measure] = count
+        return dense
+
+    def runs(self) -> Iterator[Tuple[int, int, int]]:
+        """Iterate through the measures in order as (start, end, count)
+        tuples, where each nonempty measure gets its own tuple and each run
+        of empty measures is collapsed into a single tuple with count 0."""
+        cur = 0
+        for measure, count in zip(self.measures, self.counts):
+            if measure > cur:
+                yield cur, measure, 0
+            yield measure, measure + 1, count
+            cur = measure + 1
+        if cur < len(self):
+            yield cur, len(self), 0
+
+
+class MeasureTimes:
+    """Lazily computed song times of a chart's measure boundaries, i.e. the
+    times at beats 0, 4, 8, etc. Index k gives the time at the start of
+    measure k.
+
+    Times are cached once computed. Use prefetch() to compute a batch of them
+    at once, which is much faster than fetching them one by one.
+    """
+
+    def __init__(self, batch_engine: BatchTimingEngine):
+        self.batch_engine = batch_engine
+        self._cache: Dict[int, float] = {}
+        self._steady_ranges = None
+        self._steady_range_ends = None
+
+    def prefetch(self, measures: Iterable[int]):
+        missing = np.array(
+            sorted(set(measures).difference(self._cache)), dtype=np.int64
+        )
+        if len(missing) == 0:
+            return
+        times = self.batch_engine.times_at_ticks(missing * TICKS_PER_MEASURE)
+        self._cache.update(zip(missing.tolist(), times.tolist()))
+
+    def __getitem__(self, measure: int) -> float:
+        if measure not in self._cache:
+            self.prefetch((measure,))
+        return self._cache[measure]
+
+    def steady_ranges(
+        self, start: int, end: int, min_len: float
+    ) -> Iterator[Tuple[int, int]]:
+        """Find the ranges of measures [c, d) within [start, end) whose
+        lengths are all guaranteed to be greater than min_len (see
+        BatchTimingEngine.steady_measure_ranges())."""
+        if self._steady_ranges is None:
+            self._steady_ranges = self.batch_engine.steady_measure_ranges()
+            self._steady_range_ends = [
+                range_end for _, range_end, _ in self._steady_ranges
+            ]
+        ranges = self._steady_ranges
+        first = bisect_right(self._steady_range_ends, start)
+        for i in range(first, len(ranges)):
+            range_start, range_end, measure_len = ranges[i]
+            c = max(start, range_start)
+            d = min(end, range_end)
+            if c >= end:
+                break
+            if c >= d:
+                continue
+            # the lengths of these measures are computed as differences
+            # between (possibly large) floats, so leave some room for
+            # rounding error
+            tolerance = 1e-9 * max(1, abs(self[c]), abs(self[d]))
+            if measure_len - tolerance > min_len:
+                yield c, d
+
+
+class MeasureCountsBuilder:
+    """Builds a MeasureCounts from the beats of notes, added in order."""
+
+    def __init__(self):
+        self._measures = []
+        self._counts = []
+        self._cur_measure = 0
+        self._cur_count = 0
+
+    def _finish_measure(self):
+        if self._cur_count > 0:
+            self._measures.append(self._cur_measure)
+            self._counts.append(self._cur_count)
+        self._cur_count = 0
+
+    def add(self, beat):
+        # if we've exited the current measure, finish the count for that
+        # measure and jump straight to the measure containing this beat
+        if beat >= (self._cur_measure + 1) * 4:
+            self._finish_measure()
+            self._cur_measure = beat // 4
+        self._cur_count += 1
+
+    def build(self) -> MeasureCounts:
+        self._finish_measure()
+        return MeasureCounts(self._measures, self._counts)
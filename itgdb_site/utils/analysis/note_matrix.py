@@ -0,0 +1,267 @@
+"""A NumPy-backed representation of a chart's note data.
+
+Iterating through a NoteData instance creates a Python object for every note,
+and the original ChartAnalyzer implementation did this several times per chart.
+NoteMatrix is built from a single scan of the note data (see NoteTokens) and
+stores the notes in parallel typed arrays, so the statistics we want can be
+computed with vectorized operations instead.
+"""
+
+from functools import cached_property
+from typing import Dict, List
+import numpy as np
+from simfile.notes import NoteType
+from simfile.timing import Beat
+from .measures import MeasureCounts
+from .tokenizer import NoteTokens
+
+
+# note types are stored as small integer codes
+NOTE_TYPE_CODES = {note_type: i for i, note_type in enumerate(NoteType)}
+TAP = NOTE_TYPE_CODES[NoteType.TAP]
+HOLD_HEAD = NOTE_TYPE_CODES[NoteType.HOLD_HEAD]
+TAIL = NOTE_TYPE_CODES[NoteType.TAIL]
+ROLL_HEAD = NOTE_TYPE_CODES[NoteType.ROLL_HEAD]
+LIFT = NOTE_TYPE_CODES[NoteType.LIFT]
+MINE = NOTE_TYPE_CODES[NoteType.MINE]
+FAKE = NOTE_TYPE_CODES[NoteType.FAKE]
+# maps note characters (as code points) to note type codes, or -1 if invalid
+_CHAR_TO_NOTE_TYPE_CODE = np.full(128, -1, dtype=np.int8)
+for _note_type, _code in NOTE_TYPE_CODES.items():
+    _CHAR_TO_NOTE_TYPE_CODE[ord(_note_type.value)] = _code
+
+# beats are stored as integer numbers of ticks where possible. 960 ticks per
+# beat covers every common row spacing (including 20ths/40ths and 128ths),
+# as well as the 1/48 beat grid simfile rounds timing events to
+ROW_TICKS_PER_BEAT = 960
+ROW_TICKS_PER_MEASURE = ROW_TICKS_PER_BEAT * 4
+
+# these mirror the note type sets in analyzer.py
+ALL_NOTE_TYPE_CODES = np.array(
+    (TAP, HOLD_HEAD, ROLL_HEAD, TAIL, LIFT, MINE, FAKE), dtype=np.int8
+)
+COMBO_INCREASING_NOTE_TYPE_CODES = np.array(
+    (TAP, HOLD_HEAD, ROLL_HEAD, LIFT), dtype=np.int8
+)
+STREAM_NOTE_TYPE_CODES = np.array((TAP, HOLD_HEAD, ROLL_HEAD), dtype=np.int8)
+
+
+def get_note_type_codes(chars: np.ndarray) -> np.ndarray:
+    """Convert note characters (see NoteTokens.chars) to note type codes.
+    Raises ValueError if any of them isn't a valid note type."""
+    if np.any(chars >= len(_CHAR_TO_NOTE_TYPE_CODE)):
+        note_types = np.full(len(chars), -1, dtype=np.int8)
+    else:
+        note_types = _CHAR_TO_NOTE_TYPE_CODE[chars]
+    if np.any(note_types < 0):
+        # same error NoteData would raise
+        char = chr(chars[np.flatnonzero(note_types < 0)[0]])
+        raise ValueError(f'{char!r} is not a valid NoteType')
+    return note_types
+
+
+def get_first_note_types(tokens: NoteTokens) -> Dict[int, int]:
+    """Map each column to the type code of its first note (out of the note
+    types we analyze)."""
+    note_types = get_note_type_codes(tokens.chars)
+    included = np.flatnonzero(np.isin(note_types, ALL_NOTE_TYPE_CODES))
+    columns, first = np.unique(tokens.columns[included], return_index=True)
+    return dict(zip(columns.tolist(), note_types[included[first]].tolist()))
+
+
+class NoteMatrix:
+    """Note data of a chart, stored as parallel arrays with one entry per
+    note (in the order the notes appear in the note data).
+
+    Notes are grouped into rows, where a row is a set of consecutive notes
+    sharing the same beat. Since beats strictly increase from row to row,
+    comparing row indices is equivalent to comparing beats exactly, which
+    lets us avoid Fraction arithmetic for most of the analysis.
+
+    Each row's beat is also stored as an integer tick (see
+    ROW_TICKS_PER_BEAT) in `row_ticks`. Rows that don't land exactly on a
+    tick are flagged in `row_on_grid`; their tick is rounded down, which is
+    still good enough for bucketing them into measures. The exact beat of a
+    row can be fetched with `row_beat()`.
+
+    Routine charts (whose beats restart for the second player) are not
+    supported; check `NoteMatrix.supports(notes_str)` first.
+
+    A chart can also be analyzed in pieces (see streaming.py), in which case
+    next_note_types should map each column to the type code of its first note
+    after this piece. Holds whose tails are in a later piece get num_rows as
+    their tail row.
+    """
+
+    def __init__(
+        self,
+        tokens: NoteTokens,
+        next_note_types: Dict[int, int] | None = None
+    ):
+        chars = tokens.chars
+        note_types = get_note_type_codes(chars)
+
+        # a new row starts whenever the measure or row changes
+        measures = tokens.measures
+        new_row = np.ones(len(chars), dtype=bool)
+        new_row[1:] = (measures[1:] != measures[:-1]) \
+            | (tokens.rows[1:] != tokens.rows[:-1])
+        row_starts = np.flatnonzero(new_row)
+        self.row_measures = measures[row_starts]
+        self._row_idx = tokens.rows[row_starts]
+        self._row_subdivisions = tokens.subdivisions[row_starts]
+
+        # beat = 4 * (measure + row / subdivision)
+        ticks_in_measure, remainder = np.divmod(
+            self._row_idx * ROW_TICKS_PER_MEASURE, self._row_subdivisions
+        )
+        self.row_ticks = self.row_measures * ROW_TICKS_PER_MEASURE \
+            + ticks_in_measure
+        self.row_on_grid = remainder == 0
+        self.rows = np.cumsum(new_row) - 1
+        self.columns = tokens.columns.astype(np.int16)
+        self.note_types = note_types
+        self._join_heads_to_tails(next_note_types or {})
+
+    def __len__(self) -> int:
+        return len(self.note_types)
+
+    @property
+    def num_rows(self) -> int:
+        return len(self.row_ticks)
+
+    def row_beat(self, i: int) -> Beat:
+        """Get the exact beat of the i-th row."""
+        subdivision = int(self._row_subdivisions[i])
+        return Beat(
+            int(self.row_measures[i]) * 4 * subdivision
+                + int(self._row_idx[i]) * 4,
+            subdivision
+        )
+
+    @cached_property
+    def row_beats(self) -> List[Beat]:
+        """The exact beats of every row."""
+        return [self.row_beat(i) for i in range(self.num_rows)]
+
+    @staticmethod
+    def supports(notes_str: str) -> bool:
+        return '&' not in notes_str
+
+    def _join_heads_to_tails(self, next_note_types: Dict[int, int]):
+        """Reproduce the behavior of simfile's group_notes() with
+        join_heads_to_tails=True and orphaned heads/tails dropped (see
+        ChartAnalyzer._group_notes_no_orphans()).
+
+        Sets `emitted` (mask of notes group_notes() would yield) and
+        `tail_rows` (row index of each hold/roll head's tail, or -1).
+        """
+        note_types = self.note_types
+        count = len(note_types)
+        included = np.isin(note_types, ALL_NOTE_TYPE_CODES)
+
+        # a head is joined to its tail iff the next included note in the
+        # same column is a tail; otherwise the head is an orphan. tails are
+        # never yielded by themselves.
+        idx = np.flatnonzero(included)
+        order = idx[np.lexsort((idx, self.columns[idx]))]
+        ordered_types = note_types[order]
+        ordered_columns = self.columns[order]
+        is_last_in_column = np.ones(len(order), dtype=bool)
+        is_last_in_column[:-1] = ordered_columns[1:] != ordered_columns[:-1]
+        next_is_tail = np.zeros(len(order), dtype=bool)
+        next_is_tail[:-1] = (ordered_types[1:] == TAIL) \
+            & ~is_last_in_column[:-1]
+        # the last note in each column is followed by the first note in that
+        # column after this piece (if there is one)
+        for i in np.flatnonzero(is_last_in_column):
+            column = int(ordered_columns[i])
+            next_is_tail[i] = next_note_types.get(column) == TAIL
+        is_head = (ordered_types == HOLD_HEAD) | (ordered_types == ROLL_HEAD)
+        joined = is_head & next_is_tail
+
+        self.emitted = included & (note_types != TAIL)
+        self.emitted[order[is_head & ~joined]] = False
+        next_rows = np.full(len(order), self.num_rows, dtype=np.int64)
+        next_rows[:-1] = self.rows[order[1:]]
+        next_rows[is_last_in_column] = self.num_rows
+        self.tail_rows = np.full(count, -1, dtype=np.int64)
+        self.tail_rows[order[joined]] = next_rows[joined]
+
+    def first_note_rows(self) -> Dict[int, int]:
+        """Map each column to the row of its first note (out of the note
+        types we analyze)."""
+        included = np.flatnonzero(np.isin(self.note_types, ALL_NOTE_TYPE_CODES))
+        columns, first = np.unique(self.columns[included], return_index=True)
+        return dict(zip(columns.tolist(), self.rows[included[first]].tolist()))
+
+    def open_hold_columns(self, hittable_rows: np.ndarray) -> List[int]:
+        """Get the columns of the (counted) holds/rolls whose tails are after
+        this piece of the chart."""
+        held = self.emitted & hittable_rows[self.rows] \
+            & (self.tail_rows == self.num_rows)
+        return self.columns[held].tolist()
+
+    @property
+    def last_note_beat(self) -> Beat | None:
+        """The beat value of the last note/mine/object in the chart."""
+        return self.row_beat(-1) if self.num_rows else None
+
+    def get_counts(
+        self,
+        hittable_rows: np.ndarray,
+        open_tail_rows: np.ndarray | None = None
+    ) -> Dict[str, int]:
+        """Get notecount statistics, given a mask of which rows are
+        hittable. See ChartAnalyzer.get_counts().
+
+        When analyzing a chart in pieces, open_tail_rows should contain the
+        tail rows of the holds/rolls that started in earlier pieces and
+        haven't ended yet."""
+        note_types = self.note_types
+        hittable = self.emitted & hittable_rows[self.rows]
+        combo = hittable & np.isin(note_types, COMBO_INCREASING_NOTE_TYPE_CODES)
+        combo_rows, combo_row_sizes = np.unique(
+            self.rows[combo], return_counts=True
+        )
+
+        # a hold/roll counts towards a hand on a row if it started on an
+        # earlier row and its tail hasn't passed yet (see
+        # ChartAnalyzer._count_hands()). holds in the same column can't
+        # overlap, or else they would have been dropped as orphans
+        held = combo & (self.tail_rows >= 0)
+        head_rows = np.sort(self.rows[held])
+        tail_rows = np.sort(self.tail_rows[held])
+        active_holds = np.searchsorted(head_rows, combo_rows) \
+            - np.searchsorted(tail_rows, combo_rows)
+        if open_tail_rows is not None:
+            active_holds += len(open_tail_rows) \
+                - np.searchsorted(np.sort(open_tail_rows), combo_rows)
+
+        return {
+            'objects': int(np.count_nonzero(self.emitted)),
+            'steps': len(combo_rows),
+            'combo': int(np.count_nonzero(combo)),
+            'jumps': int(np.count_nonzero(combo_row_sizes >= 2)),
+            'mines': int(np.count_nonzero(hittable & (note_types == MINE))),
+            'hands': int(np.count_nonzero(
+                active_holds + combo_row_sizes > 2
+            )),
+            'holds': int(np.count_nonzero(combo & (note_types == HOLD_HEAD))),
+            'rolls': int(np.count_nonzero(combo & (note_types == ROLL_HEAD))),
+            'lifts': int(np.count_nonzero(combo & (note_types == LIFT))),
+            'fakes': int(np.count_nonzero(note_types == FAKE)),
+        }
+
+    def get_notes_per_measure(
+        self, hittable_rows: np.ndarray
+    ) -> MeasureCounts:
+        """Get the number of hittable rows containing taps/holds/rolls in each
+        measure, given a mask of which rows are hittable."""
+        stream_notes = self.emitted & hittable_rows[self.rows] \
+            & np.isin(self.note_types, STREAM_NOTE_TYPE_CODES)
+        stream_rows = np.unique(self.rows[stream_notes])
+        measures, counts = np.unique(
+            self.row_measures[stream_rows], return_counts=True
+        )
+        return MeasureCounts(measures.tolist(), counts.tolist())
@@ -0,0 +1,114 @@
+"""Memory-bounded analysis of long charts.
+
+NoteMatrix keeps a few dozen bytes of arrays around for every character of
+note data, which adds up for multi-hour marathons. Charts whose note data is
+larger than the analysis memory ceiling allows (see
+settings.ANALYSIS_MEMORY_CEILING) are instead split at measure boundaries into
+chunks that each fit within it, and analyzed one chunk at a time. The only
+state carried from one chunk to the next is fixed-size: the running note
+counts, and which columns have a hold/roll that hasn't ended yet. (The
+results themselves, i.e. the per-measure counts, are of course still
+proportional to the number of measures with notes.)
+
+Whether a hold head gets joined to a tail (or dropped as an orphan) depends on
+the next note in its column, which may be in a later chunk. So before the
+chunks are analyzed, a first pass records the first note type in each column
+of every chunk, which is all we need to know about the later chunks.
+"""
+
+from typing import Callable, Dict, Iterator, List, Tuple
+import numpy as np
+from simfile.timing import Beat
+
+from .measures import MeasureCounts
+from .note_matrix import NoteMatrix, get_first_note_types
+from .tokenizer import NoteTokens
+
+
+# a rough upper bound on the bytes of memory NoteTokens/NoteMatrix need per
+# character of note data (measured with tracemalloc on the synthetic
+# benchmark charts)
+BYTES_PER_NOTE_DATA_CHAR = 48
+
+
+def iter_measure_chunks(
+    notes: str, max_chars: int
+) -> Iterator[Tuple[int, str]]:
+    """Split note data at measure boundaries into chunks of at most
+    max_chars characters (unless a single measure is longer than that).
+    Yields the index of each chunk's first measure along with the chunk."""
+    start = 0
+    first_measure = 0
+    while len(notes) - start > max_chars:
+        cut = notes.rfind(',', start, start + max_chars)
+        if cut < 0:
+            # the measure is too long by itself
+            cut = notes.find(',', start + max_chars)
+            if cut < 0:
+                break
+        chunk = notes[start:cut]
+        yield first_measure, chunk
+        first_measure += chunk.count(',') + 1
+        start = cut + 1
+    yield first_measure, notes[start:]
+
+
+def analyze_in_chunks(
+    notes: str,
+    max_chars: int,
+    get_hittable_rows: Callable[[NoteMatrix], np.ndarray]
+) -> Tuple[Dict[str, int], MeasureCounts, Beat | None]:
+    """Compute the notecounts, notes_per_measure, and last_note_beat of a
+    chart a chunk of measures at a time. The results are the same as those
+    from NoteMatrix for the entire chart.
+
+    get_hittable_rows() should return the mask of hittable rows for a
+    NoteMatrix (see ChartAnalyzer.hittable_rows)."""
+    # first pass: the first note type in each column after each chunk
+    first_note_types = [
+        get_first_note_types(NoteTokens(chunk, first_measure))
+        for first_measure, chunk in iter_measure_chunks(notes, max_chars)
+    ]
+    next_note_types: List[Dict[int, int]] = []
+    after: Dict[int, int] = {}
+    for types in reversed(first_note_types):
+        next_note_types.append(after)
+        after = {**after, **types}
+    next_note_types.reverse()
+
+    counts = None
+    measures = []
+    measure_counts = []
+    last_note_beat = None
+    # columns with a hold/roll that started in an earlier chunk
+    open_hold_columns = []
+    chunks = iter_measure_chunks(notes, max_chars)
+    for (first_measure, chunk), next_types in zip(chunks, next_note_types):
+        note_matrix = NoteMatrix(NoteTokens(chunk, first_measure), next_types)
+        hittable_rows = get_hittable_rows(note_matrix)
+
+        # an open hold's tail is the first note in its column (if there's
+        # no note in its column, it's still going at the end of this chunk)
+        first_rows = note_matrix.first_note_rows()
+        open_tail_rows = np.array([
+            first_rows.get(column, note_matrix.num_rows)
+            for column in open_hold_columns
+        ], dtype=np.int64)
+        chunk_counts = note_matrix.get_counts(hittable_rows, open_tail_rows)
+        if counts is None:
+            counts = chunk_counts
+        else:
+            for k, v in chunk_counts.items():
+                counts[k] += v
+        open_hold_columns = [
+            column for column, tail_row in zip(open_hold_columns, open_tail_rows)
+            if tail_row == note_matrix.num_rows
+        ] + note_matrix.open_hold_columns(hittable_rows)
+
+        chunk_measure_counts = note_matrix.get_notes_per_measure(hittable_rows)
+        measures += chunk_measure_counts.measures
+        measure_counts += chunk_measure_counts.counts
+        if note_matrix.num_rows:
+            last_note_beat = note_matrix.last_note_beat
+
+    return counts, MeasureCounts(measures, measure_counts), last_note_beat
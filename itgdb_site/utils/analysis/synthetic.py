@@ -0,0 +1,178 @@
+"""Deterministic synthetic simfiles for benchmarking the analyzer.
+
+generate_simfile() always returns the same SSC text for the same scenario and
+seed, so benchmark results can be compared between commits. The scenarios
+cover both typical charts and the extremes that show up in the wild (see
+SCENARIOS).
+"""
+
+from dataclasses import dataclass
+import random
+from typing import List
+
+
+@dataclass(frozen=True)
+class Scenario:
+    description: str
+    stepstype: str
+    columns: int
+    # number of charts, and number of measures in each chart
+    charts: int
+    measures: int
+    bpm: float
+    # fraction of measures that are 16th note stream
+    stream_ratio: float
+    # number of each kind of timing segment, placed at random beats
+    bpm_changes: int = 0
+    stops: int = 0
+    delays: int = 0
+    warps: int = 0
+    # number of edit charts (with distinct descriptions) on top of the charts
+    # above
+    edits: int = 0
+
+
+SCENARIOS = {
+    'stream_2min': Scenario(
+        '2 minute 16th note stream', 'dance-single', 4,
+        charts=1, measures=85, bpm=170, stream_ratio=1,
+    ),
+    'marathon_1h': Scenario(
+        '1 hour marathon', 'dance-single', 4,
+        charts=1, measures=2700, bpm=180, stream_ratio=0.7, bpm_changes=40,
+    ),
+    'gimmick': Scenario(
+        'dense gimmick timing', 'dance-single', 4,
+        charts=1, measures=300, bpm=150, stream_ratio=0.4,
+        bpm_changes=150, stops=400, delays=100, warps=200,
+    ),
+    'doubles': Scenario(
+        'doubles charts', 'dance-double', 8,
+        charts=5, measures=200, bpm=160, stream_ratio=0.6,
+    ),
+    'many_edits': Scenario(
+        'a full set of charts plus 100 edits', 'dance-single', 4,
+        charts=5, measures=120, bpm=150, stream_ratio=0.5, edits=100,
+    ),
+}
+
+DIFFICULTIES = ('Beginner', 'Easy', 'Medium', 'Hard', 'Challenge')
+
+
+def _format_segments(segments) -> str:
+    return ',\n'.join(f'{beat:.3f}={value:.3f}' for beat, value in segments)
+
+
+def _make_segment_beats(
+    rng: random.Random, count: int, total_beats: int
+) -> List[float]:
+    # distinct positions on a 16th note grid, excluding beat 0
+    grid = range(1, total_beats * 4)
+    return sorted(b / 4 for b in rng.sample(grid, min(count, len(grid))))
+
+
+def _make_timing(rng: random.Random, scenario: Scenario) -> List[str]:
+    total_beats = scenario.measures * 4
+    bpms = [(0, scenario.bpm)] + [
+        (beat, scenario.bpm * rng.choice((0.5, 0.75, 1, 1.5, 2)))
+        for beat in _make_segment_beats(rng, scenario.bpm_changes, total_beats)
+    ]
+    stops = [
+        (beat, rng.choice((0.05, 0.1, 0.2, 0.5)))
+        for beat in _make_segment_beats(rng, scenario.stops, total_beats)
+    ]
+    delays = [
+        (beat, rng.choice((0.05, 0.1, 0.2)))
+        for beat in _make_segment_beats(rng, scenario.delays, total_beats)
+    ]
+    warps = [
+        (beat, rng.choice((0.25, 0.5, 1, 2)))
+        for beat in _make_segment_beats(rng, scenario.warps, total_beats)
+    ]
+    return [
+        f'#BPMS:{_format_segments(bpms)};',
+        f'#STOPS:{_format_segments(stops)};',
+        f'#DELAYS:{_format_segments(delays)};',
+        f'#WARPS:{_format_segments(warps)};',
+    ]
+
+
+def _make_stream_measure(rng: random.Random, columns: int) -> List[str]:
+    rows = []
+    prev = -1
+    for _ in range(16):
+        row = ['0'] * columns
+        col = rng.choice([c for c in range(columns) if c != prev])
+        row[col] = '1'
+        # the occasional jump
+        if rng.random() < 0.1:
+            row[rng.choice([c for c in range(columns) if c != col])] = '1'
+        prev = col
+        rows.append(''.join(row))
+    return rows
+
+
+def _make_other_measure(rng: random.Random, columns: int) -> List[str]:
+    kind = rng.choice(('eighths', 'holds', 'triplets', 'break', 'mines'))
+    if kind == 'break':
+        return ['0' * columns] * 4
+    subdivision = {'eighths': 8, 'holds': 8, 'triplets': 12, 'mines': 16}[kind]
+    rows = [['0'] * columns for _ in range(subdivision)]
+    if kind == 'holds':
+        # a hold or roll that ends within the measure, plus taps on the
+        # other columns
+        col = rng.randrange(columns)
+        start = rng.randrange(subdivision // 2)
+        rows[start][col] = rng.choice('24')
+        rows[rng.randrange(start + 1, subdivision)][col] = '3'
+        for row in rows[::2]:
+            other = rng.randrange(columns)
+            if other != col:
+                row[other] = '1'
+    else:
+        for row in rows[::2 if kind == 'eighths' else 1]:
+            if rng.random() < 0.6:
+                row[rng.randrange(columns)] = \
+                    'M' if kind == 'mines' else rng.choice('1111111FL')
+    return [''.join(row) for row in rows]
+
+
+def _make_notes(rng: random.Random, scenario: Scenario) -> str:
+    measures = []
+    for _ in range(scenario.measures):
+        if rng.random() < scenario.stream_ratio:
+            rows = _make_stream_measure(rng, scenario.columns)
+        else:
+            rows = _make_other_measure(rng, scenario.columns)
+        measures.append('\n'.join(rows))
+    return '\n,\n'.join(measures)
+
+
+def generate_simfile(scenario: str, seed: int = 0) -> str:
+    """Generate the SSC text of a synthetic simfile for one of the scenarios
+    in SCENARIOS."""
+    params = SCENARIOS[scenario]
+    rng = random.Random(f'{scenario}:{seed}')
+    lines = [
+        '#VERSION:0.83;',
+        f'#TITLE:Synthetic {scenario};',
+        '#ARTIST:itgdb;',
+        '#OFFSET:-0.009;',
+        *_make_timing(rng, params),
+    ]
+    for i in range(params.charts + params.edits):
+        if i < params.charts:
+            difficulty = DIFFICULTIES[i % len(DIFFICULTIES)]
+            description = ''
+        else:
+            difficulty, description = 'Edit', f'edit {i - params.charts}'
+        lines += [
+            '#NOTEDATA:;',
+            f'#STEPSTYPE:{params.stepstype};',
+            f'#DESCRIPTION:{description};',
+            f'#DIFFICULTY:{difficulty};',
+            f'#METER:{10 + i % 10};',
+            '#CREDIT:itgdb;',
+            f'#NOTES:\n{_make_notes(rng, params)}\n;',
+        ]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,194 @@
+"""A fast tokenizer for note data.
+
+The simfile library's NoteData re-tokenizes the #NOTES string every time it's
+iterated through, creating a Note (with a Fraction beat) for every note along
+the way, and get_hash() makes yet another pass over the string with regexes.
+NoteTokens scans the string once and stores the notes as compact arrays,
+which both the analysis (see NoteMatrix) and the chart hash can be computed
+from.
+
+Almost all note data is "canonical": nothing but rows of note characters
+separated by newlines, with each comma on its own line. Canonical note data is
+tokenized with vectorized operations over the raw bytes. Everything else
+(comments, stray whitespace, keysounds, etc.) goes through a slower path that
+mirrors NoteData's behavior exactly, skipping over measures without notes.
+"""
+
+from functools import cached_property
+import numpy as np
+from simfile.notes import NoteData
+
+
+_NEWLINE = ord('\n')
+_COMMA = ord(',')
+
+# bytes that can appear in canonical note data
+_CANONICAL_BYTES = np.zeros(256, dtype=bool)
+for _c in b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz,\n':
+    _CANONICAL_BYTES[_c] = True
+# bytes of canonical note data that are notes
+_NOTE_BYTES = _CANONICAL_BYTES.copy()
+for _c in b'0,\n':
+    _NOTE_BYTES[_c] = False
+# characters that can make up a measure without any notes. measures containing
+# any other character are handled by the NoteData-like path
+_EMPTY_MEASURE_CHARS = '0 \t\n'
+
+
+class NoteTokens:
+    """The notes of a chart's note data, stored as parallel arrays with one
+    entry per note, in the same order as NoteData yields them:
+    - measures: index of the measure containing the note
+    - rows: index of the note's row within its measure
+    - subdivisions: number of rows in the note's measure
+    - columns: the note's column
+    - chars: the note's character (as a code point, e.g. ord('1') for a tap).
+      Note that these aren't validated here.
+
+    Routine charts (whose note data contains an '&') are not supported.
+
+    To tokenize a chart in pieces, split its note data at commas and pass the
+    index of each piece's first measure as first_measure.
+    """
+
+    def __init__(self, notes: str, first_measure: int = 0):
+        self.notes = notes
+        if '&' in notes:
+            raise ValueError('routine charts are not supported')
+        if self._canonical_lines is not None:
+            self._tokenize_canonical()
+        else:
+            self._tokenize_general()
+        if first_measure:
+            self.measures = self.measures + first_measure
+
+    def __len__(self) -> int:
+        return len(self.chars)
+
+    @cached_property
+    def _canonical_lines(self) -> tuple | None:
+        """If the note data is canonical, returns its (stripped) bytes along
+        with the start and end of each of its lines, and a mask of which
+        lines are commas. Otherwise, returns None."""
+        stripped = self.notes.strip()
+        if not stripped or not stripped.isascii():
+            return None
+        data = np.frombuffer(stripped.encode('ascii'), dtype=np.uint8)
+        if not _CANONICAL_BYTES[data].all():
+            return None
+        newlines = np.flatnonzero(data == _NEWLINE)
+        line_starts = np.concatenate(([0], newlines + 1))
+        line_ends = np.concatenate((newlines, [len(data)]))
+        # no blank lines...
+        if np.any(line_starts == line_ends):
+            return None
+        # ...and each comma must be on its own line
+        comma_lines = data[line_starts] == _COMMA
+        if np.count_nonzero(comma_lines) != np.count_nonzero(data == _COMMA) \
+            or np.any(line_ends[comma_lines] - line_starts[comma_lines] != 1):
+            return None
+        return data, line_starts, line_ends, comma_lines
+
+    def _tokenize_canonical(self):
+        data, line_starts, line_ends, comma_lines = self._canonical_lines
+        # the measure each line belongs to (comma lines belong to the
+        # measure they end)
+        line_measures = np.cumsum(comma_lines) - comma_lines
+        self._line_measures = line_measures
+        self.num_measures = int(np.count_nonzero(comma_lines)) + 1
+
+        # index of each row within its measure (-1 for comma lines)
+        row_lines = np.flatnonzero(~comma_lines)
+        row_line_measures = line_measures[row_lines]
+        self._row_lines = row_lines
+        self._line_rows = np.full(len(line_starts), -1, dtype=np.int64)
+        self._line_rows[row_lines] = np.arange(len(row_lines)) \
+            - np.searchsorted(row_line_measures, row_line_measures)
+        self.measure_subdivisions = np.bincount(
+            row_line_measures, minlength=self.num_measures
+        )
+
+        positions = np.flatnonzero(_NOTE_BYTES[data])
+        note_lines = np.searchsorted(line_starts, positions, side='right') - 1
+        self._note_lines = note_lines
+        self.measures = line_measures[note_lines]
+        self.rows = self._line_rows[note_lines]
+        self.subdivisions = self.measure_subdivisions[self.measures]
+        self.columns = positions - line_starts[note_lines]
+        self.chars = data[positions].astype(np.int32)
+
+    def _tokenize_general(self):
+        # same as iterating through NoteData, just without creating a Note
+        # for every note
+        measures = []
+        rows = []
+        subdivisions = []
+        columns = []
+        chars = []
+        measure_strs = self.notes.split(',')
+        for m, measure in enumerate(measure_strs):
+            if not measure.strip(_EMPTY_MEASURE_CHARS):
+                continue
+            lines = measure.strip().splitlines()
+            subdivision = len(lines)
+            for r, line in enumerate(lines):
+                line = line.strip()
+                if '[' in line:
+                    line = NoteData._extract_keysound_indices(line)
+                if line.count('0') == len(line):
+                    continue
+                for c, char in enumerate(line):
+                    if char != '0':
+                        measures.append(m)
+                        rows.append(r)
+                        subdivisions.append(subdivision)
+                        columns.append(c)
+                        chars.append(ord(char))
+
+        self.num_measures = len(measure_strs)
+        self.measures = np.array(measures, dtype=np.int64)
+        self.rows = np.array(rows, dtype=np.int64)
+        self.subdivisions = np.array(subdivisions, dtype=np.int64)
+        self.columns = np.array(columns, dtype=np.int64)
+        self.chars = np.array(chars, dtype=np.int32)
+
+    def get_minimized_chart(self) -> str | None:
+        """Get the note data in the normalized and minimized form that the
+        chart hash is computed from (see get_hash() in utils/charts.py), i.e.
+        with every measure reduced to the fewest rows that can express it.
+
+        Only canonical note data is supported; returns None otherwise.
+        Raises RuntimeError if a measure (other than the last) is empty, just
+        like get_hash()."""
+        if self._canonical_lines is None:
+            return None
+        data, line_starts, line_ends, comma_lines = self._canonical_lines
+        subdivisions = self.measure_subdivisions
+        if np.any(subdivisions[:-1] == 0):
+            raise RuntimeError('chart contains an empty measure')
+
+        # a measure is halved for as long as it has an even number of rows
+        # and all of its odd rows are empty, so the rows that are kept are
+        # the multiples of the largest power of 2 dividing both the number of
+        # rows and the index of every nonempty row
+        steps = subdivisions & -subdivisions
+        nonempty_lines = np.unique(self._note_lines)
+        nonempty_lines = nonempty_lines[self._line_rows[nonempty_lines] > 0]
+        nonempty_rows = self._line_rows[nonempty_lines]
+        np.minimum.at(
+            steps,
+            self._line_measures[nonempty_lines],
+            nonempty_rows & -nonempty_rows
+        )
+
+        row_lines = self._row_lines
+        keep = comma_lines.copy()
+        keep[row_lines] = self._line_rows[row_lines] \
+            % steps[self._line_measures[row_lines]] == 0
+
+        # keep the bytes of every kept line, along with its trailing newline
+        line_lengths = np.diff(np.concatenate((line_starts, [len(data) + 1])))
+        byte_lines = np.repeat(np.arange(len(line_starts)), line_lengths)
+        minimized = data[keep[byte_lines[:len(data)]]].tobytes().decode('ascii')
+        # if the last line was dropped, we're left with an extra newline
+        return minimized.removesuffix('\n')
@@ -0,0 +1,184 @@
+"""Read-only filesystems over pack archives, so packs can be uploaded
+without extracting them first.
+
+Extracting an archive writes out every file in it, multi-GB background videos
+and all, whereas an upload only reads the simfiles and a few assets of each
+song. An archive opened with open_archive() reads its members on demand
+instead. It's a PyFilesystem2 filesystem, which the simfile library already
+supports (see the filesystem argument of SimfilePack etc.), and which our own
+routines that look around a pack take as well. Only formats with random
+access to their members are supported (zip and uncompressed tar); anything
+else still gets extracted, see tasks._open_pack_source().
+
+Paths in an archive are PyFilesystem paths ('/Pack/Song/song.ssc'), while
+extracted packs are read through simfile's NativeOSFS (the default everywhere)
+with OS paths. Since those are posix paths too, os.path works on both.
+
+The few tools that need an actual file (ffprobe, OpenCV) get the member
+spooled to a temporary file, see syspath().
+"""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from typing import Iterator, Set
+from fs.base import FS
+from fs.errors import FileExpected, ResourceNotFound, ResourceReadOnly
+from fs.iotools import RawWrapper
+from fs.path import abspath, join, normpath, relpath
+from fs.tarfs import ReadTarFS
+from fs.zipfs import ReadZipFS
+from simfile._private.nativeosfs import NativeOSFS
+
+
+# the filesystem for paths on disk
+NATIVE_FS = NativeOSFS()
+
+
+class _ArchiveMixin:
+    """Lets files be removed from an archive filesystem, by hiding them from
+    then on (e.g. for uploads.delete_dupe_sims())."""
+
+    archive_path: str
+
+    def _init_archive(self, archive_path: str):
+        self.archive_path = archive_path
+        self._removed: Set[str] = set()
+
+    def _is_removed(self, path: str) -> bool:
+        return abspath(normpath(path)) in self._removed
+
+    def getinfo(self, path, namespaces=None):
+        if self._is_removed(path):
+            raise ResourceNotFound(path)
+        return super().getinfo(path, namespaces)
+
+    def listdir(self, path):
+        return [
+            name for name in super().listdir(path)
+            if not self._is_removed(join(path, name))
+        ]
+
+    def scandir(self, path, namespaces=None, page=None):
+        for info in super().scandir(path, namespaces, page):
+            if not self._is_removed(join(path, info.name)):
+                yield info
+
+    def openbin(self, path, mode='r', buffering=-1, **options):
+        if self._is_removed(path):
+            raise ResourceNotFound(path)
+        return super().openbin(path, mode, buffering, **options)
+
+    def remove(self, path):
+        if not self.isfile(path):
+            raise FileExpected(path)
+        self._removed.add(abspath(normpath(path)))
+
+
+class ZipArchiveFS(_ArchiveMixin, ReadZipFS):
+    def __init__(self, archive_path: str):
+        super().__init__(archive_path)
+        self._init_archive(archive_path)
+
+
+class _TarMemberFile(RawWrapper):
+    # closes the member's own handle on the archive along with the member
+    def __init__(self, member_file, archive_file):
+        super().__init__(member_file)
+        self._archive_file = archive_file
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._archive_file.close()
+
+
+class _ThreadSafeReadTarFS(ReadTarFS):
+    """ReadTarFS reads every member through the tar's one file object,
+    seeking it back and forth, so members read in several threads at once
+    (e.g. by _AssetPipeline in uploads.py) get each other's data. Here, each
+    opened member reads the archive through a file object of its own."""
+
+    def __init__(self, file, encoding='utf-8'):
+        super().__init__(file, encoding)
+        # the index of the members also gets read through the tar's file
+        # object, so build it now rather than on first use, which might be
+        # in several threads at once
+        self._directory_entries
+
+    def openbin(self, path, mode='r', buffering=-1, **options):
+        _path = relpath(self.validatepath(path))
+        if 'w' in mode or '+' in mode or 'a' in mode:
+            raise ResourceReadOnly(path)
+        member = self._directory_entries.get(_path)
+        if member is None:
+            raise ResourceNotFound(path)
+        if not member.isfile():
+            raise FileExpected(path)
+
+        archive_file = open(self.archive_path, 'rb')
+        try:
+            # only reads the first header, the member comes from our index
+            tar = tarfile.TarFile(fileobj=archive_file)
+            return _TarMemberFile(tar.extractfile(member), archive_file)
+        except BaseException:
+            archive_file.close()
+            raise
+
+
+class TarArchiveFS(_ArchiveMixin, _ThreadSafeReadTarFS):
+    def __init__(self, archive_path: str):
+        super().__init__(archive_path)
+        self._init_archive(archive_path)
+
+
+ArchiveFS = ZipArchiveFS | TarArchiveFS
+
+
+def _is_uncompressed_tar(path: str) -> bool:
+    # members of compressed tars can only be read by decompressing
+    # everything before them
+    try:
+        with tarfile.open(path, 'r:'):
+            return True
+    except tarfile.TarError:
+        return False
+
+
+def open_archive(path: str) -> ArchiveFS | None:
+    """Open an archive as a filesystem, or return None if its format doesn't
+    support reading members on demand."""
+    if zipfile.is_zipfile(path):
+        return ZipArchiveFS(path)
+    if _is_uncompressed_tar(path):
+        return TarArchiveFS(path)
+    return None
+
+
+def remove_file(filesystem: FS, path: str):
+    """Remove a file (which for archives just hides it)."""
+    if isinstance(filesystem, NativeOSFS):
+        # NativeOSFS is read-only
+        os.remove(path)
+    else:
+        filesystem.remove(path)
+
+
+@contextmanager
+def syspath(filesystem: FS, path: str) -> Iterator[str]:
+    """Get the path of a file on disk, for tools that can only open files by
+    path. Files in archives are copied to a temporary file (with the same
+    extension), which is deleted on exit."""
+    if isinstance(filesystem, NativeOSFS):
+        yield path
+        return
+    ext = os.path.splitext(path)[1]
+    with filesystem.openbin(path) as src, \
+        tempfile.NamedTemporaryFile(suffix=ext) as dst:
+        shutil.copyfileobj(src, dst)
+        dst.flush()
+        yield dst.name
@@ -2,22 +2,29 @@
 using the `simfile` library.
 """
 
-from typing import Tuple, Dict
+from typing import Tuple, Dict, Iterator, List
 import hashlib
 import re
 import os
-import subprocess
 from simfile.types import Chart, Simfile
 from simfile.dir import SimfileDirectory, SimfilePack
+from fs.base import FS
 from simfile.notes.count import *
 from PIL import Image
 
 from .analysis import SongAnalyzer
+from .analysis.tokenizer import NoteTokens
+from .archive_fs import NATIVE_FS
+from .audio import get_audio_duration
 from .path import find_case_sensitive_path, convert_path_to_os_style
 
 
 IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
 SOUND_EXTS = ('.mp3', '.oga', '.ogg', '.wav')
+# the simfile properties that get_assets() looks for
+ASSET_PROPERTIES = (
+    'MUSIC', 'BANNER', 'BACKGROUND', 'CDTITLE', 'JACKET', 'CDIMAGE', 'DISC'
+)
 
 
 def _normalize_decimal(decimal):
@@ -34,58 +41,106 @@ def _normalize_float_digits(param):
     return ','.join(param_parts)
 
 
-def _minimize_measure(measure):
+# the note data is normalized this many characters at a time (give or take a
+# line), so that the whole normalized string never has to be in memory at once
+_HASH_CHUNK_SIZE = 1 << 16
+
+
+def _iter_normalized_lines(notes: str) -> Iterator[List[str]]:
+    # equivalent to normalizing newlines, stripping the note data, removing
+    # comments and whitespace, then splitting into lines, except that the
+    # lines are yielded in batches (one per chunk)
+    start = 0
+    end = len(notes)
+    while start < end and notes[start].isspace():
+        start += 1
+    while end > start and notes[end - 1].isspace():
+        end -= 1
+    while True:
+        # chunks always end right after a newline, so that line endings and
+        # comments are never split across chunks
+        cut = notes.find('\n', start + _HASH_CHUNK_SIZE, end) + 1
+        if cut <= 0:
+            cut = end
+        chunk = notes[start:cut]
+        chunk = re.sub(r'\r\n?', r'\n', chunk)
+        chunk = re.sub(r'//[^\n]*', '', chunk)
+        chunk = re.sub(r'[\r\t\f\v ]+', '', chunk)
+        lines = chunk.split('\n')
+        if cut == end:
+            yield lines
+            return
+        # drop the empty "line" after the chunk's last newline
+        lines.pop()
+        yield lines
+        start = cut
+
+
+def _minimize_measure(measure: List[str]) -> List[str]:
     if not measure:
-        # if the measure is empty, it will cause an infinite loop in
-        # the while loop after this, so we have to catch it now
         # TODO: figure out a more proper way of dealing with empty measures
         raise RuntimeError('chart contains an empty measure')
-    minimal = False
-    while not minimal and len(measure) % 2 == 0:
-        all_zeroes = True
-        for row in measure[1::2]:
-            if row != '0' * len(row):
-                all_zeroes = False
+    # halve the measure for as long as it has an even number of rows and all
+    # of its odd rows are empty. rather than actually slicing the measure every
+    # time, keep track of the spacing between the rows that are left
+    step = 1
+    while len(measure) % (step * 2) == 0 \
+        and not ''.join(measure[step::step * 2]).strip('0'):
+        step *= 2
+    return measure[::step]
+
+
+def _update_hash_with_minimized_chart(hasher, notes: str):
+    # the rows of the measure that's still being read (measures can span
+    # multiple chunks)
+    cur_measure = []
+    separator = ''
+    for lines in _iter_normalized_lines(notes):
+        start = 0
+        while True:
+            try:
+                comma = lines.index(',', start)
+            except ValueError:
+                cur_measure.extend(lines[start:])
                 break
-        if all_zeroes:
-            measure = measure[::2]
-        else:
-            minimal = True
-    return measure
+            cur_measure.extend(lines[start:comma])
+            hasher.update((
+                separator + '\n'.join(_minimize_measure(cur_measure)) + '\n,'
+            ).encode())
+            separator = '\n'
+            cur_measure = []
+            start = comma + 1
+    if cur_measure:
+        hasher.update(
+            (separator + '\n'.join(_minimize_measure(cur_measure))).encode()
+        )
 
 
-def _minimize_chart(chart_str):
-    final_data = []
-    cur_measure = []
-    for line in chart_str.split('\n'):
-        if line == ',':
-            cur_measure = _minimize_measure(cur_measure)
-            final_data.extend(cur_measure)
-            final_data.append(',')
-            cur_measure.clear()
-        else:
-            cur_measure.append(line)
-    if cur_measure:
-        cur_measure = _minimize_measure(cur_measure)
-        final_data.extend(cur_measure)
-    return '\n'.join(final_data)
-
-
-def get_hash(sim: Simfile, chart: Chart) -> str:
-    """Get the Groovestats hash of a chart."""
-    # TODO: is all this necessary?
-    notedata = chart.notes
-    notedata = re.sub(r'\r\n?', r'\n', notedata)
-    notedata = notedata.strip()
-    notedata = re.sub(r'//[^\n]*', '', notedata)
-    notedata = re.sub(r'[\r\t\f\v ]+', '', notedata)
-    notedata = _minimize_chart(notedata)
+def get_hash(
+    sim: Simfile, chart: Chart, note_tokens: NoteTokens | None = None
+) -> str:
+    """Get the Groovestats hash of a chart. If the chart's notes have already
+    been tokenized (e.g. by a ChartAnalyzer), pass in the NoteTokens to reuse
+    them."""
+    hasher = hashlib.sha1()
+    minimized = None
+    if note_tokens is not None and note_tokens.notes == chart.notes:
+        minimized = note_tokens.get_minimized_chart()
+    if minimized is not None:
+        hasher.update(minimized.encode())
+    else:
+        # normalize and minimize the notes one measure at a time, feeding
+        # them into the hash as we go
+        _update_hash_with_minimized_chart(hasher, chart.notes)
     # use .get() to handle SMChart gracefully
     bpms = _normalize_float_digits(chart.get('BPMS') or sim.bpms)
-    return hashlib.sha1((notedata + bpms).encode()).hexdigest()
+    hasher.update(bpms.encode())
+    return hasher.hexdigest()
 
 
-def _get_full_validated_asset_path(sim_dir_path: str, path: str):
+def _get_full_validated_asset_path(
+    sim_dir_path: str, path: str, filesystem: FS
+):
     if not path:
         return None
     path = convert_path_to_os_style(path.strip())
@@ -95,13 +150,14 @@ def _get_full_validated_asset_path(sim_dir_path: str, path: str):
     # we start the case-sensitive search from the pack directory so we can find
     # assets outside the simfile directory but still in the pack directory
     full_path = find_case_sensitive_path(
-        pack_path, os.path.relpath(insensitive_full_path, start=pack_path)
+        pack_path, os.path.relpath(insensitive_full_path, start=pack_path),
+        filesystem
     )
     
     # ensure path exists and does not point outside the pack
     if full_path and full_path.startswith(pack_path):
         # ensure path is a file
-        if os.path.isfile(full_path):
+        if filesystem.isfile(full_path):
             return full_path
     return None
 
@@ -130,20 +186,20 @@ def get_assets(simfile_dir: SimfileDirectory) -> Dict[str, str | None]:
 
     sim = simfile_dir.open(strict=False)
     sim_dir_path = os.path.normpath(simfile_dir.simfile_dir)
+    filesystem = simfile_dir.filesystem
 
     # first, try to populate fields using the simfile's fields
     assets = {
-        prop: _get_full_validated_asset_path(sim_dir_path, sim.get(prop))
-        for prop in (
-            'MUSIC', 'BANNER', 'BACKGROUND',
-            'CDTITLE', 'JACKET', 'CDIMAGE', 'DISC'
+        prop: _get_full_validated_asset_path(
+            sim_dir_path, sim.get(prop), filesystem
         )
+        for prop in ASSET_PROPERTIES
     }
 
     # stepmania represents directories as what is essentially an
     # std::set<File>, where File::operator<() compares by lowercased filename.
     # Thus, stepmania fetches files by (lowercase) alphabetical filename order.
-    file_list = sorted(os.listdir(sim_dir_path), key=str.lower)
+    file_list = sorted(filesystem.listdir(sim_dir_path), key=str.lower)
     # ignore filenames starting with "._" (macOS stuff)
     file_list = list(filter(
         lambda fname: not fname.startswith('._'),
@@ -190,10 +246,10 @@ def get_assets(simfile_dir: SimfileDirectory) -> Dict[str, str | None]:
 
         full_path = os.path.join(sim_dir_path, fname)
         try:
-            image = Image.open(full_path)
+            with filesystem.openbin(full_path) as f, Image.open(f) as image:
+                w, h = image.size
         except:
             continue # could not open image, skip
-        w, h = image.size
 
         if not assets['BACKGROUND'] and w >= 320 and h >= 240:
             assets['BACKGROUND'] = full_path
@@ -229,8 +285,11 @@ def get_pack_banner_path(pack_path: str, simfile_pack: SimfilePack) -> str | Non
     # as in get_assets(), stepmania draws potential pack banner files from
     # a std::set<File> which is sorted by (lowercase) alphabet order,
     # so here we sort the directory listing before iterating through.
+    file_list = sorted(
+        simfile_pack.filesystem.listdir(pack_path), key=str.lower
+    )
     for image_type in IMAGE_EXTS:
-        for item in sorted(os.listdir(pack_path), key=str.lower):
+        for item in file_list:
             if item.lower().endswith(image_type):
                 return os.path.join(pack_path, item)
 
@@ -240,21 +299,17 @@ def get_pack_banner_path(pack_path: str, simfile_pack: SimfilePack) -> str | Non
 
 
 def get_song_lengths(
-    music_path: str, song_analyzer: SongAnalyzer
+    music_path: str, song_analyzer: SongAnalyzer, filesystem: FS = NATIVE_FS
 ) -> Tuple[float, float] | None:
     """Return the song length (as displayed on the songwheel in StepMania).
     If the music file could not be opened, None is returned.
+
+    Instead of a SongAnalyzer, anything else with a get_chart_len() method
+    (e.g. uploads.SongAnalysis) can be passed in.
     """
-    # fetch music file duration using ffprobe
-    completed_process = subprocess.run([
-        'ffprobe', '-i', music_path, '-show_entries', 'format=duration',
-        '-v', 'quiet', '-of', 'csv=p=0'
-    ], capture_output=True, encoding='utf-8')
-    # check for failure
-    if completed_process.returncode != 0:
+    music_len = get_audio_duration(music_path, filesystem)
+    if music_len is None:
         return None
 
-    music_len = float(completed_process.stdout)
-
     chart_end = song_analyzer.get_chart_len()
     return max(music_len, chart_end), chart_end
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""An on-disk cache of downloaded pack files.
+
+The same link often gets fetched more than once (patches, retries, re-running
+a failed batch row), so downloads are kept in MEDIA_ROOT/download_cache. They
+are keyed by the normalized URL along with whatever validators the host sends
+(ETag, Last-Modified, Content-Length), so that a file that changed at the same
+URL is a miss. Responses with neither an ETag nor a Last-Modified header
+aren't cached, since we couldn't tell whether they changed.
+
+Entries are written to a temporary file and renamed into place, so an entry
+is always complete, even with several workers downloading at once. Once the
+cache is bigger than settings.DOWNLOAD_CACHE_MAX_BYTES, the least recently
+used entries (by mtime, which gets bumped on every hit) are evicted.
+
+Entries are handed out as hard links, so the caller can delete (or the cache
+can evict) its copy at any time.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable, Mapping
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+_TEMP_PREFIX = '.download-'
+# temporary files older than this are left over from crashed downloads
+_STALE_TEMP_AGE = 24 * 60 * 60
+
+
+def normalize_url(url: str) -> str:
+    """Normalize a URL, so that links to the same file map to the same cache
+    entry (and dropbox links point to the file itself)."""
+    parts = urlsplit(url.strip())
+    netloc = parts.netloc.lower()
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if netloc == 'www.dropbox.com':
+        # fetch the file itself instead of the preview page
+        query = [(k, v) for k, v in query if k != 'dl'] + [('dl', '1')]
+    return urlunsplit((
+        parts.scheme.lower(), netloc, parts.path or '/',
+        urlencode(sorted(query)), ''
+    ))
+
+
+def get_cache_key(url: str, headers: Mapping[str, str]) -> str | None:
+    """Get the cache key of a response, or None if it can't be cached."""
+    etag = headers.get('ETag')
+    last_modified = headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return None
+    key = '\n'.join((
+        normalize_url(url), etag or '', last_modified or '',
+        headers.get('Content-Length') or ''
+    ))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # e.g. on filesystems without hard links
+        shutil.copyfile(src, dst)
+
+
+class DownloadCache:
+    """A directory of cached downloads, holding at most max_bytes bytes
+    (0 disables the cache)."""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _get_entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def get(self, key: str, dest_path: str) -> bool:
+        """Put the cached file for `key` at dest_path, returning whether it
+        was cached."""
+        entry_path = self._get_entry_path(key)
+        try:
+            _link_or_copy(entry_path, dest_path)
+        except FileNotFoundError:
+            return False
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            pass # evicted in the meantime, but we've got our copy
+        return True
+
+    def put(self, key: str, download: Callable[[str], None], dest_path: str):
+        """Download a file into the cache under `key` with download(), which
+        is given the path to write it to, and put it at dest_path."""
+        os.makedirs(self.path, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=_TEMP_PREFIX)
+        os.close(fd)
+        try:
+            download(temp_path)
+            os.replace(temp_path, self._get_entry_path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        _link_or_copy(self._get_entry_path(key), dest_path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        max_bytes."""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.path):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith(_TEMP_PREFIX):
+                if now - stat.st_mtime > _STALE_TEMP_AGE:
+                    self._remove(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            self._remove(path)
+            total_size -= size
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # another worker got to it first
@@ -0,0 +1,252 @@
+"""Streaming downloads of pack files.
+
+HTTP(S) downloads go through requests, with one pooled session per host, so
+that e.g. scraping a download page and then downloading the file from the
+same host reuses the connection (see get_session()). On top of that:
+- if the server supports range requests and sends an ETag or Last-Modified
+  (to make sure the file doesn't change in between), a dropped connection is
+  resumed from where it left off, up to _MAX_ATTEMPTS times
+- files of at least settings.DOWNLOAD_SEGMENT_MIN_BYTES bytes are downloaded
+  in settings.DOWNLOAD_SEGMENTS ranged segments in parallel, each of which can
+  be resumed the same way
+- the bytes downloaded so far are reported to a progress callback, at most
+  every _PROGRESS_INTERVAL seconds
+
+Other URLs (e.g. file://) are just copied over with urllib.
+"""
+
+import re
+import threading
+from abc import ABC, abstractmethod
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Mapping
+from urllib.parse import urlsplit
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+
+USER_AGENT = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36'
+)
+# (connect, read) timeouts in seconds
+TIMEOUT = (15, 60)
+
+_CHUNK_SIZE = 1 << 16
+_MAX_ATTEMPTS = 5
+# seconds to wait before resuming, times the number of attempts so far
+_RETRY_DELAY = 2
+_PROGRESS_INTERVAL = 1
+# errors after which a download can be resumed
+_RESUMABLE_ERRORS = (
+    requests.ConnectionError, requests.Timeout,
+    requests.exceptions.ChunkedEncodingError
+)
+
+# called with the bytes downloaded so far, and the total (if known)
+ProgressCallback = Callable[[int, int | None], None]
+
+
+class DownloadError(Exception):
+    """Raised when a download fails in a way that can't be retried."""
+
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url: str) -> requests.Session:
+    """Get the session for the host of a URL."""
+    parts = urlsplit(url)
+    host = f'{parts.scheme.lower()}://{parts.netloc.lower()}'
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            session.headers['User-Agent'] = USER_AGENT
+            # enough connections for all the segments of a download
+            adapter = HTTPAdapter(
+                pool_maxsize=max(settings.DOWNLOAD_SEGMENTS, 1)
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[host] = session
+        return session
+
+
+class _Progress:
+    # thread-safe progress reporting (for parallel segments)
+
+    def __init__(self, callback: ProgressCallback | None, total: int | None):
+        self.callback = callback
+        self.total = total
+        self.done = 0
+        self._last_report = 0
+        self._lock = threading.Lock()
+
+    def add(self, size: int):
+        with self._lock:
+            self.done += size
+            now = time.monotonic()
+            if self.callback \
+                and now - self._last_report >= _PROGRESS_INTERVAL:
+                self._last_report = now
+                self.callback(self.done, self.total)
+
+    def finish(self):
+        if self.callback:
+            self.callback(self.done, self.total)
+
+
+class _Download(ABC):
+    """A download whose response headers are available right away (e.g. for
+    download_cache.get_cache_key()), and whose body is only read by save().
+    """
+
+    def __init__(self, response):
+        self._response = response
+        self.headers: Mapping[str, str] = response.headers
+
+    def close(self):
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @abstractmethod
+    def save(self, path: str):
+        """Download the file to path."""
+
+
+class HttpDownload(_Download):
+    """A download over HTTP(S)."""
+
+    def __init__(self, url: str, progress: ProgressCallback | None = None):
+        self.session = get_session(url)
+        response = self.session.get(url, stream=True, timeout=TIMEOUT)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        super().__init__(response)
+        # where we ended up after redirects
+        self.url = self._response.url
+
+        length = self.headers.get('Content-Length')
+        # with a content encoding, the length is that of the encoded body
+        self.size = int(length) if length and length.isdigit() \
+            and not self.headers.get('Content-Encoding') else None
+        # resuming requires a validator that If-Range accepts (i.e. not a
+        # weak etag), so that a changed file isn't spliced together
+        etag = self.headers.get('ETag')
+        self._validator = etag if etag and not etag.startswith('W/') \
+            else self.headers.get('Last-Modified')
+        self.resumable = bool(
+            self.size and self._validator
+            and self.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        )
+        self._progress = _Progress(progress, self.size)
+
+    def _request_range(self, start: int, end: int) -> requests.Response:
+        response = self.session.get(
+            self.url, stream=True, timeout=TIMEOUT, headers={
+                'Range': f'bytes={start}-{end - 1}',
+                'If-Range': self._validator,
+            }
+        )
+        if response.status_code != 206:
+            response.close()
+            response.raise_for_status()
+            # the server sent the whole file instead, i.e. it changed
+            raise DownloadError(f'{self.url} changed during the download')
+        return response
+
+    def _save_range(
+        self, path: str, start: int, end: int | None,
+        response: requests.Response | None = None
+    ):
+        # write bytes [start, end) of the file to the same place in the file
+        # at path, resuming if the connection drops. end is None if the size
+        # is unknown, in which case we read until the response ends
+        pos = start
+        attempt = 1
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            while True:
+                try:
+                    if response is None:
+                        response = self._request_range(pos, end)
+                    for chunk in response.iter_content(_CHUNK_SIZE):
+                        if end is not None:
+                            chunk = chunk[:end - pos]
+                        f.write(chunk)
+                        pos += len(chunk)
+                        self._progress.add(len(chunk))
+                        if end is not None and pos >= end:
+                            break
+                    if end is None or pos >= end:
+                        return
+                    raise requests.ConnectionError('response ended early')
+                except _RESUMABLE_ERRORS:
+                    if not self.resumable or attempt >= _MAX_ATTEMPTS:
+                        raise
+                    time.sleep(_RETRY_DELAY * attempt)
+                    attempt += 1
+                finally:
+                    if response is not None:
+                        response.close()
+                        response = None
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            if self.size:
+                # allocate the file so that segments can be written anywhere
+                f.truncate(self.size)
+        segments = settings.DOWNLOAD_SEGMENTS
+        if self.resumable and segments > 1 \
+            and self.size >= settings.DOWNLOAD_SEGMENT_MIN_BYTES:
+            self.close()
+            bounds = [self.size * i // segments for i in range(segments + 1)]
+            with ThreadPoolExecutor(segments) as executor:
+                futures = [
+                    executor.submit(self._save_range, path, start, end)
+                    for start, end in zip(bounds, bounds[1:]) if start < end
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            self._save_range(path, 0, self.size, self._response)
+        self._progress.finish()
+
+
+class UrllibDownload(_Download):
+    """A download of anything else urllib can open (e.g. file:// URLs)."""
+
+    def __init__(self, url: str, progress: ProgressCallback | None = None):
+        super().__init__(urllib.request.urlopen(url))
+        self.url = url
+        length = self.headers.get('Content-Length')
+        self.size = int(length) if length and length.isdigit() else None
+        self._progress = _Progress(progress, self.size)
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            while chunk := self._response.read(_CHUNK_SIZE):
+                f.write(chunk)
+                self._progress.add(len(chunk))
+        self._progress.finish()
+
+
+def open_download(
+    url: str, progress: ProgressCallback | None = None
+) -> _Download:
+    """Start downloading a URL."""
+    if re.match('https?://', url, re.IGNORECASE):
+        return HttpDownload(url, progress)
+    return UrllibDownload(url, progress)
@@ -0,0 +1,465 @@
+"""Selective extraction of pack archives that can't be read in place (rars,
+7zs, compressed tars; see archive_fs.py).
+
+Extracting a whole archive writes out everything in it, whereas an upload only
+reads a few files of each song, and a malicious archive could fill the disk.
+So we list the archive first and only extract what an upload needs, in two
+passes:
+1. simfiles, Pack.ini files and images (any of which get_assets() or
+   get_pack_banner_path() might pick)
+2. going by the extracted simfiles, the assets they reference (music, video
+   backgrounds etc.), plus for songs whose music isn't referenced, the first
+   audio file in the song's directory (again, see get_assets())
+Everything else (keysounds, unused videos, lua scripts...) is skipped.
+
+Each job can extract at most settings.EXTRACTION_MAX_BYTES bytes in
+settings.EXTRACTION_MAX_FILES files. On top of that, all jobs extracting into
+MEDIA_ROOT/extracted share settings.EXTRACTION_SCRATCH_BYTES: before each
+pass, a job reserves the bytes it's about to extract, waiting for other jobs
+to finish if there isn't enough space left. The reservations are kept in a
+file in MEDIA_ROOT, and last until they're released or their extraction
+directory is removed.
+
+The sizes come from the archive's listing. Zips and tars are extracted by us,
+so we also make sure that no member is bigger than it says it is. Other
+formats are extracted with unrar/7z, and the extracted files are checked
+against the budget afterwards.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+import zipfile
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+from django.conf import settings
+import simfile
+
+from .charts import ASSET_PROPERTIES, IMAGE_EXTS, SOUND_EXTS
+from .path import convert_path_to_os_style
+
+
+class ExtractionError(Exception):
+    """Raised when an archive can't be listed or extracted."""
+
+
+class ExtractionBudgetError(ExtractionError):
+    """Raised when extracting an archive would exceed the extraction budget.
+    """
+
+
+# a file in an archive
+ArchiveMember = namedtuple('ArchiveMember', ['name', 'size'])
+
+SIMFILE_EXTS = ('.sm', '.ssc')
+
+_RAR_MAGIC = b'Rar!\x1a\x07'
+_SEVEN_ZIP_PROGRAMS = ('7z', '7zz', '7za')
+_COPY_CHUNK_SIZE = 1 << 20
+# how long to wait for other jobs to free up scratch space
+_RESERVATION_TIMEOUT = 15 * 60
+_RESERVATION_POLL_INTERVAL = 5
+_RESERVATIONS_FILENAME = '.extraction_reservations'
+
+
+class ExtractionReport:
+    """What was (and wasn't) extracted from an archive."""
+
+    def __init__(self):
+        self.extracted: List[ArchiveMember] = []
+        self.skipped: List[ArchiveMember] = []
+
+    @property
+    def extracted_bytes(self) -> int:
+        return sum(m.size for m in self.extracted)
+
+    @property
+    def skipped_bytes(self) -> int:
+        return sum(m.size for m in self.skipped)
+
+    def __str__(self):
+        return (
+            f'extracted {len(self.extracted)} files '
+            f'({self.extracted_bytes / 1e6:.1f} MB), '
+            f'skipped {len(self.skipped)} files '
+            f'({self.skipped_bytes / 1e6:.1f} MB)'
+        )
+
+
+# Listing and extracting =============================================
+
+def _run(args: List[str]) -> str:
+    try:
+        completed_process = subprocess.run(
+            args, stdin=subprocess.DEVNULL, capture_output=True,
+            encoding='utf-8', errors='replace'
+        )
+    except OSError as e:
+        raise ExtractionError(f'could not run {args[0]}: {e}') from e
+    if completed_process.returncode != 0:
+        raise ExtractionError(
+            f'{args[0]} failed: {completed_process.stderr.strip()}'
+        )
+    return completed_process.stdout
+
+
+def _parse_listing(
+    output: str, name_key: str, sep: str, is_file
+) -> List[ArchiveMember]:
+    # parses the "technical" listings of unrar and 7z, which consist of
+    # blocks of "key<sep>value" lines, one block per member, each starting
+    # with the member's name
+    blocks = []
+    for line in output.splitlines():
+        key, found, value = line.strip().partition(sep)
+        if not found:
+            continue
+        if key == name_key:
+            blocks.append({})
+        if blocks:
+            blocks[-1][key] = value
+    return [
+        ArchiveMember(block[name_key], int(block.get('Size') or 0))
+        for block in blocks if is_file(block)
+    ]
+
+
+def _find_seven_zip() -> str | None:
+    for program in _SEVEN_ZIP_PROGRAMS:
+        if shutil.which(program):
+            return program
+    return None
+
+
+def _get_format(archive_path: str) -> str:
+    if zipfile.is_zipfile(archive_path):
+        return 'zip'
+    if tarfile.is_tarfile(archive_path):
+        return 'tar'
+    with open(archive_path, 'rb') as f:
+        is_rar = f.read(len(_RAR_MAGIC)) == _RAR_MAGIC
+    if is_rar and shutil.which('unrar'):
+        return 'rar'
+    # 7z handles just about everything else (including rars, if unrar isn't
+    # installed)
+    if _find_seven_zip():
+        return '7z'
+    raise ExtractionError('unsupported archive format')
+
+
+def list_archive(archive_path: str) -> List[ArchiveMember]:
+    """List the files in an archive (directories aren't included)."""
+    archive_format = _get_format(archive_path)
+    if archive_format == 'zip':
+        with zipfile.ZipFile(archive_path) as z:
+            return [
+                ArchiveMember(info.filename, info.file_size)
+                for info in z.infolist() if not info.is_dir()
+            ]
+    if archive_format == 'tar':
+        with tarfile.open(archive_path) as t:
+            return [
+                ArchiveMember(info.name, info.size)
+                for info in t.getmembers() if info.isfile()
+            ]
+    if archive_format == 'rar':
+        output = _run(['unrar', 'lt', '-p-', archive_path])
+        return _parse_listing(
+            output, 'Name', ': ', lambda b: b.get('Type') == 'File'
+        )
+    output = _run([_find_seven_zip(), 'l', '-slt', archive_path])
+    # the first block describes the archive itself
+    output = output.partition('\n----------\n')[2]
+    return _parse_listing(
+        output, 'Path', ' = ',
+        lambda b: b.get('Folder') != '+'
+        and not b.get('Attributes', '').startswith('D')
+    )
+
+
+def _get_safe_path(extract_path: str, name: str) -> str | None:
+    # where to extract a member to, or None if it would end up outside the
+    # extraction directory
+    path = os.path.normpath(os.path.join(extract_path, name.lstrip('/')))
+    if not path.startswith(extract_path + os.path.sep):
+        return None
+    return path
+
+
+def _copy_member(src, dst_path: str, size: int):
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    written = 0
+    with open(dst_path, 'wb') as dst:
+        while chunk := src.read(_COPY_CHUNK_SIZE):
+            written += len(chunk)
+            if written > size:
+                raise ExtractionBudgetError(
+                    f'{dst_path} is bigger than the archive says'
+                )
+            dst.write(chunk)
+
+
+def _extract_with_program(
+    archive_path: str, archive_format: str, names: List[str],
+    extract_path: str
+):
+    with tempfile.NamedTemporaryFile(
+        'w', encoding='utf-8', suffix='.txt'
+    ) as list_file:
+        list_file.write('\n'.join(names) + '\n')
+        list_file.flush()
+        if archive_format == 'rar':
+            _run([
+                'unrar', 'x', '-o+', '-p-', '-scul', archive_path,
+                '@' + list_file.name, extract_path + os.path.sep
+            ])
+        else:
+            # -spd: don't treat the names as wildcards
+            _run([
+                _find_seven_zip(), 'x', '-y', '-spd', '-scsUTF-8',
+                '-o' + extract_path, archive_path, '@' + list_file.name
+            ])
+
+
+def _get_extracted_size(extract_path: str) -> tuple[int, int]:
+    # returns the number of files and bytes in the extraction directory
+    files = 0
+    size = 0
+    for dir_path, _, filenames in os.walk(extract_path):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(dir_path, filename))
+    return files, size
+
+
+def extract_members(
+    archive_path: str, members: Iterable[ArchiveMember], extract_path: str
+):
+    """Extract the given members of an archive into extract_path. Members
+    with paths leading outside of extract_path are ignored."""
+    members = [
+        m for m in members if _get_safe_path(extract_path, m.name) is not None
+    ]
+    if not members:
+        return
+    archive_format = _get_format(archive_path)
+    if archive_format == 'zip':
+        with zipfile.ZipFile(archive_path) as z:
+            for member in members:
+                with z.open(member.name) as src:
+                    _copy_member(
+                        src, _get_safe_path(extract_path, member.name),
+                        member.size
+                    )
+    elif archive_format == 'tar':
+        # go through the tar in order, since seeking back in a compressed tar
+        # means decompressing it from the start again
+        sizes = {m.name: m.size for m in members}
+        with tarfile.open(archive_path) as t:
+            for info in t:
+                if info.isfile() and info.name in sizes:
+                    with t.extractfile(info) as src:
+                        _copy_member(
+                            src, _get_safe_path(extract_path, info.name),
+                            sizes.pop(info.name)
+                        )
+    else:
+        _extract_with_program(
+            archive_path, archive_format, [m.name for m in members],
+            extract_path
+        )
+
+
+# Planning ===========================================================
+
+def _is_first_pass_member(member: ArchiveMember) -> bool:
+    name = os.path.basename(member.name).lower()
+    return name == 'pack.ini' or name.endswith(SIMFILE_EXTS + IMAGE_EXTS)
+
+
+def _normalize_member_name(name: str) -> str:
+    return os.path.normpath(name.lstrip('/')).lower()
+
+
+def _get_second_pass_members(
+    members: List[ArchiveMember], extract_path: str
+) -> List[ArchiveMember]:
+    # the assets referenced by the extracted simfiles, and the audio files
+    # that get_assets() would fall back to
+    members_by_path = {_normalize_member_name(m.name): m for m in members}
+    needed: Dict[str, ArchiveMember] = {}
+    dirs_without_music = set()
+    for path, member in members_by_path.items():
+        if not path.endswith(SIMFILE_EXTS):
+            continue
+        sim_dir = os.path.dirname(path)
+        try:
+            sim = simfile.open(
+                _get_safe_path(extract_path, member.name), strict=False
+            )
+        except Exception:
+            continue # the upload will skip this song anyway
+        has_music = False
+        for prop in ASSET_PROPERTIES:
+            value = sim.get(prop)
+            if not value:
+                continue
+            asset_path = os.path.normpath(os.path.join(
+                sim_dir, convert_path_to_os_style(value.strip()).lower()
+            ))
+            if asset_path in members_by_path:
+                needed[asset_path] = members_by_path[asset_path]
+                has_music = has_music or prop == 'MUSIC'
+        if not has_music:
+            dirs_without_music.add(sim_dir)
+
+    for path in sorted(members_by_path):
+        sim_dir = os.path.dirname(path)
+        if sim_dir in dirs_without_music and path.endswith(SOUND_EXTS) \
+            and not os.path.basename(path).startswith('._'):
+            needed[path] = members_by_path[path]
+            dirs_without_music.remove(sim_dir)
+    return list(needed.values())
+
+
+# Scratch space ======================================================
+
+def _open_locked(path: str):
+    while True:
+        f = open(path, 'a+', encoding='utf-8')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # the file might've been removed while we were waiting for the lock
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+@contextmanager
+def _locked_reservations():
+    # yields the reservations (extraction directory -> bytes) of all the
+    # jobs, which can be modified while the file is locked
+    path = os.path.join(settings.MEDIA_ROOT, _RESERVATIONS_FILENAME)
+    with _open_locked(path) as f:
+        f.seek(0)
+        contents = f.read()
+        reservations = json.loads(contents) if contents else {}
+        # the jobs that removed their extraction directories are done
+        reservations = {
+            p: size for p, size in reservations.items() if os.path.isdir(p)
+        }
+        yield reservations
+        if reservations:
+            f.seek(0)
+            f.truncate()
+            json.dump(reservations, f)
+        else:
+            os.remove(path)
+
+
+def reserve_scratch_space(extract_path: str, size: int):
+    """Reserve another `size` bytes of scratch space for the (existing)
+    extraction directory extract_path, waiting for other jobs to free up
+    space if necessary. The reservation is released once the directory is
+    removed or release_scratch_space() is called. Raises
+    ExtractionBudgetError if the space doesn't become available in time."""
+    extract_path = os.path.abspath(extract_path)
+    limit = settings.EXTRACTION_SCRATCH_BYTES
+    deadline = time.monotonic() + _RESERVATION_TIMEOUT
+    while True:
+        with _locked_reservations() as reservations:
+            own = reservations.get(extract_path, 0)
+            if limit and own + size > limit:
+                raise ExtractionBudgetError(
+                    f'extraction needs {own + size} bytes, but the scratch '
+                    f'space is only {limit} bytes'
+                )
+            if not limit or sum(reservations.values()) + size <= limit:
+                reservations[extract_path] = own + size
+                return
+        if time.monotonic() >= deadline:
+            raise ExtractionBudgetError('timed out waiting for scratch space')
+        time.sleep(_RESERVATION_POLL_INTERVAL)
+
+
+def release_scratch_space(extract_path: str):
+    """Release the scratch space reserved for an extraction directory (which
+    also happens by itself once the directory is removed)."""
+    with _locked_reservations() as reservations:
+        reservations.pop(os.path.abspath(extract_path), None)
+
+
+# ====================================================================
+
+def _check_budget(members: List[ArchiveMember]):
+    max_files = settings.EXTRACTION_MAX_FILES
+    max_bytes = settings.EXTRACTION_MAX_BYTES
+    size = sum(m.size for m in members)
+    if max_files and len(members) > max_files:
+        raise ExtractionBudgetError(
+            f'pack has {len(members)} files to extract, more than the '
+            f'maximum of {max_files}'
+        )
+    if max_bytes and size > max_bytes:
+        raise ExtractionBudgetError(
+            f'pack has {size} bytes to extract, more than the maximum of '
+            f'{max_bytes}'
+        )
+
+
+def _extract_pass(
+    archive_path: str, members: List[ArchiveMember], extract_path: str,
+    report: ExtractionReport
+):
+    report.extracted += members
+    _check_budget(report.extracted)
+    reserve_scratch_space(extract_path, sum(m.size for m in members))
+    extract_members(archive_path, members, extract_path)
+
+
+def extract_pack_archive(
+    archive_path: str, extract_path: str
+) -> ExtractionReport:
+    """Extract the files of an archive that a pack upload needs into
+    extract_path. Raises ExtractionError if the archive can't be extracted,
+    or ExtractionBudgetError if the files exceed the extraction budget. The
+    extraction directory should be removed on failure."""
+    extract_path = os.path.abspath(extract_path)
+    all_members = list_archive(archive_path)
+    members = [
+        m for m in all_members
+        if _get_safe_path(extract_path, m.name) is not None
+    ]
+    os.makedirs(extract_path, exist_ok=True)
+    report = ExtractionReport()
+
+    first_pass = [m for m in members if _is_first_pass_member(m)]
+    _extract_pass(archive_path, first_pass, extract_path, report)
+    first_pass_names = set(m.name for m in first_pass)
+    second_pass = [
+        m for m in _get_second_pass_members(members, extract_path)
+        if m.name not in first_pass_names
+    ]
+    _extract_pass(archive_path, second_pass, extract_path, report)
+
+    extracted_names = first_pass_names | set(m.name for m in second_pass)
+    report.skipped = [
+        m for m in all_members if m.name not in extracted_names
+    ]
+
+    # we can't tell unrar/7z to stop at the sizes from the listing, so check
+    # what they actually extracted
+    files, size = _get_extracted_size(extract_path)
+    if size > report.extracted_bytes or files > len(report.extracted):
+        raise ExtractionBudgetError(
+            'extracted files are bigger than the archive says'
+        )
+    return report
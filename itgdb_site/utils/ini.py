@@ -1,16 +1,20 @@
 """Utility for parsing INI files. I rolled my own instead of using configparser
 in order to emulate ITGmania's behavior as closely as possible."""
 
+from fs.base import FS
+
+from .archive_fs import NATIVE_FS
+
 class IniFile:
     """Holds data from an INI file."""
 
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, filesystem: FS = NATIVE_FS):
         """Parses the INI file at `file_path`. Encoding is assumed to be
         UTF-8, which is probably fine?"""
         self.sections: dict[str, dict[str, str]] = {}
         self.raw_text = ''
 
-        with open(file_path, 'r', encoding='utf-8') as file:
+        with filesystem.open(file_path, 'r', encoding='utf-8') as file:
             # essentially a port of the logic in IniFile::ReadFile()
             accum_line = ''
             cur_section = None
@@ -2,6 +2,9 @@
 
 import os
 from pathlib import Path, PureWindowsPath
+from fs.base import FS
+
+from .archive_fs import NATIVE_FS
 
 # TODO: consider using pathlib instead of passing around paths as strings
 
@@ -11,19 +14,21 @@ def convert_path_to_os_style(path: str) -> str:
 
 
 # https://stackoverflow.com/a/37708342
-def find_case_sensitive_path(dir: str, insensitive_path: str) -> str | None:
+def find_case_sensitive_path(
+    dir: str, insensitive_path: str, filesystem: FS = NATIVE_FS
+) -> str | None:
     insensitive_path = os.path.normpath(insensitive_path)
     insensitive_path = insensitive_path.lstrip(os.path.sep)
 
     parts = insensitive_path.split(os.path.sep, 1)
     next_name = parts[0]
-    for name in os.listdir(dir):
+    for name in filesystem.listdir(dir):
         if next_name.lower() == name.lower():
             improved_path = os.path.join(dir, name)
             if len(parts) == 1:
                 return improved_path
             else:
                 return find_case_sensitive_path(
-                    improved_path, parts[1]
+                    improved_path, parts[1], filesystem
                 )
     return None
\ No newline at end of file
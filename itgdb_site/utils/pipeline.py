@@ -0,0 +1,235 @@
+"""A pipeline that runs a sequence of items through a series of stages, e.g.
+downloading, extracting and uploading the packs of a batch upload, so that the
+earlier stages work on the next items while the later ones are still busy with
+the previous ones. The batch then takes about as long as its slowest stage,
+rather than as long as all of them put together.
+
+Each stage but the last runs in its own pool of threads, and hands its output
+over to the next stage through a queue of at most queue_size items, so a fast
+stage only ever gets a few items ahead of a slow one. The last stage runs in
+the thread that called Pipeline.run() (for batch uploads, that's the one
+writing to the database), which is also where on_result() gets called.
+
+Since items that are ahead of the slowest stage take up disk space (e.g.
+downloaded pack archives), the first stage doesn't start on another item
+while the items in the pipeline add up to more than high_water_bytes bytes
+(according to get_size(), which is called on the output of every stage but
+the last; items still in the first stage count as 0 bytes). It always gets to
+start on one when the pipeline is empty though, however big the items are.
+"""
+
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Sequence
+from django.db import connections
+
+# how often (in seconds) threads blocked on a queue check whether the
+# pipeline has been stopped
+_POLL_INTERVAL = 0.1
+# put into a stage's queue once per thread of the stage, after the last item
+_DONE = object()
+
+
+class Stage(NamedTuple):
+    """A stage of a Pipeline. func is called with the output of the previous
+    stage for each item (or the item itself, for the first stage), in up to
+    `threads` threads at once (ignored for the last stage).
+
+    func takes ownership of its input: if it raises, it should clean up after
+    the input itself, like the item never made it this far."""
+    name: str
+    func: Callable[[Any], Any]
+    threads: int = 1
+
+
+class PipelineResult(NamedTuple):
+    """The outcome of an item: the output of the last stage, or the exception
+    the item failed with and the name of the stage it failed in."""
+    value: Any = None
+    error: Exception | None = None
+    stage: str | None = None
+
+
+class Pipeline:
+    """Runs items through stages, see the module docstring. Items that fail
+    in a stage are dropped from the pipeline, without holding up the others.
+
+    discard() is called with the output of a stage that won't make it to the
+    next one, because the pipeline got interrupted (e.g. by the task running
+    it being terminated) while it was waiting in a queue."""
+
+    def __init__(
+        self,
+        stages: Sequence[Stage],
+        queue_size: int = 1,
+        high_water_bytes: int = 0,
+        get_size: Callable[[Any], int] | None = None,
+        discard: Callable[[Any], None] | None = None,
+        on_result: Callable[[Any, PipelineResult], None] | None = None
+    ):
+        if not stages:
+            raise ValueError('a pipeline needs at least one stage')
+        self.stages = stages
+        self.queue_size = max(queue_size, 1)
+        self.high_water_bytes = high_water_bytes
+        self.get_size = get_size or (lambda value: 0)
+        self.discard = discard or (lambda value: None)
+        self.on_result = on_result or (lambda item, result: None)
+
+        self._cond = threading.Condition()
+        # item index -> bytes taken up, for every item in the pipeline
+        self._sizes: Dict[int, int] = {}
+        # number of threads of each stage, and how many haven't finished yet
+        self._thread_counts: List[int] = []
+        self._running: List[int] = []
+        # item index -> result, for every item that's made it through
+        self._results: Dict[int, PipelineResult] = {}
+        self._stopped = False
+
+    # the first stage waits for the pipeline to drain below the high-water
+    # mark before taking another item
+
+    def _can_start(self) -> bool:
+        return self._stopped or not self._sizes or self.high_water_bytes <= 0 \
+            or sum(self._sizes.values()) < self.high_water_bytes
+
+    def _start_item(self, index: int):
+        with self._cond:
+            self._cond.wait_for(self._can_start)
+            self._sizes[index] = 0
+
+    def _set_size(self, index: int, value: Any):
+        try:
+            size = self.get_size(value)
+        except OSError:
+            size = 0
+        with self._cond:
+            self._sizes[index] = size
+
+    def _finish_item(self, index: int):
+        with self._cond:
+            self._sizes.pop(index, None)
+            self._cond.notify_all()
+
+    # queue operations that give up once the pipeline is stopped, rather
+    # than blocking forever on a stage that isn't running anymore
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self._stopped:
+            try:
+                return q.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _put(self, q: queue.Queue, entry: Any) -> bool:
+        while not self._stopped:
+            try:
+                q.put(entry, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run_stage(self, stage_index: int, queues: List[queue.Queue]):
+        stage = self.stages[stage_index]
+        is_last = stage_index == len(self.stages) - 1
+        while (entry := self._get(queues[stage_index])) is not _DONE:
+            index, item, value = entry
+            if isinstance(value, PipelineResult):
+                # an item that failed in an earlier stage
+                self._finish(index, item, value)
+                continue
+            if stage_index == 0:
+                self._start_item(index)
+            try:
+                output = stage.func(value)
+            except Exception as e:
+                result = PipelineResult(error=e, stage=stage.name)
+                if is_last:
+                    self._finish(index, item, result)
+                elif not self._put(queues[-1], (index, item, result)):
+                    self._finish_item(index)
+                continue
+            if is_last:
+                self._finish(index, item, PipelineResult(output))
+                continue
+            self._set_size(index, output)
+            if not self._put(queues[stage_index + 1], (index, item, output)):
+                self.discard(output)
+                self._finish_item(index)
+
+        if is_last:
+            return
+        with self._cond:
+            self._running[stage_index] -= 1
+            last_thread = self._running[stage_index] == 0
+        if last_thread:
+            # let every thread of the next stage know there's nothing left
+            for _ in range(self._thread_counts[stage_index + 1]):
+                self._put(queues[stage_index + 1], _DONE)
+
+    def _finish(self, index: int, item: Any, result: PipelineResult):
+        # only ever called in the last stage's thread
+        self._finish_item(index)
+        self._results[index] = result
+        self.on_result(item, result)
+
+    def _run_thread(self, stage_index: int, queues: List[queue.Queue]):
+        try:
+            self._run_stage(stage_index, queues)
+        finally:
+            # the stages may use the database (e.g. for progress updates)
+            connections.close_all()
+
+    def run(self, items: Iterable[Any]) -> List[PipelineResult]:
+        """Run items through the pipeline, returning their results in the
+        same order."""
+        items = list(items)
+        self._results = {}
+        self._stopped = False
+        self._sizes = {}
+        # the last stage runs in this thread
+        self._thread_counts = [
+            max(stage.threads, 1) for stage in self.stages[:-1]
+        ] + [1]
+        self._running = list(self._thread_counts)
+        queues = [queue.Queue()] + [
+            queue.Queue(self.queue_size) for _ in self.stages[1:]
+        ]
+        # the first stage's queue holds all the items from the start, with
+        # the item itself as the input to the first stage
+        for index, item in enumerate(items):
+            queues[0].put((index, item, item))
+        for _ in range(self._thread_counts[0]):
+            queues[0].put(_DONE)
+
+        threads = [
+            threading.Thread(
+                target=self._run_thread, args=(stage_index, queues),
+                daemon=True
+            )
+            for stage_index, count in enumerate(self._thread_counts[:-1])
+            for _ in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            self._run_stage(len(self.stages) - 1, queues)
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+            for thread in threads:
+                thread.join()
+            # clean up whatever was left waiting between stages
+            for q in queues[1:]:
+                while True:
+                    try:
+                        entry = q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if entry is not _DONE \
+                        and not isinstance(entry[2], PipelineResult):
+                        self.discard(entry[2])
+        return [self._results[index] for index in range(len(items))]
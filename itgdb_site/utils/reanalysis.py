@@ -0,0 +1,258 @@
+"""Routines for incrementally re-analyzing the songs/charts in the database.
+
+Every analysis component stored in the database is tagged with the version of
+the analyzer that computed it (see ANALYZER_VERSIONS). When the analysis code
+changes, only the components whose stored version is older than the current
+one need to be recomputed.
+
+Songs are processed in order of id, and each song's results are committed
+in their own short transaction, which only locks the song while its results
+are written (the analysis itself happens before that, without holding any
+locks, so uploads and patches aren't held up). Since the stored versions are
+updated along with the results, a re-analysis that gets interrupted can
+simply be run again: the songs that were already committed are no longer
+outdated, so they get skipped. Songs that fail to be analyzed are logged and
+skipped, so one bad simfile doesn't keep the rest from being brought up to
+date.
+
+A chart's density graph ends at its song's chart length, so when the chart
+length of a song changes, its charts' density graphs get recomputed too.
+
+Chart hashes aren't versioned, since they have to match GrooveStats' hashes
+exactly. rehash_song() just recomputes them from scratch.
+
+Breakdowns are generated from the stored stream info rather than from the
+simfile, so they get regenerated whenever the stream info is recomputed, or
+when their own version is outdated.
+"""
+
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Iterator
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, QuerySet
+import simfile
+from celery.utils.log import get_task_logger
+from simfile.types import Simfile
+
+from ..models import Song, Chart
+from .analysis import SongAnalyzer, AnalysisCache, get_chart_key
+from .analysis.analyzer import ANALYZER_VERSIONS, CHART_ANALYSIS_COMPONENTS
+from .analysis.breakdown import generate_breakdowns
+from .charts import get_hash
+
+logger = get_task_logger(__name__)
+
+DEFAULT_CHUNK_SIZE = 50
+
+
+@contextmanager
+def open_stored_simfile(song: Song) -> Iterator[Simfile]:
+    """Open the simfile stored for the given song. Raises FileNotFoundError
+    if it doesn't exist."""
+    file = song.simfile
+    ext = file.name.rsplit('.', 1)[1]
+    tmp_path = os.path.join(settings.MEDIA_ROOT, f'{uuid.uuid4()}.{ext}')
+    try:
+        # copy simfile contents to a temp file on disk so that we can
+        # use simfile.open() with its encoding autodetection
+        with file.open(mode='rb') as f, open(tmp_path, 'wb') as tmp:
+            shutil.copyfileobj(f, tmp)
+        yield simfile.open(tmp_path, strict=False)
+    finally:
+        # cleanup temp file
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def _outdated_chart_q(prefix: str = '') -> Q:
+    q = Q()
+    for component in (*CHART_ANALYSIS_COMPONENTS, 'breakdowns'):
+        q |= Q(**{
+            f'{prefix}{component}_version__lt': ANALYZER_VERSIONS[component]
+        })
+    return q
+
+
+def get_outdated_charts() -> QuerySet:
+    """Get the charts with at least one outdated analysis component."""
+    return Chart.objects.filter(_outdated_chart_q())
+
+
+def get_outdated_songs() -> QuerySet:
+    """Get the songs whose chart length or charts have outdated analyses."""
+    return Song.objects.filter(
+        Q(chart_length_version__lt=ANALYZER_VERSIONS['chart_length']) |
+        _outdated_chart_q('chart__')
+    ).distinct()
+
+
+def _find_chart(sim: Simfile, chart_obj: Chart):
+    # find the simfile chart the given chart was uploaded from
+    key = chart_obj.get_chart_key()
+    return next((c for c in sim.charts if get_chart_key(c) == key), None)
+
+
+def reanalyze_song(song: Song, analysis_cache: AnalysisCache) -> bool:
+    """Recompute the outdated analysis components of a song and its charts,
+    and write them in one transaction. Returns False if the song's simfile
+    couldn't be found."""
+    chart_len_version = ANALYZER_VERSIONS['chart_length']
+    song_fields = []
+    chart_fields = {}
+    try:
+        with open_stored_simfile(song) as sim:
+            song_analyzer = SongAnalyzer(sim)
+
+            chart_len_changed = False
+            if song.chart_length_version < chart_len_version:
+                chart_len = song_analyzer.get_chart_len()
+                chart_len_changed = chart_len != song.chart_length
+                song.chart_length = chart_len
+                song.chart_length_version = chart_len_version
+                song_fields = ['chart_length', 'chart_length_version']
+
+            charts = song.chart_set.all() if chart_len_changed \
+                else song.chart_set.filter(_outdated_chart_q())
+            for chart_obj in charts:
+                if chart_len_changed:
+                    # the density graph's end point moved
+                    chart_obj.density_graph_version = 0
+                chart_fields[chart_obj] = _reanalyze_chart(
+                    chart_obj, song_analyzer, analysis_cache
+                )
+    except FileNotFoundError:
+        return False
+
+    with transaction.atomic():
+        # lock the song while writing, and skip it if it got deleted or
+        # patched with a new simfile in the meantime (the patch will have
+        # analyzed the new one)
+        current = Song.objects.select_for_update() \
+            .filter(pk=song.pk).values_list('simfile', flat=True).first()
+        if current != song.simfile.name:
+            return True
+        if song_fields:
+            song.save(update_fields=song_fields)
+        existing_ids = set(
+            song.chart_set.values_list('id', flat=True)
+        )
+        for chart_obj, fields in chart_fields.items():
+            if fields and chart_obj.id in existing_ids:
+                chart_obj.save(update_fields=fields)
+    return True
+
+
+def _reanalyze_chart(
+    chart_obj: Chart,
+    song_analyzer: SongAnalyzer,
+    analysis_cache: AnalysisCache
+) -> list:
+    # update the chart's outdated components (without saving it), returning
+    # the fields that changed
+    outdated = [
+        component for component in CHART_ANALYSIS_COMPONENTS
+        if getattr(chart_obj, f'{component}_version') <
+            ANALYZER_VERSIONS[component]
+    ]
+    fields = []
+    if outdated:
+        chart = _find_chart(song_analyzer.sim, chart_obj)
+        if chart is None:
+            # nothing we can do here; the chart stays outdated
+            return fields
+        chart_analysis = analysis_cache.analyze(
+            song_analyzer.get_chart_analyzer(chart)
+        )
+    for component in outdated:
+        if component == 'counts':
+            for k, v in chart_analysis.counts.items():
+                setattr(chart_obj, k + '_count', v)
+                fields.append(k + '_count')
+        else:
+            chart_obj.analysis[component] = getattr(chart_analysis, component)
+            fields.append('analysis')
+        setattr(
+            chart_obj, f'{component}_version', ANALYZER_VERSIONS[component]
+        )
+        fields.append(f'{component}_version')
+
+    if 'stream_info' in outdated or \
+        chart_obj.breakdowns_version < ANALYZER_VERSIONS['breakdowns']:
+        update_breakdowns(chart_obj)
+        fields += ['breakdowns', 'breakdowns_version']
+    return list(dict.fromkeys(fields))
+
+
+def update_breakdowns(chart_obj: Chart):
+    """Regenerate a chart's breakdowns from its stored stream info (without
+    saving the chart)."""
+    stream_info = chart_obj.analysis.get('stream_info')
+    if stream_info is None:
+        return
+    chart_obj.breakdowns = generate_breakdowns(stream_info)
+    chart_obj.breakdowns_version = ANALYZER_VERSIONS['breakdowns']
+
+
+def reanalyze_outdated(
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    analysis_cache: AnalysisCache | None = None,
+    progress_callback: Callable[[int, int, Song], None] | None = None
+) -> int:
+    """Re-analyze every song with outdated analyses, fetching chunk_size
+    songs at a time. progress_callback, if given, is called before processing
+    each song with the number of songs processed so far, the total number of
+    songs to process, and the song itself. Returns the number of songs
+    processed (including ones that failed and were skipped).
+    """
+    if analysis_cache is None:
+        analysis_cache = AnalysisCache()
+    song_ids = list(
+        get_outdated_songs().order_by('id').values_list('id', flat=True)
+    )
+    total = len(song_ids)
+    done = 0
+    for start in range(0, total, chunk_size):
+        chunk_ids = song_ids[start:start + chunk_size]
+        # skip any songs that got brought up to date in the meantime (e.g. by
+        # a concurrent re-analysis)
+        songs = get_outdated_songs().filter(id__in=chunk_ids).order_by('id')
+        for song in songs:
+            if progress_callback:
+                progress_callback(done, total, song)
+            try:
+                reanalyze_song(song, analysis_cache)
+            except Exception:
+                # it stays outdated, so the next run tries it again
+                logger.warning(
+                    f'Could not re-analyze song {song.id} ({song})',
+                    exc_info=True
+                )
+            done += 1
+        # songs that were skipped still count as done
+        done = start + len(chunk_ids)
+    return done
+
+
+def rehash_song(song: Song) -> int | None:
+    """Recompute the hashes of a song's charts from its stored simfile.
+    Returns the number of charts whose hash changed, or None if the song's
+    simfile couldn't be found."""
+    changed = 0
+    try:
+        with open_stored_simfile(song) as sim:
+            for chart_obj in song.chart_set.all():
+                chart = _find_chart(sim, chart_obj)
+                if chart is None:
+                    continue
+                chart_hash = get_hash(sim, chart)
+                if chart_hash != chart_obj.chart_hash:
+                    chart_obj.chart_hash = chart_hash
+                    chart_obj.save(update_fields=['chart_hash'])
+                    changed += 1
+    except FileNotFoundError:
+        return None
+    return changed
@@ -0,0 +1,112 @@
+"""Deleting files from content-addressed storage once nothing uses them.
+
+Files in content-addressed storage (see storage_backends.py) can be shared by
+several rows, so a file may only be deleted once no row refers to it anymore.
+That's not enough on its own though: an upload that's still in progress may
+have found a file already stored and be about to refer to it, but its rows
+aren't visible to anyone else until it commits, which can take hours. Locking
+each file until then would take thousands of locks for a big upload, and make
+uploads that share files wait on (or deadlock with) each other.
+
+Instead, anything that stores files holds one shared lock for as long as its
+transaction lasts (see storing_files()), and files that might not be used
+anymore only get queued up for deletion, as PendingFileDeletions. They're
+deleted by delete_unused_files() while nothing holds that lock, i.e. once
+every upload that might have reused them has either committed its rows or
+rolled back. Whatever stops storing files last runs it.
+"""
+
+from contextlib import contextmanager
+from django.db import connection, transaction
+from sorl.thumbnail import delete
+
+from ..models import ImageFile, Song, PendingFileDeletion
+
+# the fields whose files are in content-addressed storage (django-cleanup
+# ignores these models, see signals.py)
+CONTENT_ADDRESSED_FIELDS = {ImageFile: 'image', Song: 'simfile'}
+_MODELS_BY_NAME = {
+    model._meta.model_name: model for model in CONTENT_ADDRESSED_FIELDS
+}
+
+# key of the postgres advisory lock held (shared) while storing files
+_STORING_FILES_LOCK = 0x17_6D_B5_70
+# number of files to delete per transaction, so that uploads waiting to
+# start storing files don't wait for long
+_DELETE_BATCH_SIZE = 100
+
+
+@contextmanager
+def storing_files():
+    """Hold while storing files in content-addressed storage, around the
+    transaction that saves the rows referring to them (i.e. outside of
+    transaction.atomic(), otherwise the lock is released before the rows are
+    committed)."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_advisory_lock_shared(%s)', [_STORING_FILES_LOCK]
+        )
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_unlock_shared(%s)', [_STORING_FILES_LOCK]
+            )
+    delete_unused_files()
+
+
+def queue_file_deletion(model, name: str):
+    """Queue up a stored file to be deleted by delete_unused_files() if no
+    row refers to it by then. Part of the current transaction, so if that's
+    rolled back, so is this."""
+    if name:
+        PendingFileDeletion.objects.bulk_create(
+            [PendingFileDeletion(model=model._meta.model_name, name=name)],
+            ignore_conflicts=True
+        )
+
+
+def _delete_file(model, name: str):
+    field_name = CONTENT_ADDRESSED_FIELDS[model]
+    field = model._meta.get_field(field_name)
+    file = field.attr_class(None, field, name)
+    if model is ImageFile:
+        # also deletes the thumbnails
+        delete(file)
+    else:
+        file.storage.delete(name)
+
+
+def _delete_batch() -> bool:
+    # returns whether there might be more to delete
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_try_advisory_xact_lock(%s)', [_STORING_FILES_LOCK]
+            )
+            if not cursor.fetchone()[0]:
+                # something's storing files, and it'll call us when it's done
+                return False
+        pending = list(
+            PendingFileDeletion.objects.select_for_update(skip_locked=True)
+            .order_by('pk')[:_DELETE_BATCH_SIZE]
+        )
+        for pending_deletion in pending:
+            model = _MODELS_BY_NAME[pending_deletion.model]
+            field_name = CONTENT_ADDRESSED_FIELDS[model]
+            name = pending_deletion.name
+            if not model.objects.filter(**{field_name: name}).exists():
+                _delete_file(model, name)
+        PendingFileDeletion.objects.filter(
+            pk__in=[p.pk for p in pending]
+        ).delete()
+    return len(pending) == _DELETE_BATCH_SIZE
+
+
+def delete_unused_files():
+    """Delete the files queued up by queue_file_deletion() that no row refers
+    to anymore, unless something's storing files right now (see
+    storing_files()), in which case that will do it instead."""
+    while _delete_batch():
+        pass
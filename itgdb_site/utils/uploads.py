@@ -1,17 +1,34 @@
 """Routines for uploading packs/songs/charts to the database.
+
+Analyzing the charts is what takes the longest in an upload. So when
+settings.UPLOAD_ANALYSIS_PROCESSES is set, upload_pack() and patch_pack()
+analyze the songs in a pool of worker processes (see analyze_song()), while
+the uploading process just writes the results to the database, in the same
+order as it would otherwise.
+
+Similarly, the songs' images are processed (and stored) in a pool of threads
+while the songs are being uploaded, see _AssetPipeline.
 """
 
 import os
+import io
 import magic
 import uuid
 from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, asdict
 import re
 import fnmatch
+from typing import Dict, Iterator, List, Tuple
+from django.conf import settings
 from django.core.files import File
+from django.db import models
+from fs.base import FS
 from simfile.dir import SimfilePack, SimfileDirectory
 from simfile.timing.displaybpm import displaybpm, BeatValues
 from simfile.types import Simfile, Chart as SimfileChart
 from celery.utils.log import get_task_logger
+import billiard
 import cv2
 from PIL import Image
 
@@ -19,7 +36,13 @@ from ..models import Pack, Song, Chart, ImageFile
 from .charts import (
     get_hash, get_assets, get_pack_banner_path, get_song_lengths
 )
-from .analysis import SongAnalyzer, get_chart_key
+from .analysis import SongAnalyzer, AnalysisCache, ChartAnalysis, get_chart_key
+from .analysis.analyzer import (
+    ANALYZER_VERSIONS, CHART_ANALYSIS_COMPONENTS, BPMRange,
+    get_analysis_digest
+)
+from .analysis.breakdown import generate_breakdowns
+from .archive_fs import ArchiveFS, NATIVE_FS, open_archive, remove_file, syspath
 from .ini import IniFile
 from .path import find_case_sensitive_path, convert_path_to_os_style
 
@@ -38,51 +61,226 @@ def _determine_has_alpha(file):
     return mode in {'RGBA', 'LA', 'PA', 'RGBa', 'La'}
 
 
-def _get_image(path, parent_obj, cache, generate_thumbnail=False):
-    if not path or not os.path.isfile(path):
-        return None
-    if path in cache:
-        return cache[path]
-    
-    mimetype = magic.from_file(path, mime=True)
-    img_path = None
+def _store_files(obj: models.Model):
+    # store the object's files now, while they're still open (this is what
+    # would otherwise happen when saving the object)
+    for field in obj._meta.concrete_fields:
+        if isinstance(field, models.FileField):
+            field.pre_save(obj, add=True)
+
+
+class _BulkWriter:
+    """Collects the images, songs and charts of a pack upload so they can be
+    inserted with a few bulk_create() calls at the end, instead of one or two
+    queries per object. Only the database writes are deferred: files get
+    stored as soon as objects are added."""
+
+    BATCH_SIZE = 500
+
+    def __init__(self):
+        self.images: List[ImageFile] = []
+        self.songs: List[Song] = []
+        self.charts: List[Chart] = []
+
+    def _add(self, objs: list, obj: models.Model):
+        _store_files(obj)
+        objs.append(obj)
+
+    def add_image(self, img_file: ImageFile):
+        self._add(self.images, img_file)
+
+    def add_song(self, song: Song):
+        self._add(self.songs, song)
+
+    def add_chart(self, chart: Chart):
+        self._add(self.charts, chart)
+
+    def write(self):
+        # insert images before the songs that use them and songs before their
+        # charts, so that each insert can fill in its foreign keys with the
+        # ids from the previous one. (the pack banner has been saved already,
+        # see _AssetPipeline.get_image())
+        ImageFile.objects.bulk_create(
+            [img_file for img_file in self.images if img_file.pk is None],
+            batch_size=self.BATCH_SIZE
+        )
+        Song.objects.bulk_create(self.songs, batch_size=self.BATCH_SIZE)
+        Chart.objects.bulk_create(self.charts, batch_size=self.BATCH_SIZE)
+
+
+def _make_image_file(
+    f, filename: str, parent_obj: Pack | Song, generate_thumbnail: bool
+) -> ImageFile:
+    has_alpha = _determine_has_alpha(f)
+    f.seek(0)
+    if isinstance(parent_obj, Pack):
+        img_file = ImageFile(
+            pack = parent_obj,
+            image = File(f, name=f'{uuid.uuid4()}_{filename}'),
+            original_name = filename,
+            has_alpha = has_alpha
+        )
+    else: # parent_obj is a Song
+        img_file = ImageFile(
+            song = parent_obj,
+            image = File(f, name=f'{uuid.uuid4()}_{filename}'),
+            original_name = filename,
+            has_alpha = has_alpha
+        )
+    _store_files(img_file)
+    if generate_thumbnail:
+        # pregenerate thumbnail
+        img_file.get_thumbnail(save=False)
+    return img_file
+
+
+# number of bytes at the start of a file for libmagic to look at (its own
+# default limit)
+_MAGIC_BUFFER_SIZE = 1 << 20
+
+
+def _process_image(
+    path: str, parent_obj: Pack | Song, generate_thumbnail: bool,
+    filesystem: FS = NATIVE_FS
+) -> ImageFile | None:
+    """Create an ImageFile for an image (or the first frame of a video),
+    store its file and pregenerate its thumbnail if needed. Doesn't touch the
+    database, so that it can run in _AssetPipeline's threads."""
+    with filesystem.openbin(path) as f:
+        mimetype = magic.from_buffer(f.read(_MAGIC_BUFFER_SIZE), mime=True)
+    filename = os.path.basename(path)
     if mimetype.startswith('image'):
-        img_path = path 
+        with filesystem.openbin(path) as f:
+            return _make_image_file(
+                f, filename, parent_obj, generate_thumbnail
+            )
     elif mimetype.startswith('video'):
         # get first frame of video
-        video_capture = cv2.VideoCapture(path)
-        success, img = video_capture.read()
+        with syspath(filesystem, path) as video_path:
+            video_capture = cv2.VideoCapture(video_path)
+            success, img = video_capture.read()
+            video_capture.release()
         if success:
-            img_path = path + '.png'
-            cv2.imwrite(img_path, img)
-        video_capture.release()
-
-    if img_path:
-        with open(img_path, 'rb') as f:
-            has_alpha = _determine_has_alpha(f)
-            base_filename = os.path.basename(img_path)
-            if isinstance(parent_obj, Pack):
-                img_file = ImageFile(
-                    pack = parent_obj,
-                    image = File(f, name=f'{uuid.uuid4()}_{base_filename}'),
-                    has_alpha = has_alpha
-                )
-            else: # parent_obj is a Song
-                img_file = ImageFile(
-                    song = parent_obj,
-                    image = File(f, name=f'{uuid.uuid4()}_{base_filename}'),
-                    has_alpha = has_alpha
-                )
-            img_file.save()
-            if generate_thumbnail:
-                # pregenerate thumbnail
-                img_file.get_thumbnail()
-            cache[path] = img_file
-            return img_file
-    
+            success, png = cv2.imencode('.png', img)
+        if success:
+            return _make_image_file(
+                io.BytesIO(png.tobytes()), filename + '.png', parent_obj,
+                generate_thumbnail
+            )
     return None
 
 
+class _AssetPipeline:
+    """Processes the images (banners, backgrounds etc.) of an upload in a pool
+    of threads (see _process_image()), since that's mostly waiting on the
+    storage backend. Each file is only processed once, however many songs use
+    it. The ImageFiles are then saved (or added to the bulk writer) and
+    assigned to the songs that use them by finish(), in this thread.
+
+    Should be used as a context manager, so that the threads get shut down if
+    the upload fails."""
+
+    def __init__(
+        self,
+        threads: int | None = None,
+        bulk_writer: _BulkWriter | None = None,
+        filesystem: FS = NATIVE_FS
+    ):
+        if threads is None:
+            threads = settings.UPLOAD_ASSET_THREADS
+        # the threads only get started when the first asset is submitted,
+        # which is after _iter_song_analyses() has forked its worker
+        # processes (forking with threads around is asking for deadlocks)
+        self.executor = ThreadPoolExecutor(threads) if threads > 0 else None
+        self.bulk_writer = bulk_writer
+        self.filesystem = filesystem
+        # path -> future of the path's ImageFile (or None if it's not an
+        # image), for every file that's been submitted
+        self.in_flight: Dict[str, Future] = {}
+        # path -> ImageFile, for every file whose ImageFile has been written
+        self.written: Dict[str, ImageFile | None] = {}
+        # (object, field name, path) to assign once the ImageFiles are done
+        self.links: List[Tuple[models.Model, str, str]] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def _submit(
+        self, path: str, parent_obj: Pack | Song, generate_thumbnail: bool,
+        wait: bool = False
+    ) -> bool:
+        # returns whether the file exists
+        if not path or not self.filesystem.isfile(path):
+            return False
+        if path not in self.in_flight:
+            if self.executor is None or wait:
+                future = Future()
+                try:
+                    future.set_result(_process_image(
+                        path, parent_obj, generate_thumbnail, self.filesystem
+                    ))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                future = self.executor.submit(
+                    _process_image, path, parent_obj, generate_thumbnail,
+                    self.filesystem
+                )
+            self.in_flight[path] = future
+        return True
+
+    def _write(self, path: str, bulk: bool = True) -> ImageFile | None:
+        if path not in self.written:
+            img_file = self.in_flight[path].result()
+            if img_file is not None:
+                if self.bulk_writer is None or not bulk:
+                    img_file.save()
+                else:
+                    self.bulk_writer.add_image(img_file)
+            self.written[path] = img_file
+        return self.written[path]
+
+    def get_image(
+        self, path: str, parent_obj: Pack | Song, generate_thumbnail: bool
+    ) -> ImageFile | None:
+        """Process and save an image right away, e.g. for the pack banner,
+        which has to be saved before the pack. Returns None if the file
+        doesn't exist or isn't an image/video."""
+        if not self._submit(path, parent_obj, generate_thumbnail, wait=True):
+            return None
+        return self._write(path, bulk=False)
+
+    def link(
+        self, obj: models.Model, field_name: str, path: str,
+        parent_obj: Pack | Song, generate_thumbnail: bool
+    ):
+        """Queue an image to be processed and assigned to obj.field_name by
+        finish(). Nothing gets assigned if the file doesn't exist or isn't an
+        image/video (so patches without some asset don't erase it)."""
+        if self._submit(path, parent_obj, generate_thumbnail):
+            self.links.append((obj, field_name, path))
+
+    def finish(self, save: bool = True):
+        """Wait for the linked images, then save them and assign them to their
+        objects. With save, objects that got new images are saved too (unless
+        there's a bulk writer, which will insert them later anyway)."""
+        updated_fields = {}
+        for obj, field_name, path in self.links:
+            img_file = self._write(path)
+            if img_file is not None:
+                setattr(obj, field_name, img_file)
+                updated_fields.setdefault(id(obj), (obj, []))[1] \
+                    .append(field_name)
+        self.links = []
+        if save and self.bulk_writer is None:
+            for obj, field_names in updated_fields.values():
+                obj.save(update_fields=field_names)
+
+
 # match the behavior of NotesLoader::GetMainAndSubTitlesFromFullTitle()
 def _get_title_and_subtitles_from_full_title(full_title: str):
     for sep in ('\t', ' -', ' ~', ' (', ' ['):
@@ -96,35 +294,216 @@ SIMFILE_FILENAME_PATTERNS = (
     re.compile(fnmatch.translate('*.sm'), re.IGNORECASE),
     re.compile(fnmatch.translate('*.ssc'), re.IGNORECASE)
 )
+def _delete_dupe_sims_in_dir(filesystem: FS, song_dir_path: str):
+    all_fnames = filesystem.listdir(song_dir_path)
+    for pattern in SIMFILE_FILENAME_PATTERNS:
+        fnames = list(filter(lambda f: pattern.match(f), all_fnames))
+        fnames.sort(key=str.lower)
+        # keep the first file alphabetically, delete the rest
+        for fname in fnames[1:]:
+            path = os.path.join(song_dir_path, fname)
+            remove_file(filesystem, path)
+
+
 def delete_dupe_sims(simfile_pack: SimfilePack):
+    # (in archives, the files just get hidden)
     for song_dir_path in simfile_pack.simfile_dir_paths:
-        all_fnames = os.listdir(song_dir_path)
-        for pattern in SIMFILE_FILENAME_PATTERNS:
-            fnames = list(filter(lambda f: pattern.match(f), all_fnames))
-            fnames.sort(key=str.lower)
-            # keep the first file alphabetically, delete the rest
-            for fname in fnames[1:]:
-                path = os.path.join(song_dir_path, fname)
-                os.remove(path)
-
-
-def _get_pack_ini_if_present(pack_path: str):
-    pack_ini_path = find_case_sensitive_path(pack_path, 'Pack.ini')
-    if pack_ini_path and os.path.isfile(pack_ini_path):
-        return IniFile(pack_ini_path)
+        _delete_dupe_sims_in_dir(simfile_pack.filesystem, song_dir_path)
+
+
+def _get_pack_ini_if_present(pack_path: str, filesystem: FS):
+    pack_ini_path = find_case_sensitive_path(pack_path, 'Pack.ini', filesystem)
+    if pack_ini_path and filesystem.isfile(pack_ini_path):
+        return IniFile(pack_ini_path, filesystem)
     return None
 
 
+@dataclass
+class SongAnalysis:
+    """The analysis results of a simfile, as computed by analyze_song().
+    Provides the same get_chart_len() and get_bpm_ranges() as SongAnalyzer.
+    """
+    chart_len: float
+    bpm_ranges: Tuple[BPMRange, BPMRange]
+    # chart key -> (chart hash, analysis digest, analysis results), for the
+    # first chart with each key
+    charts: Dict[tuple, Tuple[str, str, ChartAnalysis]]
+
+    def get_chart_len(self) -> float:
+        return self.chart_len
+
+    def get_bpm_ranges(self) -> Tuple[BPMRange, BPMRange]:
+        return self.bpm_ranges
+
+    def to_dict(self) -> dict:
+        """Convert to a dict that celery can serialize as a task result."""
+        return {
+            'chart_len': self.chart_len,
+            'bpm_ranges': self.bpm_ranges,
+            'charts': [
+                [list(key), chart_hash, digest, asdict(chart_analysis)]
+                for key, (chart_hash, digest, chart_analysis)
+                in self.charts.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'SongAnalysis':
+        return cls(
+            data['chart_len'],
+            tuple(tuple(bpm_range) for bpm_range in data['bpm_ranges']),
+            {
+                tuple(key): (chart_hash, digest, ChartAnalysis(**analysis))
+                for key, chart_hash, digest, analysis in data['charts']
+            }
+        )
+
+
+# the archive of the pack being analyzed, in the worker processes of
+# _iter_song_analyses(), see _init_analysis_worker()
+_worker_archive: ArchiveFS | None = None
+
+
+def _init_analysis_worker(archive_path: str | None):
+    # each worker process opens its own copy of the archive (and keeps it
+    # open for the next songs), since a forked one would share its file
+    # offset with the other processes
+    global _worker_archive
+    if archive_path is not None:
+        _worker_archive = _open_song_archive(archive_path)
+
+
+def _open_song_archive(archive_path: str) -> ArchiveFS:
+    archive = open_archive(archive_path)
+    if archive is None:
+        raise ValueError(f'unsupported archive {archive_path}')
+    return archive
+
+
+def _analyze_simfile_dir(simfile_dir: SimfileDirectory) -> SongAnalysis:
+    sim = simfile_dir.open(strict=False)
+    song_analyzer = SongAnalyzer(sim)
+    charts = {}
+    for key, chart in song_analyzer.charts.items():
+        if Chart.steps_type_to_int(chart.stepstype) is None:
+            continue
+        analyzer = song_analyzer.get_chart_analyzer(chart)
+        chart_hash = get_hash(sim, chart, analyzer.note_tokens)
+        charts[key] = (
+            chart_hash,
+            get_analysis_digest(sim, chart, song_analyzer.chart_len),
+            analyzer.analyze()
+        )
+    return SongAnalysis(
+        song_analyzer.get_chart_len(),
+        song_analyzer.get_bpm_ranges(),
+        charts
+    )
+
+
+def _analyze_archived_song(
+    archive: ArchiveFS, simfile_dir_path: str
+) -> SongAnalysis:
+    # the uploading process only hid the dupes in its own copy
+    _delete_dupe_sims_in_dir(archive, simfile_dir_path)
+    return _analyze_simfile_dir(
+        SimfileDirectory(simfile_dir_path, filesystem=archive)
+    )
+
+
+def analyze_song(
+    simfile_dir_path: str, archive_path: str | None = None
+) -> SongAnalysis | None:
+    """Analyze the simfile in the given directory (meant to be run in a
+    worker process, so it doesn't touch the database). For a pack that's
+    read from an archive (see archive_fs.py), pass in the archive's path.
+    Returns None if the simfile couldn't be analyzed, in which case
+    upload_song() just analyzes it again itself (and handles the error the
+    usual way)."""
+    try:
+        if archive_path is None:
+            return _analyze_simfile_dir(SimfileDirectory(simfile_dir_path))
+        if _worker_archive is not None \
+            and _worker_archive.archive_path == archive_path:
+            return _analyze_archived_song(_worker_archive, simfile_dir_path)
+        # e.g. in a celery task, which shouldn't keep the archive open for
+        # as long as the celery worker lives
+        with _open_song_archive(archive_path) as archive:
+            return _analyze_archived_song(archive, simfile_dir_path)
+    except Exception:
+        logger.warning(
+            f'Could not analyze {simfile_dir_path} in worker', exc_info=True
+        )
+        return None
+
+
+def _analyze_song_args(args: Tuple[str, str | None]) -> SongAnalysis | None:
+    return analyze_song(*args)
+
+
+def _get_archive_path(filesystem: FS) -> str | None:
+    return filesystem.archive_path \
+        if isinstance(filesystem, ArchiveFS) else None
+
+
+def _iter_song_analyses(
+    simfile_dirs: List[SimfileDirectory], processes: int
+) -> Iterator[SongAnalysis | None]:
+    # yield the analysis of each song, in order, while the worker processes
+    # keep analyzing the songs after it. without any processes, just yield
+    # None for every song so that they get analyzed during the upload
+    if processes <= 0 or not simfile_dirs:
+        for _ in simfile_dirs:
+            yield None
+        return
+    # the pool comes from billiard (celery's fork of multiprocessing) rather
+    # than multiprocessing, since celery's prefork workers are daemonic
+    # processes, which multiprocessing doesn't allow to have children. fork
+    # so that the workers inherit the django setup
+    pool = billiard.get_context('fork').Pool(
+        processes, initializer=_init_analysis_worker,
+        # the songs all come from the same pack
+        initargs=(_get_archive_path(simfile_dirs[0].filesystem),)
+    )
+    try:
+        yield from pool.imap(_analyze_song_args, [
+            (d.simfile_dir, _get_archive_path(d.filesystem))
+            for d in simfile_dirs
+        ])
+    finally:
+        # don't wait for the remaining songs if the upload failed
+        pool.terminate()
+        pool.join()
+
+
 def upload_pack(
     simfile_pack: SimfilePack,
     pack_data: dict,
-    prog_tracking_info: ProgressTrackingInfo | None = None
+    prog_tracking_info: ProgressTrackingInfo | None = None,
+    analysis_processes: int | None = None,
+    song_analyses: Dict[str, SongAnalysis | None] | None = None,
+    bulk: bool = True
 ):
+    """Upload a pack and all of its songs. Songs are analyzed in
+    analysis_processes worker processes (default:
+    settings.UPLOAD_ANALYSIS_PROCESSES), or in this process if it's 0.
+
+    If the songs have already been analyzed elsewhere, pass in song_analyses
+    instead, mapping simfile directory paths to the results of analyze_song()
+    for them. Only the songs in song_analyses get uploaded.
+
+    With bulk, the songs, charts and images are inserted all at once after
+    every song has been processed, rather than one at a time. Either way, the
+    songs' images are processed in settings.UPLOAD_ASSET_THREADS threads
+    while the songs are being uploaded (see _AssetPipeline)."""
+    if analysis_processes is None:
+        analysis_processes = settings.UPLOAD_ANALYSIS_PROCESSES
     pack_path = simfile_pack.pack_dir
-    image_cache = {}
+    filesystem = simfile_pack.filesystem
+    analysis_cache = AnalysisCache()
     delete_dupe_sims(simfile_pack) # kind of redundant but i think it's fine
 
-    pack_ini = _get_pack_ini_if_present(pack_path)
+    pack_ini = _get_pack_ini_if_present(pack_path, filesystem)
     # only use pack.ini if a non-empty version value exists
     # (matches ITGmania behavior)
     if pack_ini and (pack_ini.get('Group', 'Version') or '').strip('\r\n\t '):
@@ -133,7 +512,9 @@ def upload_pack(
         pack_bn_path = pack_ini.get('Group', 'Banner')
         if pack_bn_path:
             pack_bn_path = convert_path_to_os_style(pack_bn_path)
-            pack_bn_path = find_case_sensitive_path(pack_path, pack_bn_path)
+            pack_bn_path = find_case_sensitive_path(
+                pack_path, pack_bn_path, filesystem
+            )
     else:
         pack_ini_raw = ''
         display_title = None
@@ -152,44 +533,72 @@ def upload_pack(
 
     p.tags.add(*pack_data['tags'])
 
-    # find banner file
-    banner = None
-    # first, try the path specified in pack.ini, if present
-    if pack_bn_path:
-        banner = _get_image(pack_bn_path, p, image_cache, True)
-    # if the path is not specified in pack.ini or the banner doesn't exist,
-    # fall back to the default way of fetching the pack banner
-    if banner is None:
-        pack_bn_path = get_pack_banner_path(pack_path, simfile_pack)
-        banner = _get_image(pack_bn_path, p, image_cache, True)
-    p.banner = banner
-    p.save()
+    bulk_writer = _BulkWriter() if bulk else None
+    with _AssetPipeline(
+        bulk_writer=bulk_writer, filesystem=filesystem
+    ) as asset_pipeline:
+        # find banner file
+        banner = None
+        # first, try the path specified in pack.ini, if present
+        if pack_bn_path:
+            banner = asset_pipeline.get_image(pack_bn_path, p, True)
+        # if the path is not specified in pack.ini or the banner doesn't
+        # exist, fall back to the default way of fetching the pack banner
+        if banner is None:
+            pack_bn_path = get_pack_banner_path(pack_path, simfile_pack)
+            banner = asset_pipeline.get_image(pack_bn_path, p, True)
+        p.banner = banner
+        p.save()
 
-    simfile_dirs = list(simfile_pack.simfile_dirs())
-    total_count = len(simfile_dirs)
-    for i, simfile_dir in enumerate(simfile_dirs):
-        # update progress bar, if needed
-        if prog_tracking_info:
-            prog_tracker, finished_subparts, num_subparts = prog_tracking_info
-            basename = os.path.basename(simfile_dir.simfile_dir)
-            prog_tracker.update_progress(
-                (finished_subparts + (i / total_count)) / num_subparts,
-                f'[{i + 1}/{total_count}] Processing {p.name}/{basename}'
+        simfile_dirs = list(simfile_pack.simfile_dirs())
+        if song_analyses is not None:
+            simfile_dirs = [
+                d for d in simfile_dirs if d.simfile_dir in song_analyses
+            ]
+            analyses = (song_analyses[d.simfile_dir] for d in simfile_dirs)
+        else:
+            analyses = _iter_song_analyses(simfile_dirs, analysis_processes)
+        total_count = len(simfile_dirs)
+        for i, (simfile_dir, song_analysis) in enumerate(
+            zip(simfile_dirs, analyses)
+        ):
+            # update progress bar, if needed
+            if prog_tracking_info:
+                prog_tracker, finished_subparts, num_subparts = \
+                    prog_tracking_info
+                basename = os.path.basename(simfile_dir.simfile_dir)
+                prog_tracker.update_progress(
+                    (finished_subparts + (i / total_count)) / num_subparts,
+                    f'[{i + 1}/{total_count}] Processing {p.name}/{basename}'
+                )
+            upload_song(
+                simfile_dir, p, asset_pipeline, analysis_cache=analysis_cache,
+                song_analysis=song_analysis, bulk_writer=bulk_writer
             )
-        upload_song(simfile_dir, p, image_cache)
+        asset_pipeline.finish()
+        if bulk_writer is not None:
+            bulk_writer.write()
+
+    logger.info(f'Finished {p.name} ({analysis_cache})')
 
 
 def patch_pack(
     simfile_pack: SimfilePack,
     p: Pack,
     patch_params: dict,
-    prog_tracking_info: ProgressTrackingInfo | None = None
+    prog_tracking_info: ProgressTrackingInfo | None = None,
+    analysis_processes: int | None = None
 ):
+    """Patch an existing pack with the songs of another. See upload_pack()
+    for analysis_processes."""
+    if analysis_processes is None:
+        analysis_processes = settings.UPLOAD_ANALYSIS_PROCESSES
     pack_path = simfile_pack.pack_dir
-    image_cache = {}
+    filesystem = simfile_pack.filesystem
+    analysis_cache = AnalysisCache()
     delete_dupe_sims(simfile_pack) # kind of redundant but i think it's fine
 
-    pack_ini = _get_pack_ini_if_present(pack_path)
+    pack_ini = _get_pack_ini_if_present(pack_path, filesystem)
     # only use pack.ini if a non-empty version value exists
     # (matches ITGmania behavior)
     if pack_ini and (pack_ini.get('Group', 'Version') or '').strip('\r\n\t '):
@@ -198,7 +607,9 @@ def patch_pack(
         pack_bn_path = pack_ini.get('Group', 'Banner')
         if pack_bn_path:
             pack_bn_path = convert_path_to_os_style(pack_bn_path)
-            pack_bn_path = find_case_sensitive_path(pack_path, pack_bn_path)
+            pack_bn_path = find_case_sensitive_path(
+                pack_path, pack_bn_path, filesystem
+            )
     else:
         pack_ini_raw = ''
         display_title = None
@@ -221,12 +632,12 @@ def patch_pack(
     banner = None
     # first, try the path specified in pack.ini, if present
     if pack_bn_path:
-        banner = _get_image(pack_bn_path, p, image_cache, True)
+        banner = asset_pipeline.get_image(pack_bn_path, p, True)
     # if the path is not specified in pack.ini or the banner doesn't exist,
     # fall back to the default way of fetching the pack banner
     if banner is None:
         pack_bn_path = get_pack_banner_path(pack_path, simfile_pack)
-        banner = _get_image(pack_bn_path, p, image_cache, True)
+        banner = asset_pipeline.get_image(pack_bn_path, p, True)
     # only overwrite existing banner if we found a new one
     if banner:
         p.banner = banner
@@ -236,26 +647,53 @@ def patch_pack(
 
     simfile_dirs = list(simfile_pack.simfile_dirs())
     total_count = len(simfile_dirs)
-    for i, simfile_dir in enumerate(simfile_dirs):
-        # update progress bar, if needed
-        if prog_tracking_info:
-            prog_tracker, finished_subparts, num_subparts = prog_tracking_info
-            basename = os.path.basename(simfile_dir.simfile_dir)
-            prog_tracker.update_progress(
-                (finished_subparts + (i / total_count)) / num_subparts,
-                f'[{i + 1}/{total_count}] Processing {p.name}/{basename}'
+    song_analyses = _iter_song_analyses(simfile_dirs, analysis_processes)
+    with _AssetPipeline(filesystem=filesystem) as asset_pipeline:
+        for i, (simfile_dir, song_analysis) in enumerate(
+            zip(simfile_dirs, song_analyses)
+        ):
+            # update progress bar, if needed
+            if prog_tracking_info:
+                prog_tracker, finished_subparts, num_subparts = \
+                    prog_tracking_info
+                basename = os.path.basename(simfile_dir.simfile_dir)
+                prog_tracker.update_progress(
+                    (finished_subparts + (i / total_count)) / num_subparts,
+                    f'[{i + 1}/{total_count}] Processing {p.name}/{basename}'
+                )
+            upload_song(
+                simfile_dir, p, asset_pipeline, patch_params, analysis_cache,
+                song_analysis
             )
-        upload_song(simfile_dir, p, image_cache, patch_params)
+        asset_pipeline.finish()
+
+    logger.info(f'Finished patching {p.name} ({analysis_cache})')
 
 
 def upload_song(
     simfile_dir: SimfileDirectory,
     p: Pack | None = None,
-    image_cache: dict | None = None,
-    patch_params: dict | None = None
+    asset_pipeline: _AssetPipeline | None = None,
+    patch_params: dict | None = None,
+    analysis_cache: AnalysisCache | None = None,
+    song_analysis: SongAnalysis | None = None,
+    bulk_writer: _BulkWriter | None = None
 ):
-    if image_cache is None:
-        image_cache = {}
+    """Upload a song (and its charts and assets). If the simfile has already
+    been analyzed by analyze_song(), pass in the results to use them instead
+    of analyzing it again. If bulk_writer is given, the song, charts and
+    assets are added to it instead of being saved (only for songs in packs).
+
+    When uploading a pack, pass in the pack's asset_pipeline: the song's
+    assets only get assigned to it once the pipeline finishes. Otherwise,
+    they're processed right away.
+    """
+    assert bulk_writer is None or (p is not None and patch_params is None)
+    finish_assets = asset_pipeline is None
+    if asset_pipeline is None:
+        asset_pipeline = _AssetPipeline(
+            0, bulk_writer, simfile_dir.filesystem
+        )
 
     sim = simfile_dir.open(strict=False)
     assets = get_assets(simfile_dir)
@@ -303,6 +741,7 @@ def upload_song(
         # TODO: patch with song file should read from the song file instead
         music_len = existing_song.music_length
         chart_len = existing_song.chart_length
+        chart_len_version = existing_song.chart_length_version
     else:
         # must figure out song length from file.
         # if we're uploading this sim for the first time, we should
@@ -312,14 +751,18 @@ def upload_song(
             if is_patching:
                 patch_results.append(log_name, 'err: no music')
             return
-        song_lengths = get_song_lengths(music_path, song_analyzer)
+        song_lengths = get_song_lengths(
+            music_path, song_analysis or song_analyzer,
+            simfile_dir.filesystem
+        )
         if not song_lengths:
             if is_patching:
                 patch_results.append(log_name, 'err: can\'t open music')
             return
         music_len, chart_len = song_lengths
+        chart_len_version = ANALYZER_VERSIONS['chart_length']
 
-    with open(sim_path, 'rb') as f:
+    with simfile_dir.filesystem.openbin(sim_path) as f:
         sim_uuid = uuid.uuid4()
         fields = dict(
             pack = p,
@@ -328,8 +771,10 @@ def upload_song(
             artist = artist,
             music_length = music_len,
             chart_length = chart_len,
+            chart_length_version = chart_len_version,
             # NOTE: we now fill in release date later
             simfile = File(f, name=f'{sim_uuid}_{sim_filename}'),
+            simfile_name = sim_filename,
             has_sm = bool(simfile_dir.sm_path),
             has_ssc = bool(simfile_dir.ssc_path),
         )
@@ -359,37 +804,48 @@ def upload_song(
 
         # write the rest of the fields and save to db,
         # and also upload all the charts of the song
-        update_song_with_simfile(sim, s, patch_params)
+        update_song_with_simfile(
+            sim, s, patch_params, analysis_cache, song_analysis, bulk_writer
+        )
 
         img_parent = p or s
         # add assets, but only if they're found (so patches that don't include
         # asset files don't overwrite existing asset fields)
-        if banner := _get_image(assets['BANNER'], img_parent, image_cache, True):
-            s.banner = banner
-        if bg := _get_image(assets['BACKGROUND'], img_parent, image_cache, True):
-            s.bg = bg
-        if cdtitle := _get_image(assets['CDTITLE'], img_parent, image_cache):
-            s.cdtitle = cdtitle
-        if jacket := _get_image(assets['JACKET'], img_parent, image_cache):
-            s.jacket = jacket
-        s.save()
+        asset_pipeline.link(s, 'banner', assets['BANNER'], img_parent, True)
+        asset_pipeline.link(s, 'bg', assets['BACKGROUND'], img_parent, True)
+        asset_pipeline.link(
+            s, 'cdtitle', assets['CDTITLE'], img_parent, False
+        )
+        asset_pipeline.link(s, 'jacket', assets['JACKET'], img_parent, False)
+        if finish_assets:
+            asset_pipeline.finish(save=False)
+        if bulk_writer is None:
+            s.save()
+        else:
+            bulk_writer.add_song(s)
 
 
 def update_song_with_simfile(
     sim: Simfile,
     s: Song,
-    patch_params: dict | None = None
+    patch_params: dict | None = None,
+    analysis_cache: AnalysisCache | None = None,
+    song_analysis: SongAnalysis | None = None,
+    bulk_writer: _BulkWriter | None = None
 ):
     """Update and save a Song object with data from a simfile. Only fields
     that can be derived directly from the simfile will be written. Also
-    updates the Charts of the Song to match the simfile.
+    updates the Charts of the Song to match the simfile. Pass in the results
+    of analyze_song() for the simfile, if any, to reuse them. With
+    bulk_writer, the song isn't saved, and its new charts are added to the
+    bulk writer instead.
 
     The following fields should be written to s before passing it into
     this function:
     - release_date, release_date_year_only
     - music_length, chart_length
     - has_sm, has_ssc
-    - simfile
+    - simfile, simfile_name
     """
 
     # ensure required fields that we don't write are present,
@@ -402,8 +858,10 @@ def update_song_with_simfile(
     # already, if needed
 
     song_analyzer = SongAnalyzer(sim)
+    if analysis_cache is None:
+        analysis_cache = AnalysisCache()
 
-    bpm_range, disp_range = song_analyzer.get_bpm_ranges()
+    bpm_range, disp_range = (song_analysis or song_analyzer).get_bpm_ranges()
 
     # note: the name of the simfile directory is needed to fully match the
     # behavior of TidyUpData() in Song.cpp, see upload_song().
@@ -435,7 +893,8 @@ def update_song_with_simfile(
     for field, val in fields.items():
         setattr(s, field, val)
 
-    s.save()
+    if bulk_writer is None:
+        s.save()
 
     # upload the charts for this song.
     # try not to upload multiple charts for the same stepstype and difficulty
@@ -446,7 +905,10 @@ def update_song_with_simfile(
     for chart in sim.charts:
         chart_key = get_chart_key(chart)
         if chart_key not in chart_keys_already_uploaded:
-            upload_chart(chart, s, song_analyzer, patch_params)
+            upload_chart(
+                chart, s, song_analyzer, patch_params, analysis_cache,
+                song_analysis, bulk_writer
+            )
             chart_keys_already_uploaded.add(chart_key)
     
     # if we are patching, then there might be charts in diff slots that were
@@ -466,7 +928,10 @@ def upload_chart(
     chart: SimfileChart,
     s: Song,
     song_analyzer: SongAnalyzer,
-    patch_params: dict | None = None
+    patch_params: dict | None = None,
+    analysis_cache: AnalysisCache | None = None,
+    song_analysis: SongAnalysis | None = None,
+    bulk_writer: _BulkWriter | None = None
 ):
     steps_type = Chart.steps_type_to_int(chart.stepstype)
     if steps_type is None:
@@ -498,15 +963,24 @@ def upload_chart(
             patch_results.append(log_name, 'overwrite')
             existing_chart = existing_charts.first()
     
-    chart_hash = get_hash(song_analyzer.sim, chart)
-
-    analyzer = song_analyzer.get_chart_analyzer(chart)
-    counts = analyzer.get_counts()
-    counts = {k + '_count': v for k, v in counts.items()}
+    if analysis_cache is None:
+        analysis_cache = AnalysisCache()
+    chart_key = get_chart_key(chart)
+    if song_analysis is not None and chart_key in song_analysis.charts:
+        chart_hash, digest, chart_analysis = song_analysis.charts[chart_key]
+        # still cache the results for future uploads
+        analysis_cache.store(digest, chart_analysis)
+    else:
+        analyzer = song_analyzer.get_chart_analyzer(chart)
+        # the hash and the analysis can share the same tokenized notes
+        chart_hash = get_hash(song_analyzer.sim, chart, analyzer.note_tokens)
+        chart_analysis = analysis_cache.analyze(analyzer)
+    counts = {k + '_count': v for k, v in chart_analysis.counts.items()}
     analysis = {
-        'density_graph': analyzer.get_density_graph(),
-        'stream_info': analyzer.get_stream_info(),
+        'density_graph': chart_analysis.density_graph,
+        'stream_info': chart_analysis.stream_info,
     }
+    breakdowns = generate_breakdowns(chart_analysis.stream_info)
     
     # stepmania trims whitespace from description and chartname,
     # but not credit. thanks stepmania
@@ -520,10 +994,15 @@ def upload_chart(
         chart_name = (chart.get('CHARTNAME') or '').strip(),
         chart_hash = chart_hash,
         analysis = analysis,
+        breakdowns = breakdowns,
         # release_date = s.release_date,
         # release_date_year_only = s.release_date_year_only,
         has_attacks = bool((chart.get('ATTACKS') or '').strip()),
-        **counts
+        **counts,
+        **{
+            f'{component}_version': ANALYZER_VERSIONS[component]
+            for component in (*CHART_ANALYSIS_COMPONENTS, 'breakdowns')
+        }
     )
 
     if existing_chart is None:
@@ -539,7 +1018,10 @@ def upload_chart(
             fields['release_date_year_only'] = s.release_date_year_only
         
         # create new chart
-        s.chart_set.create(**fields)
+        if bulk_writer is None:
+            s.chart_set.create(**fields)
+        else:
+            bulk_writer.add_chart(Chart(**fields))
     else:
         # we are patching an existing song.
         # we keep the release date already on that song and just
@@ -1,79 +1,107 @@
 """Routines for fetching pack files from URLs.
+
+Anything that isn't on google drive or mega is downloaded with downloader.py,
+through the download cache (see download_cache.py).
 """
 
 import os
 import re
-import urllib.request
-import shutil
 import uuid
+from typing import Tuple
 from django.conf import settings
 import gdown
 from mega import Mega
 from bs4 import BeautifulSoup
 
+from .download_cache import DownloadCache, get_cache_key
+from .downloader import ProgressCallback, TIMEOUT, get_session, open_download
 
-def _fetch_from_sm_online(url: str) -> str:
-    req = urllib.request.Request(url)
-    req.add_header(
-        'User-Agent',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36'
-    )
-    content = urllib.request.urlopen(req).read()
-    soup = BeautifulSoup(content, 'html.parser')
+
+def _get_page(url: str) -> BeautifulSoup:
+    response = get_session(url).get(url, timeout=TIMEOUT)
+    response.raise_for_status()
+    return BeautifulSoup(response.content, 'html.parser')
+
+
+def _fetch_from_sm_online(
+    url: str, progress: ProgressCallback | None
+) -> Tuple[str, bool]:
+    soup = _get_page(url)
     link = soup.find('a', string='Mirror')['href']
     assert link.startswith('/static/new/')
-    return fetch_from_url('https://search.stepmaniaonline.net' + link)
+    return fetch_from_url(
+        'https://search.stepmaniaonline.net' + link, progress
+    )
 
 
-def _fetch_from_sm_online_new(url: str) -> str:
-    req = urllib.request.Request(url)
-    req.add_header(
-        'User-Agent',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36'
-    )
-    content = urllib.request.urlopen(req).read()
-    soup = BeautifulSoup(content, 'html.parser')
+def _fetch_from_sm_online_new(
+    url: str, progress: ProgressCallback | None
+) -> Tuple[str, bool]:
+    soup = _get_page(url)
     link = soup.find('a', href=re.compile('^/download/mirror'))['href']
-    return fetch_from_url('https://stepmaniaonline.net' + link)
-    
+    return fetch_from_url('https://stepmaniaonline.net' + link, progress)
 
-def fetch_from_url(url: str) -> str:
+
+def _download(
+    url: str, path: str, progress: ProgressCallback | None
+) -> bool:
+    # returns whether the file came from the download cache
+    cache = DownloadCache(
+        str(settings.MEDIA_ROOT / 'download_cache'),
+        settings.DOWNLOAD_CACHE_MAX_BYTES
+    )
+    with open_download(url, progress) as download:
+        key = get_cache_key(url, download.headers) if cache.enabled else None
+        if key is None:
+            try:
+                download.save(path)
+            except BaseException:
+                if os.path.exists(path):
+                    os.remove(path)
+                raise
+            return False
+        if cache.get(key, path):
+            return True
+        cache.put(key, download.save, path)
+        return False
+
+
+def fetch_from_url(
+    url: str, progress: ProgressCallback | None = None
+) -> Tuple[str, bool]:
+    """Download the file at a URL into MEDIA_ROOT/packs. Returns the path of
+    the file, and whether it came from the download cache. progress is called
+    with the number of bytes downloaded so far and the total (if known), for
+    the downloads that go through the download engine (see downloader.py)."""
     filename = str(uuid.uuid4())
     dir_path = str(settings.MEDIA_ROOT / 'packs')
     path = os.path.join(dir_path, filename)
 
     # fetch from google drive
     if re.match('https?://drive.google.com/', url):
-        return gdown.download(url=url, output=path, fuzzy=True, quiet=True)
+        return (
+            gdown.download(url=url, output=path, fuzzy=True, quiet=True),
+            False
+        )
 
     # fetch from mega
     elif re.match('https?://mega.nz/', url):
         mega = Mega()
         m = mega.login()
-        return str(m.download_url(url, dir_path, filename))
+        return str(m.download_url(url, dir_path, filename)), False
     
     # fetch from stepmaniaonline
     elif re.match('https?://search.stepmaniaonline.net/pack/id/', url):
-        return _fetch_from_sm_online(url)
+        return _fetch_from_sm_online(url, progress)
     
     # fetch from stepmaniaonline (new site)
     elif re.match('https?://stepmaniaonline.net/pack/', url):
-        return _fetch_from_sm_online_new(url)
+        return _fetch_from_sm_online_new(url, progress)
     
     # fetch from dropbox
     elif re.match('https?://www.dropbox.com/', url):
         # modify URL to so it can be fetched from directly
         url = url.replace('dl=0', 'dl=1')
     
-    if url.startswith('http'):
-        req = urllib.request.Request(url)
-        req.add_header(
-            'User-Agent',
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36'
-        )
-    else: # e.g. file://
-        req = url
-    with urllib.request.urlopen(req) as response, open(path, 'wb') as out_file:
-        shutil.copyfileobj(response, out_file)
-
-    return path
\ No newline at end of file
+    cached = _download(url, path, progress)
+    return path, cached
@@ -1,8 +1,10 @@
+import os
 from typing import Any
 from datetime import datetime, timezone, time, timedelta
 from django.db.models import Case, When, CharField, Count, Min, Max, F, FloatField, Q
 from django.db.models.functions import Coalesce, Upper, Cast
 from django.db.models.query import QuerySet
+from django.http import FileResponse
 from django.views import generic
 from django.contrib.postgres.search import SearchVector, SearchQuery
 from django.utils.timezone import make_aware
@@ -253,7 +255,10 @@ class SongDetailView(generic.DetailView):
             }
             if 'stream_info' in chart.analysis:
                 stream_info = chart.analysis['stream_info']
-                data['breakdown'] = generate_breakdown(stream_info)
+                # breakdowns are generated at upload/re-analysis time, but
+                # charts that haven't been re-analyzed yet may lack them
+                data['breakdown'] = chart.breakdowns.get('display') \
+                    or generate_breakdown(stream_info)
                 n_stream = stream_info['total_stream']
                 n_measures = n_stream + stream_info['total_break']
                 if n_measures > 0:
@@ -290,6 +295,19 @@ class SongDetailView(generic.DetailView):
         return ctx
 
 
+class SongSimfileView(generic.detail.BaseDetailView):
+    model = Song
+
+    def render_to_response(self, context):
+        # stored simfiles are named after the hash of their contents, so
+        # serve them under their original name instead of linking to them
+        song = self.object
+        filename = song.simfile_name or os.path.basename(song.simfile.name)
+        return FileResponse(
+            song.simfile.open('rb'), as_attachment=True, filename=filename
+        )
+
+
 class PackSearchView(generic.ListView):
     template_name = 'itgdb_site/pack_search.html'
     context_object_name = 'packs'